@@ -42,6 +42,9 @@ class Enrollment(models.Model):
     remaining_hours_gift = models.DecimalField(max_digits=7, decimal_places=2, default=0)
     remaining_sessions_gift = models.PositiveIntegerField(default=0)
 
+    # 最近一次扣课中付费的部分：扣减 UPDATE 同时写入并 RETURNING，据此拆分付费/赠送（见 schedule.utils.deduct_enrollment）
+    last_deduct_paid = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+
     # 状态
     STATUS = (
         ('active', '在读'),
@@ -79,13 +82,28 @@ class Enrollment(models.Model):
         return f"Enrollment<{self.id}> S{self.student_id} mode={self.course_mode} unit={self.deduct_unit} status={self.status}"
 
     @staticmethod
-    def is_student_studying(student_id: int) -> bool:
-        """判断学生是否有可用余额（在读 & 未过期 & 有剩余）"""
+    def studying_q() -> Q:
+        """“派生在读”条件：在读 & 未过期 & 有剩余"""
         today = timezone.localdate()
-        qs = Enrollment.objects.filter(student_id=student_id, status='active').filter(
+        return Q(status='active') & (
             Q(deduct_unit='hours', remaining_hours__gt=0) |
             Q(deduct_unit='sessions', remaining_sessions__gt=0)
-        ).filter(
+        ) & (
             Q(expire_at__isnull=True) | Q(expire_at__gte=today)
         )
-        return qs.exists()
+
+    @staticmethod
+    def is_student_studying(student_id: int) -> bool:
+        """判断学生是否有可用余额（在读 & 未过期 & 有剩余）"""
+        return Enrollment.objects.filter(Enrollment.studying_q(), student_id=student_id).exists()
+
+    @staticmethod
+    def studying_student_ids(student_ids) -> set:
+        """批量版 is_student_studying：一次查询返回其中在读的学生 id 集合"""
+        student_ids = list(student_ids)
+        if not student_ids:
+            return set()
+        return set(Enrollment.objects
+                   .filter(Enrollment.studying_q(), student_id__in=student_ids)
+                   .values_list('student_id', flat=True)
+                   .distinct())
@@ -3,6 +3,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from decimal import Decimal
 from billing.models import PriceRule, GiftRule
+from billing.pricing import bump_price_version
 from students.models import Student, GRADE_CHOICES
 
 
@@ -154,6 +155,10 @@ class Command(BaseCommand):
                 created_cnt += int(c); updated_cnt += int(u)
             self.stdout.write(f"[gift] small_class buy>={min_qty} → gift={gift} {'(write)' if apply else ''}")
 
+        # 各进程的价格表缓存随版本号失效
+        if apply:
+            bump_price_version()
+
         self.stdout.write(self.style.SUCCESS(
             f"完成：created={created_cnt}, updated={updated_cnt}, mode={'APPLY' if apply else 'DRY-RUN'}"
         ))
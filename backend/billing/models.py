@@ -57,6 +57,21 @@ class GiftRule(models.Model):
         return f'GiftRule<{self.id}> min>={self.min_qty_sessions} gift={self.gift_sessions}'
 
 
+class PriceVersion(models.Model):
+    """
+    价格表版本号（单行，id=1）：PriceRule / GiftRule 写入即 +1
+    各 worker 进程据此判断本地缓存的价格表是否过期
+    """
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'edu_price_version'
+
+    def __str__(self):
+        return f'PriceVersion@{self.version}'
+
+
 class PurchaseOrder(models.Model):
     """
     购买订单：一次结算锁定班型、单位、单价与规则快照
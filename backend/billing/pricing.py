@@ -0,0 +1,160 @@
+# backend/billing/pricing.py
+"""
+价格表进程内缓存（pick_price_rule / pick_gift_rule_for_small_class 共用）
+- 编译结果：(年级, 班型) -> 按 min_qty 升序的阶梯数组；小班赠送 -> 按 min_qty_sessions 升序的门槛数组
+  查询用 bisect，命中“≤ 数量的最高一档”，与原先按 min_qty 倒序线性扫描的结果一致
+- 失效：PriceRule / GiftRule 写入（信号）与 seed_pricing 把版本号 +1
+  版本号存 PriceVersion（单行），多 worker 进程共享
+- 本进程写入提交后立即丢弃本地表；其它进程最多 PRICE_TABLE_RECHECK_SECONDS 秒后查一次版本号，
+  版本变了才重新加载。常态下取价零查询
+- 缓存表只用于报价展示；下单计价用 fresh_price_table 直接读库，不受复查间隔影响
+"""
+import threading
+import time
+from bisect import bisect_right
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+D = Decimal
+
+PRICE_VERSION_ID = 1
+PRICE_TABLE_RECHECK_SECONDS = 30
+
+_lock = threading.Lock()
+_table = None       # 当前编译好的 PriceTable
+_checked_at = 0.0   # 最近一次确认版本号的时间（monotonic）
+
+
+class PriceTable:
+    """一次加载的全部有效规则；构建后只读，可被多个线程共享"""
+
+    def __init__(self, version, price_rules, gift_rules):
+        # version：构建时的 PriceVersion；fresh_price_table 直接读库，为 None
+        self.version = version
+        self._tiers = {}
+        for r in sorted(price_rules, key=lambda r: (r.min_qty, r.id)):
+            mins, rules = self._tiers.setdefault((r.grade, r.course_mode), ([], []))
+            mins.append(r.min_qty)
+            rules.append(r)
+        gifts = sorted(gift_rules, key=lambda r: (r.min_qty_sessions, r.id))
+        self._gift_mins = [r.min_qty_sessions for r in gifts]
+        self._gifts = gifts
+
+    def price_rule(self, grade: int, course_mode: str, qty):
+        """≤ qty 的最高一档；qty 低于所有档位时取最低档；未配置返回 None"""
+        tier = self._tiers.get((grade, course_mode))
+        if not tier:
+            return None
+        mins, rules = tier
+        i = bisect_right(mins, Decimal(qty)) - 1
+        return rules[max(i, 0)]
+
+    def gift_rule(self, qty_sessions: int):
+        """购买节数命中的最高赠送档；不足最低门槛返回 None"""
+        i = bisect_right(self._gift_mins, int(qty_sessions)) - 1
+        return self._gifts[i] if i >= 0 else None
+
+
+def _current_version() -> int:
+    from .models import PriceVersion
+    v = PriceVersion.objects.filter(pk=PRICE_VERSION_ID).values_list('version', flat=True).first()
+    return v or 0
+
+
+def _load(version: int) -> PriceTable:
+    from .models import PriceRule, GiftRule
+    return PriceTable(
+        version,
+        PriceRule.objects.filter(is_active=True),
+        GiftRule.objects.filter(course_mode='small_class', is_active=True),
+    )
+
+
+def fresh_price_table(grade: int, course_mode: str) -> PriceTable:
+    """直接读库、只含该年级与班型规则的价格表（下单计价用，不经过进程缓存）"""
+    from .models import PriceRule, GiftRule
+    gifts = (GiftRule.objects.filter(course_mode='small_class', is_active=True)
+             if course_mode == 'small_class' else [])
+    return PriceTable(
+        None,
+        PriceRule.objects.filter(grade=grade, course_mode=course_mode, is_active=True),
+        gifts,
+    )
+
+
+def price_table() -> PriceTable:
+    """取当前价格表；过了复查间隔才查版本号，版本变化才重新加载"""
+    global _table, _checked_at
+    now = time.monotonic()
+    table = _table
+    if table is not None and now - _checked_at < PRICE_TABLE_RECHECK_SECONDS:
+        return table
+    with _lock:
+        if _table is not None and now - _checked_at < PRICE_TABLE_RECHECK_SECONDS:
+            return _table
+        version = _current_version()
+        if _table is None or _table.version != version:
+            _table = _load(version)
+        _checked_at = now
+        return _table
+
+
+def invalidate_local() -> None:
+    """丢弃本进程的价格表，下次取价重新加载"""
+    global _table
+    with _lock:
+        _table = None
+
+
+def bump_price_version() -> None:
+    """价格/赠送规则变更：全局版本 +1；本进程缓存立即丢弃，事务提交后再丢一次（防止提交前被旧数据重新填充）"""
+    from .models import PriceVersion
+    if not PriceVersion.objects.filter(pk=PRICE_VERSION_ID).update(version=F('version') + 1):
+        try:
+            with transaction.atomic():
+                PriceVersion.objects.create(pk=PRICE_VERSION_ID, version=1)
+        except IntegrityError:
+            # 并发下别人刚创建：再 +1 一次，保证本次写入一定使旧版本失效
+            PriceVersion.objects.filter(pk=PRICE_VERSION_ID).update(version=F('version') + 1)
+    invalidate_local()
+    transaction.on_commit(invalidate_local)
+
+
+# —— 报价计算（PurchaseIn 与批量报价共用）——
+def qty_error(course_mode: str, qty):
+    """购买数量校验：小班整数节，小时类 0.5 步长；合法返回 None，否则返回错误信息"""
+    qty = D(qty)
+    if qty <= 0:
+        return '购买数量必须大于 0'
+    if course_mode == 'small_class':
+        if qty != qty.to_integral_value():
+            return '小班购买数量必须为整数节'
+    elif (qty * D('2')) != (qty * D('2')).to_integral_value():
+        return '小时购买数量必须以 0.5 为步长'
+    return None
+
+
+def quote_line(grade: int, course_mode: str, qty, table: PriceTable = None):
+    """
+    单行报价（不含折扣/立减）：单价、小计、赠送（小班按赠送规则，小时类为 0）
+    未配置价格规则返回 None；数量需先经 qty_error 校验
+    table 缺省取进程缓存的价格表（报价用）；下单传 fresh_price_table
+    """
+    from .models import UNIT_OF_MODE
+    table = table or price_table()
+    qty = D(qty)
+    rule = table.price_rule(grade, course_mode, qty)
+    if rule is None:
+        return None
+    unit_price = D(rule.unit_price)
+    gift_rule = table.gift_rule(int(qty)) if course_mode == 'small_class' else None
+    return {
+        'unit': UNIT_OF_MODE[course_mode],
+        'rule': rule,
+        'unit_price': unit_price,
+        'subtotal': (qty * unit_price).quantize(D('0.01'), rounding=ROUND_HALF_UP),
+        'gift_rule': gift_rule,
+        'gift_qty': D(gift_rule.gift_sessions) if gift_rule else D('0'),
+    }
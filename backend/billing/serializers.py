@@ -1,27 +1,21 @@
 from decimal import Decimal, ROUND_HALF_UP
+from django.db.models import F
 from rest_framework import serializers
-from students.models import Student
+from students.models import Student, GRADE_CHOICES
 from academics.models import Enrollment
-from .models import PriceRule, GiftRule, PurchaseOrder, UNIT_OF_MODE
+from .models import PurchaseOrder, UNIT_OF_MODE
+from .pricing import fresh_price_table, price_table, qty_error, quote_line
 
 D = Decimal
 
 def pick_price_rule(grade: int, course_mode: str, qty: D):
     """
-    取价：同(年级, 班型)下，按 min_qty 从高到低匹配
+    取价：同(年级, 班型)下，取 min_qty ≤ qty 的最高一档（进程内价格表，见 billing.pricing）
     """
-    qs = PriceRule.objects.filter(grade=grade, course_mode=course_mode, is_active=True).order_by('-min_qty')
-    for r in qs:
-        if D(qty) >= r.min_qty:
-            return r
-    return qs.last()  # 若都不满足，取最小档；若整体为空，则为 None
+    return price_table().price_rule(grade, course_mode, qty)
 
 def pick_gift_rule_for_small_class(qty_sessions: int):
-    qs = GiftRule.objects.filter(course_mode='small_class', is_active=True).order_by('-min_qty_sessions')
-    for r in qs:
-        if int(qty_sessions) >= r.min_qty_sessions:
-            return r
-    return None
+    return price_table().gift_rule(qty_sessions)
 
 class PriceIn(serializers.Serializer):
     student_id = serializers.IntegerField()
@@ -51,6 +45,102 @@ class PriceOut(serializers.Serializer):
     unit_price = serializers.DecimalField(max_digits=10, decimal_places=2)
     rule_id = serializers.IntegerField()
 
+MAX_QUOTE_ROWS = 500
+COURSE_MODES = list(UNIT_OF_MODE.keys())
+
+class PriceQuoteItemIn(serializers.Serializer):
+    """批量报价的一行：student_id 与 grade 二选一（给 student_id 时按学生当前年级）"""
+    student_id = serializers.IntegerField(required=False)
+    grade = serializers.ChoiceField(choices=GRADE_CHOICES, required=False)
+    course_mode = serializers.ChoiceField(choices=COURSE_MODES)
+    qty = serializers.DecimalField(max_digits=7, decimal_places=2, required=False, default=D('1'))
+
+    def validate(self, attrs):
+        if ('student_id' in attrs) == ('grade' in attrs):
+            raise serializers.ValidationError('student_id 与 grade 必须且只能提供一个')
+        return attrs
+
+class PriceQuoteGridIn(serializers.Serializer):
+    """价目表网格：(学生 或 若干年级) × 班型 × 数量 的笛卡尔积"""
+    student_id = serializers.IntegerField(required=False)
+    grades = serializers.ListField(child=serializers.ChoiceField(choices=GRADE_CHOICES), required=False, allow_empty=False)
+    course_modes = serializers.ListField(child=serializers.ChoiceField(choices=COURSE_MODES), required=False,
+                                         allow_empty=False, default=lambda: list(COURSE_MODES))
+    qtys = serializers.ListField(child=serializers.DecimalField(max_digits=7, decimal_places=2), allow_empty=False)
+
+    def validate(self, attrs):
+        if ('student_id' in attrs) == ('grades' in attrs):
+            raise serializers.ValidationError('student_id 与 grades 必须且只能提供一个')
+        return attrs
+
+    def rows(self, v):
+        heads = [{'student_id': v['student_id']}] if 'student_id' in v else [{'grade': g} for g in v['grades']]
+        return [dict(h, course_mode=m, qty=q) for h in heads for m in v['course_modes'] for q in v['qtys']]
+
+class PriceBatchIn(serializers.Serializer):
+    """
+    批量报价：items（逐行列出）与 grid（网格展开）二选一
+    - 学生年级一次查询取齐；价格/赠送走进程内价格表，逐行计算与 PurchaseIn 相同（不含折扣/立减）
+    - 单行失败（学生不存在、数量不合法、未配置价格）只在该行给出 error，不影响其它行
+    """
+    items = PriceQuoteItemIn(many=True, required=False)
+    grid = PriceQuoteGridIn(required=False)
+
+    def validate(self, attrs):
+        if ('items' in attrs) == ('grid' in attrs):
+            raise serializers.ValidationError('items 与 grid 必须且只能提供一个')
+        rows = attrs['items'] if 'items' in attrs else self.fields['grid'].rows(attrs['grid'])
+        if not rows:
+            raise serializers.ValidationError('报价行不能为空')
+        if len(rows) > MAX_QUOTE_ROWS:
+            raise serializers.ValidationError(f'单次最多报价 {MAX_QUOTE_ROWS} 行')
+        attrs['rows'] = rows
+        return attrs
+
+    def create(self, v):
+        rows = v['rows']
+        sids = {r['student_id'] for r in rows if 'student_id' in r}
+        grade_of = dict(Student.objects.filter(id__in=sids).values_list('id', 'grade')) if sids else {}
+        table = price_table()
+
+        out = []
+        for r in rows:
+            course_mode, qty = r['course_mode'], D(r['qty'])
+            grade = grade_of.get(r['student_id']) if 'student_id' in r else r['grade']
+            line = {
+                'student_id': r.get('student_id'), 'grade': grade, 'course_mode': course_mode, 'qty': qty,
+                'unit': UNIT_OF_MODE[course_mode], 'unit_price': None, 'subtotal': None, 'gift_qty': None,
+                'rule_id': None, 'gift_rule_id': None, 'error': None,
+            }
+            if grade is None:
+                line['error'] = '学生不存在'
+            else:
+                line['error'] = qty_error(course_mode, qty)
+            if not line['error']:
+                q = quote_line(grade, course_mode, qty, table=table)
+                if q:
+                    line.update({
+                        'unit_price': q['unit_price'], 'subtotal': q['subtotal'], 'gift_qty': q['gift_qty'],
+                        'rule_id': q['rule'].id, 'gift_rule_id': getattr(q['gift_rule'], 'id', None),
+                    })
+                else:
+                    line['error'] = '未配置该年级与班型的价格规则'
+            out.append(line)
+        return out
+
+class PriceQuoteOut(serializers.Serializer):
+    student_id = serializers.IntegerField(allow_null=True)
+    grade = serializers.IntegerField(allow_null=True)
+    course_mode = serializers.CharField()
+    qty = serializers.DecimalField(max_digits=7, decimal_places=2)
+    unit = serializers.CharField()
+    unit_price = serializers.DecimalField(max_digits=10, decimal_places=2, allow_null=True)
+    subtotal = serializers.DecimalField(max_digits=12, decimal_places=2, allow_null=True)
+    gift_qty = serializers.DecimalField(max_digits=7, decimal_places=2, allow_null=True)
+    rule_id = serializers.IntegerField(allow_null=True)
+    gift_rule_id = serializers.IntegerField(allow_null=True)
+    error = serializers.CharField(allow_null=True)
+
 class PurchaseIn(serializers.Serializer):
     student_id = serializers.IntegerField()
     course_mode = serializers.ChoiceField(choices=list(UNIT_OF_MODE.keys()))
@@ -73,23 +163,12 @@ class PurchaseIn(serializers.Serializer):
             raise serializers.ValidationError('学生不存在')
         attrs['student'] = student
 
-        # 数量
+        # 数量（小班整数节，小时类 0.5 步长）
         qty = D(attrs['qty'])
-        if qty <= 0:
-            raise serializers.ValidationError('购买数量必须大于 0')
-
         course_mode = attrs['course_mode']
-        unit = UNIT_OF_MODE[course_mode]
-        attrs['unit'] = unit
-
-        # 小班：购买数量必须为整数节
-        if course_mode == 'small_class':
-            if qty != qty.to_integral_value():
-                raise serializers.ValidationError('小班购买数量必须为整数节')
-        else:
-            # 小时类：按 0.5 步长
-            if (qty * D('2')) != (qty * D('2')).to_integral_value():
-                raise serializers.ValidationError('小时购买数量必须以 0.5 为步长')
+        msg = qty_error(course_mode, qty)
+        if msg:
+            raise serializers.ValidationError(msg)
 
         # 金额校验
         dp = D(attrs.get('discount_percent') or 0)
@@ -99,28 +178,20 @@ class PurchaseIn(serializers.Serializer):
         if direct_off < 0:
             raise serializers.ValidationError('立减金额不可为负')
 
-        # 取价
-        rule = pick_price_rule(student.grade, course_mode, qty)
-        if not rule:
+        # 取价 + 赠送（小班自动、小时类默认 0）；实际收费直接读库，不用可能滞后的缓存价格表
+        q = quote_line(student.grade, course_mode, qty, table=fresh_price_table(student.grade, course_mode))
+        if not q:
             raise serializers.ValidationError('未配置该年级与班型的价格规则')
+        attrs['unit'] = q['unit']
+        rule, unit_price, subtotal = q['rule'], q['unit_price'], q['subtotal']
+        gift_rule, gift_qty = q['gift_rule'], q['gift_qty']
+        gift_source = 'auto'
 
-        unit_price = D(rule.unit_price)
-        subtotal = (qty * unit_price).quantize(D('0.01'), rounding=ROUND_HALF_UP)
         after_discount = (subtotal * (D('100') - dp) / D('100')).quantize(D('0.01'), rounding=ROUND_HALF_UP)
         if direct_off > after_discount:
             raise serializers.ValidationError('立减金额不能超过折扣后的小计金额')
         total_payable = (after_discount - direct_off).quantize(D('0.01'), rounding=ROUND_HALF_UP)
 
-        # 赠送（小班自动、小时类默认 0）
-        gift_qty = D('0')
-        gift_rule = None
-        gift_source = 'auto'
-        if course_mode == 'small_class':
-            gr = pick_gift_rule_for_small_class(int(qty))
-            if gr:
-                gift_rule = gr
-                gift_qty = D(gr.gift_sessions)
-
         # 人工覆盖（可选）
         if 'gift_override' in attrs and attrs['gift_override'] is not None:
             gift_qty = D(attrs['gift_override'])
@@ -176,21 +247,23 @@ class PurchaseIn(serializers.Serializer):
                 course_mode=course_mode,
                 defaults={'deduct_unit': unit, 'status': 'active'}
             )
-            # 保持单位一致
-            en.deduct_unit = unit
 
+            # 充值：F() 原子累加（与并发消课不会互相覆盖）；保持单位一致；仅累计实付金额
             if unit == 'hours':
-                en.purchased_hours = (en.purchased_hours or 0) + qty
-                en.remaining_hours = (en.remaining_hours or 0) + qty
-                en.remaining_hours_gift = (getattr(en, 'remaining_hours_gift', 0) or 0) + gift_qty
+                credit = {
+                    'purchased_hours': F('purchased_hours') + qty,
+                    'remaining_hours': F('remaining_hours') + qty,
+                    'remaining_hours_gift': F('remaining_hours_gift') + gift_qty,
+                }
             else:
-                en.purchased_sessions = (en.purchased_sessions or 0) + int(qty)
-                en.remaining_sessions = (en.remaining_sessions or 0) + int(qty)
-                en.remaining_sessions_gift = (getattr(en, 'remaining_sessions_gift', 0) or 0) + int(gift_qty)
-
-            # 仅累计实付金额
-            en.amount_total = (en.amount_total or D('0')) + v['total_payable']
-            en.save()
+                credit = {
+                    'purchased_sessions': F('purchased_sessions') + int(qty),
+                    'remaining_sessions': F('remaining_sessions') + int(qty),
+                    'remaining_sessions_gift': F('remaining_sessions_gift') + int(gift_qty),
+                }
+            Enrollment.objects.filter(pk=en.pk).update(
+                deduct_unit=unit, amount_total=F('amount_total') + v['total_payable'], **credit
+            )
 
         return po
 
@@ -0,0 +1,15 @@
+# backend/billing/signals.py
+"""
+价格表缓存失效：PriceRule / GiftRule 任一写入或删除即把价格版本 +1
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import PriceRule, GiftRule
+from .pricing import bump_price_version
+
+
+@receiver([post_save, post_delete], sender=PriceRule)
+@receiver([post_save, post_delete], sender=GiftRule)
+def _pricing_changed(sender, instance, **kwargs):
+    bump_price_version()
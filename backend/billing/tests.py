@@ -1,3 +1,160 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from students.models import School, Student
+
+from . import pricing
+from .models import PriceRule, GiftRule, PriceVersion, PurchaseOrder
+
+User = get_user_model()
+
+
+class PricingFixtureMixin:
+    @classmethod
+    def make_base(cls):
+        cls.admin = User.objects.create(username='admin', role='admin', is_staff=True)
+        school = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+        cls.student = Student.objects.create(name='张伟', grade=8, school=school)
+        cls.rule = PriceRule.objects.create(grade=8, course_mode='one_to_one', min_qty=0, unit_price=Decimal('200'))
+        PriceRule.objects.create(grade=8, course_mode='small_class', min_qty=0, unit_price=Decimal('100'))
+        GiftRule.objects.create(min_qty_sessions=10, gift_sessions=2)
+
+    def setUp(self):
+        pricing.invalidate_local()  # 进程级缓存不跨用例
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+
+class PriceVersionTests(PricingFixtureMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+
+    def test_rule_write_bumps_version_and_reloads(self):
+        before = PriceVersion.objects.get().version
+        self.assertEqual(pricing.price_table().price_rule(8, 'one_to_one', 1).unit_price, Decimal('200'))
+        self.rule.unit_price = Decimal('250')
+        self.rule.save()
+        self.assertEqual(PriceVersion.objects.get().version, before + 1)
+        self.assertEqual(pricing.price_table().price_rule(8, 'one_to_one', 1).unit_price, Decimal('250'))
+
+    def test_purchase_charges_current_db_price(self):
+        pricing.price_table()  # 本进程缓存旧价
+        # 模拟别的进程改价：本进程缓存在复查间隔内仍是旧价
+        PriceRule.objects.filter(id=self.rule.id).update(unit_price=Decimal('300'))
+        self.assertEqual(pricing.price_table().price_rule(8, 'one_to_one', 1).unit_price, Decimal('200'))
+
+        resp = self.client.post('/api/billing/purchases', {
+            'student_id': self.student.id, 'course_mode': 'one_to_one', 'qty': '2',
+        }, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(Decimal(resp.json()['data']['unit_price']), Decimal('300'))
+        self.assertEqual(Decimal(resp.json()['data']['total_payable']), Decimal('600'))
+
+
+class PriceBatchTests(PricingFixtureMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+
+    def _batch(self, body):
+        return self.client.post('/api/billing/price/batch', body, format='json')
+
+    def test_grid_expands_in_request_order(self):
+        resp = self._batch({'grid': {'grades': [8, 9], 'course_modes': ['one_to_one', 'small_class'], 'qtys': [10, 20]}})
+        self.assertEqual(resp.status_code, 200, resp.content)
+        rows = resp.json()['data']
+        self.assertEqual([(r['grade'], r['course_mode'], Decimal(r['qty'])) for r in rows], [
+            (g, m, Decimal(q)) for g in (8, 9) for m in ('one_to_one', 'small_class') for q in (10, 20)
+        ])
+        first = rows[0]
+        self.assertEqual((Decimal(first['unit_price']), Decimal(first['subtotal'])), (Decimal('200'), Decimal('2000')))
+        self.assertEqual(first['rule_id'], self.rule.id)
+        small = rows[2]
+        self.assertEqual(Decimal(small['gift_qty']), Decimal('2'))
+        self.assertIsNotNone(small['gift_rule_id'])
+
+    def test_grid_for_student_uses_student_grade(self):
+        rows = self._batch({'grid': {'student_id': self.student.id, 'course_modes': ['one_to_one'], 'qtys': [1]}}).json()['data']
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]['student_id'], rows[0]['grade']), (self.student.id, 8))
+
+    def test_row_errors_do_not_fail_the_batch(self):
+        resp = self._batch({'items': [
+            {'grade': 8, 'course_mode': 'small_class', 'qty': '1.5'},   # 小班非整数节
+            {'grade': 8, 'course_mode': 'one_to_one', 'qty': '1.3'},    # 小时非 0.5 步长
+            {'student_id': 999999, 'course_mode': 'one_to_one'},
+            {'grade': 9, 'course_mode': 'one_to_one', 'qty': 2},        # 未配置价格
+            {'grade': 8, 'course_mode': 'one_to_one', 'qty': 2},
+        ]})
+        self.assertEqual(resp.status_code, 200, resp.content)
+        rows = resp.json()['data']
+        self.assertEqual([r['error'] for r in rows], [
+            '小班购买数量必须为整数节', '小时购买数量必须以 0.5 为步长', '学生不存在', '未配置该年级与班型的价格规则', None,
+        ])
+        for r in rows[:4]:
+            self.assertIsNone(r['unit_price'])
+            self.assertIsNone(r['subtotal'])
+        self.assertEqual(Decimal(rows[4]['subtotal']), Decimal('400'))
+
+    def test_request_shape_errors(self):
+        self.assertEqual(self._batch({}).status_code, 400)
+        self.assertEqual(self._batch({'items': [], 'grid': {'grades': [8], 'qtys': [1]}}).status_code, 400)
+        self.assertEqual(self._batch({'items': [{'grade': 8, 'student_id': self.student.id, 'course_mode': 'one_to_one'}]}).status_code, 400)
+        too_many = {'grid': {'grades': [8], 'qtys': list(range(1, 200)), 'course_modes': ['one_to_one', 'one_to_two', 'small_class']}}
+        self.assertEqual(self._batch(too_many).status_code, 400)
+
+
+class EnrollmentSummaryTests(PricingFixtureMixin, TestCase):
+    """账户汇总：查询数固定（不随班型/订单数增长），赠送合计与最近一笔的操作人正确"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        PriceRule.objects.create(grade=8, course_mode='one_to_two', min_qty=0, unit_price=Decimal('150'))
+        cls.cashier = User.objects.create(username='cashier', name='前台小王', role='admin', is_staff=True)
+
+    def _buy(self, user, course_mode, qty):
+        client = APIClient()
+        client.force_authenticate(user)
+        resp = client.post('/api/billing/purchases', {
+            'student_id': self.student.id, 'course_mode': course_mode, 'qty': str(qty),
+        }, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+
+    def _summary(self):
+        resp = self.client.get('/api/billing/enrollment-summary', {'student_id': self.student.id})
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return {row['course_mode']: row for row in resp.json()['data']}
+
+    def test_query_count_does_not_grow_with_modes_or_orders(self):
+        self._buy(self.admin, 'one_to_one', 2)
+        with self.assertNumQueries(2):
+            self._summary()
+
+        for mode, qtys in (('one_to_one', (10, 4)), ('one_to_two', (3, 12)), ('small_class', (10, 20, 5))):
+            for qty in qtys:
+                self._buy(self.admin, mode, qty)
+        with self.assertNumQueries(2):
+            rows = self._summary()
+        self.assertEqual(set(rows), {'one_to_one', 'one_to_two', 'small_class'})
+
+    def test_gift_totals_and_last_operator(self):
+        self._buy(self.admin, 'small_class', 10)
+        self._buy(self.admin, 'small_class', 20)
+        self._buy(self.cashier, 'small_class', 5)
+        self._buy(self.cashier, 'one_to_one', 10)
+        self._buy(self.admin, 'one_to_one', 2)
+        rows = self._summary()
 
-# Create your tests here.
+        for mode, row in rows.items():
+            orders = PurchaseOrder.objects.filter(student=self.student, course_mode=mode).order_by('id')
+            gift_total = sum(o.gift_qty for o in orders)
+            self.assertEqual(Decimal(str(row['purchased_gift_qty'])), gift_total, mode)
+            self.assertEqual(row['last_purchase']['id'], orders.last().id, mode)
+        self.assertEqual(rows['small_class']['purchased_gift_qty'], 4)
+        self.assertEqual(rows['small_class']['last_purchase']['operator_name'], '前台小王')
+        self.assertEqual(rows['one_to_one']['last_purchase']['operator_name'], 'admin')
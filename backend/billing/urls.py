@@ -1,8 +1,9 @@
 from django.urls import path
-from .views import PriceView, PurchaseCreateView , EnrollmentSummaryView, PurchaseListView
+from .views import PriceView, PriceBatchView, PurchaseCreateView , EnrollmentSummaryView, PurchaseListView
 
 urlpatterns = [
     path('billing/price', PriceView.as_view()),
+    path('billing/price/batch', PriceBatchView.as_view()),   # POST 批量报价
     path('billing/purchases', PurchaseCreateView.as_view()),
     path('billing/enrollment-summary', EnrollmentSummaryView.as_view()),  # GET 汇总
     path('billing/purchases/list', PurchaseListView.as_view()),      # GET 列表
@@ -2,9 +2,9 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
-from .serializers import PriceIn, PriceOut, PurchaseIn, PurchaseOut
+from .serializers import PriceIn, PriceOut, PriceBatchIn, PriceQuoteOut, PurchaseIn, PurchaseOut
 from .models import PurchaseOrder, UNIT_OF_MODE
-from django.db.models import Sum
+from django.db.models import Sum, Max, OuterRef, Subquery
 from academics.models import Enrollment
 
 ALLOWED_ROLES = ('admin', 'salesperson')
@@ -18,6 +18,22 @@ class PriceView(APIView):
         data = s.save()
         return Response({'code': 200, 'data': PriceOut(data).data})
 
+class PriceBatchView(APIView):
+    """
+    批量报价：一次返回整张价目表（单价、小计、赠送、命中规则）
+    POST /api/billing/price/batch
+      {"items": [{"student_id": 1, "course_mode": "one_to_one", "qty": 80}, {"grade": 8, "course_mode": "small_class", "qty": 60}]}
+      或 {"grid": {"student_id": 1 | "grades": [7, 8], "course_modes": [...], "qtys": [40, 80, 160]}}
+    结果与请求行一一对应，单行失败见该行 error
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        s = PriceBatchIn(data=request.data)
+        s.is_valid(raise_exception=True)
+        rows = s.save()
+        return Response({'code': 200, 'data': PriceQuoteOut(rows, many=True).data})
+
 class PurchaseCreateView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -45,6 +61,22 @@ class EnrollmentSummaryView(APIView):
 
         # 在读账户（每个班型各一条）
         ens = Enrollment.objects.filter(student_id=sid, status='active').order_by('course_mode')
+
+        # 每个班型最近一笔订单（连同操作人）+ 该班型累计赠送：一次查询
+        orders = PurchaseOrder.objects.filter(student_id=sid)
+        gift_sum_sq = (PurchaseOrder.objects
+                       .filter(student_id=sid, course_mode=OuterRef('course_mode'))
+                       .values('course_mode')
+                       .annotate(s=Sum('gift_qty'))
+                       .values('s'))
+        latest_by_mode = {
+            po.course_mode: po
+            for po in (orders
+                       .filter(id__in=orders.values('course_mode').annotate(m=Max('id')).values('m'))
+                       .select_related('operator')
+                       .annotate(gift_total=Subquery(gift_sum_sq)))
+        }
+
         data = []
         for en in ens:
             unit = en.deduct_unit  # hours / sessions
@@ -58,17 +90,13 @@ class EnrollmentSummaryView(APIView):
                 remaining_gift = int(getattr(en, 'remaining_sessions_gift', 0) or 0)
                 purchased_paid_qty = int(en.purchased_sessions or 0)
 
-            # 累计赠送总量（按订单礼赠汇总）
-            gift_sum = PurchaseOrder.objects.filter(
-                student_id=sid, course_mode=en.course_mode
-            ).aggregate(s=Sum('gift_qty'))['s'] or 0
-
-            # 最近一笔
-            last_po = PurchaseOrder.objects.filter(student_id=sid, course_mode=en.course_mode).order_by('-id').first()
+            # 最近一笔 & 累计赠送总量（按订单礼赠汇总）
+            last_po = latest_by_mode.get(en.course_mode)
+            gift_sum = (last_po.gift_total or 0) if last_po else 0
             last = None
             if last_po:
                 # 取操作人显示名
-                oper = getattr(last_po, 'operator', None)
+                oper = last_po.operator
                 oper_name = None
                 if oper:
                     oper_name = getattr(oper, 'name', None) or getattr(oper, 'username', None)
@@ -74,6 +74,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',  # 改为内置sqlite引擎
         'NAME': BASE_DIR / 'db.sqlite3',         # 数据文件放在项目根目录
+        # 测试库用文件而非内存：多进程并发用例（如 ConcurrentDeductionTests）需要共享同一个库
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
@@ -0,0 +1,296 @@
+# backend/schedule/attendance.py
+"""
+签到提交/撤销的批量流水线（单课次与多课次的提交、撤销共用）
+- compute_attendance_plan：只读（不写任何数据），固定几次查询
+    · 所有课次的在班学生、已请假名单各一次查询
+    · 所需账户（学生 × 班型）一次查询取齐
+    · 余额在内存中按“先付费再赠送”逐课次模拟，算出每条出勤的 paid_used / gift_used
+- apply_attendance_plan：一个写事务
+    · 所有账户一条 CASE UPDATE 扣减，WHERE 带每个账户的余额条件（只用付费：付费 >= 用量；
+      用到赠送：付费仍为读到的值且赠送够扣）；命中行数不符说明读后有人改了余额 → 抛 AttendanceConflict，事务回滚
+    · Attendance / TeacherWorklog 批量写入；课次批量置为已完成并加锁
+- commit_attendance：计划 + 写入，遇到并发冲突重算重试
+- revert_attendance：批量撤销，按账户聚合回补，出勤/工时批量删除
+写入期间不跑 Python 逐行逻辑，SQLite 写锁只占用固定几条语句的时间
+"""
+import operator
+from collections import defaultdict
+from decimal import Decimal
+from functools import reduce
+
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Sum, Value
+from django.utils import timezone
+
+from academics.models import Enrollment
+from .models import Lesson, ClassEnrollment, LessonLeave, Attendance, TeacherWorklog
+from .utils import get_student_deduct, round_to_half_hours, balance_fields, credit_enrollment
+from .versioning import TIMETABLE, bump_version
+
+D = Decimal
+CENT = D('0.00')
+COMMIT_RETRIES = 3
+DEDUCT_UPDATE_BATCH = 200  # 单条 CASE UPDATE 覆盖的账户数上限
+
+
+class AttendanceConflict(Exception):
+    """读取余额/课次状态后被并发修改，本次写入已回滚"""
+
+
+# —— 计划 ——
+def lesson_final_statuses(members, leaves, payload) -> dict:
+    """在班学生 + 已请假 + 提交内容 -> {student_id: status}（与原单课次口径一致）"""
+    final = {sid: ('leave' if sid in leaves else 'absent') for sid in members}
+    # 一键签到：全部置为 present（已请假的仍保持 leave）
+    if payload.get('all_present'):
+        for sid in members:
+            if sid not in leaves:
+                final[sid] = 'present'
+    # 明细覆盖（不在班的学生忽略）
+    for it in payload.get('items') or []:
+        if it['student_id'] in final:
+            final[it['student_id']] = it['status']
+    return final
+
+
+def _load_accounts(keys) -> dict:
+    """
+    {(student_id, course_mode): unit} -> {(student_id, course_mode): Enrollment}，一次查询；只读
+    同一键有多条时优先在读账户；没有账户的不在结果里（余额按 0 计，出勤会被判为余额不足）
+    """
+    if not keys:
+        return {}
+    found = {}
+    for en in (Enrollment.objects
+               .filter(student_id__in={sid for sid, _ in keys}, course_mode__in={mode for _, mode in keys})
+               .order_by('student_id', 'course_mode', 'id')):
+        key = (en.student_id, en.course_mode)
+        if key in keys and (key not in found or (en.status == 'active' and found[key].status != 'active')):
+            found[key] = en
+    return found
+
+
+def compute_attendance_plan(lessons, payloads) -> dict:
+    """
+    lessons：已 select_related('class_group') 的课次列表；payloads：{lesson_id: {all_present, items}}
+    返回：
+      lessons  {lesson_id: {'lesson', 'final', 'unit', 'qty', 'rows'}}，rows 为待写入的出勤字段
+      accounts {(student_id, course_mode): {'enrollment', 'unit', 'paid_before', 'gift_before', 'paid', 'gift'}}
+      errors   {lesson_id: {'message', 'insufficient'?}}
+    """
+    lessons = sorted(lessons, key=lambda les: (les.date, les.start_time, les.id))
+    group_ids = {les.class_group_id for les in lessons}
+
+    members = defaultdict(list)
+    for gid, sid in (ClassEnrollment.objects.filter(class_group_id__in=group_ids, left_at__isnull=True)
+                     .order_by('id').values_list('class_group_id', 'student_id')):
+        members[gid].append(sid)
+    leaves = defaultdict(set)
+    for lid, sid in (LessonLeave.objects.filter(lesson_id__in=[les.id for les in lessons])
+                     .values_list('lesson_id', 'student_id')):
+        leaves[lid].add(sid)
+
+    plan_lessons, errors, keys = {}, {}, {}
+    for les in lessons:
+        if not members[les.class_group_id]:
+            errors[les.id] = {'message': '班内无学生'}
+            continue
+        mode = les.class_group.course_mode
+        unit, qty = get_student_deduct(mode, les.duration_minutes)
+        final = lesson_final_statuses(members[les.class_group_id], leaves[les.id], payloads.get(les.id) or {})
+        plan_lessons[les.id] = {'lesson': les, 'final': final, 'unit': unit, 'qty': qty, 'rows': []}
+        for sid, st in final.items():
+            if st == 'present':
+                keys[(sid, mode)] = unit
+
+    accounts = {}
+    found = _load_accounts(keys)
+    for key, unit in keys.items():
+        en = found.get(key)
+        paid_f, gift_f = balance_fields(unit)
+        paid = D(getattr(en, paid_f) or 0) if en else D('0')
+        gift = D(getattr(en, gift_f) or 0) if en else D('0')
+        accounts[key] = {'enrollment': en, 'unit': unit,
+                         'paid_before': paid, 'gift_before': gift, 'paid': paid, 'gift': gift}
+
+    # 按上课先后逐课次模拟扣课：先付费，再赠送
+    short = defaultdict(list)
+    for lid, p in plan_lessons.items():
+        mode = p['lesson'].class_group.course_mode
+        for sid, st in p['final'].items():
+            row = {'student_id': sid, 'status': st}
+            if st == 'present':
+                acc = accounts[(sid, mode)]
+                paid_used = min(acc['paid'], p['qty'])
+                gift_used = p['qty'] - paid_used
+                if gift_used > acc['gift']:
+                    short[lid].append(sid)
+                    continue
+                acc['paid'] -= paid_used
+                acc['gift'] -= gift_used
+                row.update(deduct_unit=p['unit'], deduct_qty=p['qty'],
+                           deduct_from=('paid' if paid_used > 0 else 'gift'),
+                           paid_used=paid_used.quantize(CENT), gift_used=gift_used.quantize(CENT))
+            p['rows'].append(row)
+    for lid, sids in short.items():
+        errors[lid] = {'message': '部分学生余额不足', 'insufficient': sids}
+
+    return {'lessons': plan_lessons, 'accounts': accounts, 'errors': errors}
+
+
+# —— 写入 ——
+def _deduct_accounts(accounts) -> None:
+    """每批账户一条 UPDATE：SET 余额 = CASE id WHEN .. THEN 余额 - x .. END，WHERE 带每个账户的余额条件"""
+    used = [a for a in accounts.values() if a['paid'] != a['paid_before'] or a['gift'] != a['gift_before']]
+    # 与 utils.ensure_enrollment 一致：扣课单位以本次课为准
+    wrong_unit = defaultdict(list)
+    for a in used:
+        if a['enrollment'].deduct_unit != a['unit']:
+            wrong_unit[a['unit']].append(a['enrollment'].pk)
+    for unit, ids in wrong_unit.items():
+        Enrollment.objects.filter(id__in=ids).update(deduct_unit=unit)
+    for i in range(0, len(used), DEDUCT_UPDATE_BATCH):
+        chunk = used[i:i + DEDUCT_UPDATE_BATCH]
+        whens = defaultdict(list)
+        guards = []
+        for a in chunk:
+            pk = a['enrollment'].pk
+            paid_f, gift_f = balance_fields(a['unit'])
+            paid_used = a['paid_before'] - a['paid']
+            gift_used = a['gift_before'] - a['gift']
+            if a['unit'] == 'sessions':
+                paid_used, gift_used = int(paid_used), int(gift_used)
+            if gift_used:
+                # 用到了赠送：拆分依据是读到的付费余额，必须仍是这个值
+                guards.append(Q(pk=pk, **{paid_f: a['paid_before'], f'{gift_f}__gte': gift_used}))
+                whens[gift_f].append(When(pk=pk, then=F(gift_f) - Value(gift_used)))
+            else:
+                guards.append(Q(pk=pk, **{f'{paid_f}__gte': paid_used}))
+            if paid_used:
+                whens[paid_f].append(When(pk=pk, then=F(paid_f) - Value(paid_used)))
+        changes = {
+            f: Case(*w, default=F(f), output_field=Enrollment._meta.get_field(f))
+            for f, w in whens.items()
+        }
+        if Enrollment.objects.filter(reduce(operator.or_, guards)).update(**changes) != len(chunk):
+            raise AttendanceConflict('学生余额已被其他操作修改')
+
+
+def worklog_for(lesson) -> dict:
+    """工时：小班=2小时；其它按时长（四舍五入0.5）"""
+    if lesson.class_group.course_mode == 'small_class':
+        return {'work_hours': D('2.00'), 'rule_code': 'small_class_x2'}
+    return {'work_hours': round_to_half_hours(lesson.duration_minutes), 'rule_code': 'normal'}
+
+
+def _upsert_worklogs(lessons) -> None:
+    """(课次, 任课老师) 工时：已有则更新，缺的批量新建（update_or_create 的批量版）"""
+    wanted = {(les.id, les.teacher_id or les.class_group.teacher_main_id): les for les in lessons}
+    existing = list(TeacherWorklog.objects.filter(lesson_id__in=[les.id for les in lessons]))
+    to_update = []
+    for wl in existing:
+        les = wanted.pop((wl.lesson_id, wl.teacher_id), None)
+        if les is not None:
+            for k, v in worklog_for(les).items():
+                setattr(wl, k, v)
+            to_update.append(wl)
+    if to_update:
+        TeacherWorklog.objects.bulk_update(to_update, ['work_hours', 'rule_code'])
+    TeacherWorklog.objects.bulk_create([
+        TeacherWorklog(lesson_id=lid, teacher_id=tid, **worklog_for(les))
+        for (lid, tid), les in wanted.items()
+    ])
+
+
+def apply_attendance_plan(plan, operator_user) -> dict:
+    """写入一个无错误的计划；返回 {lesson_id: [attendance_id, ...]}"""
+    lesson_ids = list(plan['lessons'])
+    now = timezone.now()
+    with transaction.atomic():
+        # 先锁课次：已被别人提交过的直接冲突
+        locked = (Lesson.objects.filter(id__in=lesson_ids, lock_attendance=False)
+                  .update(status='finished', lock_attendance=True))
+        if locked != len(lesson_ids):
+            raise AttendanceConflict('课次已被其他人提交签到')
+        bump_version(TIMETABLE)  # queryset.update 不触发信号
+
+        _deduct_accounts(plan['accounts'])
+
+        Attendance.objects.bulk_create([
+            Attendance(lesson_id=lid, operator=operator_user, confirmed_at=now, **row)
+            for lid, p in plan['lessons'].items() for row in p['rows']
+        ])
+        _upsert_worklogs([p['lesson'] for p in plan['lessons'].values()])
+
+        ids = defaultdict(list)
+        for lid, aid in (Attendance.objects.filter(lesson_id__in=lesson_ids)
+                         .order_by('id').values_list('lesson_id', 'id')):
+            ids[lid].append(aid)
+    return {lid: ids[lid] for lid in lesson_ids}
+
+
+def commit_attendance(lessons, payloads, operator_user):
+    """
+    计划 + 写入；返回 (errors, attendance_ids)
+    errors 非空时不写任何数据；读后余额被并发修改则重算重试，课次被别人先提交则直接抛 AttendanceConflict
+    """
+    for attempt in range(COMMIT_RETRIES):
+        plan = compute_attendance_plan(lessons, payloads)
+        if plan['errors']:
+            return plan['errors'], {}
+        try:
+            return {}, apply_attendance_plan(plan, operator_user)
+        except AttendanceConflict:
+            if attempt == COMMIT_RETRIES - 1 or Lesson.objects.filter(
+                    id__in=list(plan['lessons']), lock_attendance=True).exists():
+                raise
+
+
+# —— 撤销 ——
+def revert_attendance(lesson_ids) -> dict:
+    """
+    撤销若干已提交课次的签到（单课次撤销与批量撤销共用），一个事务：
+    - 课次条件 UPDATE 解锁（lock_attendance=True 才算），命中数不符说明被别人先撤销 → AttendanceConflict
+    - 出勤按 (学生, 班型, 单位) 一次聚合 paid_used / gift_used，每个账户一条 F() 回补；没有账户的按回补额补建
+    - Attendance / TeacherWorklog 批量删除
+    返回 {'lessons', 'attendances', 'accounts'} 计数
+    """
+    lesson_ids = list(lesson_ids)
+    with transaction.atomic():
+        unlocked = (Lesson.objects.filter(id__in=lesson_ids, lock_attendance=True)
+                    .update(status='scheduled', lock_attendance=False))
+        if unlocked != len(lesson_ids):
+            raise AttendanceConflict('部分课次未提交签到或已被撤销')
+        bump_version(TIMETABLE)  # queryset.update 不触发信号
+
+        # 同一账户的历史出勤可能有不同扣课单位（班型/单位调整过）：按单位分别回补到对应余额字段
+        refunds = {}
+        for r in (Attendance.objects.filter(lesson_id__in=lesson_ids, status='present')
+                  .values('student_id', 'lesson__class_group__course_mode', 'deduct_unit')
+                  .annotate(paid=Sum('paid_used'), gift=Sum('gift_used'))):
+            key = (r['student_id'], r['lesson__class_group__course_mode'], r['deduct_unit'])
+            refunds[key] = (D(r['paid'] or 0), D(r['gift'] or 0))
+
+        found = _load_accounts({(sid, mode): unit for sid, mode, unit in refunds})
+        missing = {}
+        for (sid, mode, unit), (paid, gift) in refunds.items():
+            if not (paid or gift):
+                continue
+            en = found.get((sid, mode))
+            if en is not None:
+                credit_enrollment(en.pk, unit, paid, gift)
+                continue
+            paid_f, gift_f = balance_fields(unit)
+            if unit == 'sessions':
+                paid, gift = int(paid), int(gift)
+            en = missing.setdefault((sid, mode), Enrollment(student_id=sid, course_mode=mode, deduct_unit=unit,
+                                                            status='active'))
+            setattr(en, paid_f, paid)
+            setattr(en, gift_f, gift)
+        if missing:
+            Enrollment.objects.bulk_create(missing.values())
+
+        deleted, _ = Attendance.objects.filter(lesson_id__in=lesson_ids).delete()
+        TeacherWorklog.objects.filter(lesson_id__in=lesson_ids).delete()
+    return {'lessons': len(lesson_ids), 'attendances': deleted,
+            'accounts': len({(sid, mode) for sid, mode, _ in refunds})}
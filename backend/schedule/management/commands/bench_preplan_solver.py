@@ -0,0 +1,91 @@
+# backend/schedule/management/commands/bench_preplan_solver.py
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from schedule.constants import TIME_SLOTS, SMALL_CLASS
+from schedule.preplan import solve_assignment, DEFAULT_MAX_BACKTRACKS
+
+
+def _to_minutes(hhmm: str) -> int:
+    h, m = hhmm.split(':')
+    return int(h) * 60 + int(m)
+
+
+def build_campus(rng, n_slots: int, n_rooms: int, n_teachers: int, n_subjects: int, busy_ratio: float) -> dict:
+    """
+    随机生成一个校区一周的预排数据（结构与 load_solver_input 一致，不读写数据库）
+    - 教室容量混合：1v1 小间 / 1v2 / 小班教室 / 不限
+    - 槽位按模板时间档随机落在周一~周六，约 1/3 为小班
+    - busy_ratio：教室/老师被已有课次占用的比例
+    """
+    capacities = [1, 2, 4, 8, 12, 16, 20, None]
+    rooms = [{'id': i + 1, 'capacity': rng.choice(capacities)} for i in range(n_rooms)]
+
+    teachers_by_subject = {}
+    for t in range(1, n_teachers + 1):
+        teachers_by_subject.setdefault(t % n_subjects + 1, []).append(t)
+
+    slots = []
+    for i in range(n_slots):
+        small = rng.random() < 0.33
+        st, et = rng.choice(TIME_SLOTS[SMALL_CLASS] if small else TIME_SLOTS['non_small'])
+        subject_id = rng.randint(1, n_subjects)
+        demand = rng.randint(4, 16) if small else rng.randint(1, 2)
+        fit_rooms = [r['id'] for r in rooms if r['capacity'] is None or r['capacity'] >= demand]
+        slots.append({
+            'id': i + 1,
+            'class_group_id': i + 1,
+            'subject_id': subject_id,
+            'weekday': rng.randint(1, 6),
+            'start': _to_minutes(st),
+            'end': _to_minutes(et),
+            'demand': demand,
+            'room_id': rng.choice(fit_rooms) if fit_rooms else None,
+            'teacher_id': rng.choice(teachers_by_subject[subject_id]),
+            'fixed_room': rng.random() < 0.05,
+            'fixed_teacher': rng.random() < 0.05,
+        })
+
+    busy = {}
+    for kind, ids in (('room', [r['id'] for r in rooms]), ('teacher', list(range(1, n_teachers + 1)))):
+        for rid in ids:
+            for wd in range(1, 7):
+                for st, et in TIME_SLOTS['non_small']:
+                    if rng.random() < busy_ratio:
+                        busy.setdefault((kind, rid, wd), []).append((_to_minutes(st), _to_minutes(et)))
+    return {'slots': slots, 'rooms': rooms, 'busy': busy, 'teachers_by_subject': teachers_by_subject}
+
+
+class Command(BaseCommand):
+    help = "预排自动分配求解器基准：随机生成若干校区的一周预排，统计求解耗时与未排数量（纯内存，不读写数据库）。"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--campuses', type=int, default=5, help='生成的校区数')
+        parser.add_argument('--slots', type=int, default=300, help='每个校区一周的预排槽位数')
+        parser.add_argument('--rooms', type=int, default=30, help='每个校区的教室数')
+        parser.add_argument('--teachers', type=int, default=60, help='每个校区的老师数')
+        parser.add_argument('--subjects', type=int, default=9, help='科目数')
+        parser.add_argument('--busy', type=float, default=0.1, help='已有课次占用比例（0~1）')
+        parser.add_argument('--max-backtracks', type=int, default=DEFAULT_MAX_BACKTRACKS)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **o):
+        rng = random.Random(o['seed'])
+        timings = []
+        for n in range(1, o['campuses'] + 1):
+            data = build_campus(rng, o['slots'], o['rooms'], o['teachers'], o['subjects'], o['busy'])
+            t0 = time.perf_counter()
+            result = solve_assignment(data['slots'], data['rooms'], data['busy'], data['teachers_by_subject'],
+                                      max_backtracks=o['max_backtracks'])
+            ms = (time.perf_counter() - t0) * 1000
+            timings.append(ms)
+            self.stdout.write(
+                f"[campus {n}] slots={len(data['slots'])} placed={len(result['assignments'])} "
+                f"unplaced={len(result['unplaced'])} backtracks={result['backtracks']} {ms:.1f}ms"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"median={statistics.median(timings):.1f}ms max={max(timings):.1f}ms"
+        ))
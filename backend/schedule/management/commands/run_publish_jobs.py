@@ -0,0 +1,37 @@
+# backend/schedule/management/commands/run_publish_jobs.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from schedule.publishing import claim_next_job, fail_job, run_publish_job
+
+
+class Command(BaseCommand):
+    help = "执行后台周期发布任务（CyclePublishJob）。默认常驻轮询；--once 处理完当前队列即退出。心跳超时的 running 任务会被重新领取并续跑（有次数上限），执行异常的任务判为失败。"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='处理完当前队列后退出（适合 cron）')
+        parser.add_argument('--interval', type=float, default=5.0, help='队列为空时的轮询间隔（秒）')
+
+    def handle(self, *args, **options):
+        once = options['once']
+        interval = options['interval']
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(interval)
+                continue
+            self.stdout.write(f"[job {job.id}] cycle={job.cycle_id} start")
+            try:
+                run_publish_job(job)
+            except Exception as e:
+                # run_publish_job 已自行兜底；这里只防记录失败本身出错时 worker 退出
+                fail_job(job, e)
+                self.stderr.write(self.style.ERROR(f"[job {job.id}] {e}"))
+                continue
+            job.refresh_from_db()
+            self.stdout.write(self.style.SUCCESS(
+                f"[job {job.id}] {job.status} processed={job.processed_pairs}/{job.total_pairs} errors={len(job.errors or [])}"
+            ))
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_lesson_campus(apps, schema_editor):
+    # 生效校区：课次教室的校区，否则回退班级默认教室的校区
+    Lesson = apps.get_model('schedule', 'Lesson')
+    Room = apps.get_model('schedule', 'Room')
+    ClassGroup = apps.get_model('schedule', 'ClassGroup')
+    Lesson.objects.update(campus_id=Coalesce(
+        Subquery(Room.objects.filter(pk=OuterRef('room_id')).values('campus_id')[:1]),
+        Subquery(ClassGroup.objects.filter(pk=OuterRef('class_group_id')).values('room_default__campus_id')[:1]),
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0005_scheduleversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='campus',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='lessons', to='schedule.campus'),
+        ),
+        migrations.AddIndex(
+            model_name='lesson',
+            index=models.Index(fields=['campus', 'date', 'status'], name='edu_lesson_campus__b4b26e_idx'),
+        ),
+        migrations.RunPython(backfill_lesson_campus, migrations.RunPython.noop),
+    ]
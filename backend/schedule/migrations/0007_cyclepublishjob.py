@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:48
+
+import django.db.models.deletion
+import schedule.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0006_lesson_campus'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CyclePublishJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', '排队中'), ('running', '执行中'), ('done', '已完成'), ('failed', '部分失败')], default='queued', max_length=10)),
+                ('scope', models.CharField(default='future_only', max_length=20)),
+                ('mode', models.CharField(default='participants', max_length=20)),
+                ('payload', schedule.models.JSONTextField(default=dict)),
+                ('total_pairs', models.PositiveIntegerField(default=0)),
+                ('processed_pairs', models.PositiveIntegerField(default=0)),
+                ('errors', schedule.models.JSONTextField(default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('cycle', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='publish_jobs', to='schedule.cycle')),
+                ('log', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='schedule.cyclepublishlog')),
+            ],
+            options={
+                'db_table': 'edu_cycle_publish_job',
+                'ordering': ['-id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='edu_cycle_p_status_e01855_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0007_cyclepublishjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cyclepublishjob',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='cyclepublishjob',
+            name='status',
+            field=models.CharField(choices=[('queued', '排队中'), ('running', '执行中'), ('done', '已完成'), ('failed', '失败')], default='queued', max_length=10),
+        ),
+    ]
@@ -249,6 +249,10 @@ class Lesson(models.Model):
     room = models.ForeignKey(Room, on_delete=models.PROTECT, related_name='lessons', null=True, blank=True)
     teacher = models.ForeignKey(User, on_delete=models.PROTECT, related_name='lessons', null=True, blank=True)
 
+    # 冗余：生效校区 = room.campus，否则回退 class_group.room_default.campus
+    # 由 utils.sync_lesson_campus 维护（Lesson/Room/ClassGroup 保存时同步），供周期看板/发布按校区直接过滤
+    campus = models.ForeignKey(Campus, on_delete=models.SET_NULL, related_name='lessons', null=True, blank=True)
+
     status = models.CharField(max_length=10, choices=LESSON_STATUS, default='scheduled')
     lock_attendance = models.BooleanField(default=False)  # 提交后锁定签到
 
@@ -260,6 +264,7 @@ class Lesson(models.Model):
         indexes = [
             models.Index(fields=['date', 'start_time']),
             models.Index(fields=['class_group', 'date']),
+            models.Index(fields=['campus', 'date', 'status']),
         ]
 
     def __str__(self):
@@ -377,6 +382,23 @@ class LessonParticipant(models.Model):
         return f'{self.lesson_id}-{self.student_id}-{self.type}'
 
 
+class ScheduleVersion(models.Model):
+    """
+    变更计数器（按 scope 区分，例如 timetable）
+    - 写操作通过信号 +1；读端把 version 拼进缓存键，旧条目自然失效
+    - 存在数据库中，多 worker 进程共享同一计数
+    """
+    scope = models.CharField(max_length=64, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'edu_schedule_version'
+
+    def __str__(self):
+        return f'{self.scope}@{self.version}'
+
+
 # ================== 新增：排课周期层（与既有逻辑解耦） ==================
 class Cycle(models.Model):
     """排课周期（销售用：一周期=一周；发布时做日期映射）"""
@@ -486,6 +508,41 @@ class CyclePublishItem(models.Model):
             models.Index(fields=['student']),
         ]
 
+
+class CyclePublishJob(models.Model):
+    """后台发布任务（大周期异步执行；进度按 (lesson, student) 对计，worker 崩溃后可续跑）"""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, '排队中'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_DONE, '已完成'),
+        (STATUS_FAILED, '失败'),
+    ]
+
+    cycle = models.ForeignKey(Cycle, on_delete=models.CASCADE, related_name='publish_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    scope = models.CharField(max_length=20, default=CyclePublishLog.SCOPE_FUTURE)
+    mode = models.CharField(max_length=20, default=CyclePublishLog.MODE_PARTICIPANTS)
+    payload = JSONTextField(default=dict)     # {map, tracks}
+    total_pairs = models.PositiveIntegerField(default=0)
+    processed_pairs = models.PositiveIntegerField(default=0)
+    errors = JSONTextField(default=list)      # [{class_group_id, error}]；整体失败时只有 error
+    attempts = models.PositiveIntegerField(default=0)  # 被领取的次数（含超时续跑）
+    log = models.ForeignKey(CyclePublishLog, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'edu_cycle_publish_job'
+        ordering = ['-id']
+        indexes = [models.Index(fields=['status', 'id'])]
+
 class CyclePreplanSlot(models.Model):
     """
     预排槽位：把某个班级放到【周几 × 时间段】的“缓冲池”里。
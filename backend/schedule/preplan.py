@@ -0,0 +1,370 @@
+# backend/schedule/preplan.py
+"""
+预排（CyclePreplanSlot）的教室/老师自动分配
+- load_solver_input：从库里一次性取出槽位、教室、已有课次占用、按科目的可选老师
+- solve_assignment：纯内存求解（不碰数据库，便于基准测试）
+    1) 难排的先排：锁定的在前，其次可用教室少、时长长的
+    2) 每个槽位先定老师（优先原老师），再定教室（优先班级默认教室，其次容量最贴合的）
+    3) 没有空闲资源时做有限回溯：把占用该资源的已排槽位挪到它的其它候选上（仅一层，受 max_backtracks 限制）
+    4) 仍排不下的放进 unplaced，并给出原因
+- apply_assignment：把结果写回 teacher_override / room_override（与班级默认相同则清空）
+- preplan_conflicts：整周期冲突报告（老师/教室/学生），按 (资源, 周几) 排序后一次扫描
+时间统一换算为“当天分钟数”，占用按 (资源类型, 资源id, 周几) 分桶。
+"""
+import time as _time
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, Q
+
+from .models import (
+    ClassEnrollment, ClassGroup, CyclePreplanSlot, CycleRoster, Lesson, Room
+)
+from .versioning import PREPLAN, bump_version
+
+User = get_user_model()
+
+DEFAULT_MAX_BACKTRACKS = 2000
+
+ROOM = 'room'
+TEACHER = 'teacher'
+
+
+def _minutes(t) -> int:
+    return t.hour * 60 + t.minute
+
+
+def _hhmm(m: int) -> str:
+    return f'{m // 60:02d}:{m % 60:02d}'
+
+
+def load_solver_input(cycle, keep_overrides: bool = True) -> dict:
+    """
+    返回 solve_assignment 的入参：
+      slots: [{id, class_group_id, subject_id, weekday, start, end, demand,
+               room_id, teacher_id, fixed_room, fixed_teacher}]
+      rooms: [{id, capacity}]
+      busy:  {(kind, id, weekday): [(start, end), ...]}   # 已有课次（不含本次预排的班级）
+      teachers_by_subject: {subject_id: [teacher_id, ...]}
+    """
+    slots_qs = list(CyclePreplanSlot.objects.filter(cycle=cycle).select_related('class_group'))
+    cg_ids = {s.class_group_id for s in slots_qs}
+
+    # 人数：周期名册与在读名单取大者
+    demand = defaultdict(int)
+    for cg_id, n in (CycleRoster.objects.filter(cycle=cycle, class_group_id__in=cg_ids)
+                     .values('class_group_id').annotate(n=Count('student_id', distinct=True))
+                     .values_list('class_group_id', 'n')):
+        demand[cg_id] = n
+    for cg_id, n in (ClassEnrollment.objects.filter(class_group_id__in=cg_ids, left_at__isnull=True)
+                     .values('class_group_id').annotate(n=Count('id'))
+                     .values_list('class_group_id', 'n')):
+        demand[cg_id] = max(demand[cg_id], n)
+
+    rooms = [{'id': r.id, 'capacity': r.capacity}
+             for r in Room.objects.filter(campus_id=cycle.campus_id, is_active=True).only('id', 'capacity')]
+
+    # 按科目的可选老师：历史上带过该科目班级的在职老师
+    subject_ids = {s.class_group.subject_id for s in slots_qs}
+    active_teachers = set(User.objects.filter(is_active=True, role='teacher').values_list('id', flat=True))
+    teachers_by_subject = defaultdict(list)
+    for subject_id, teacher_id in (ClassGroup.objects.filter(subject_id__in=subject_ids)
+                                   .values_list('subject_id', 'teacher_main_id').distinct()
+                                   .order_by('subject_id', 'teacher_main_id')):
+        if teacher_id in active_teachers:
+            teachers_by_subject[subject_id].append(teacher_id)
+    pool = {t for ts in teachers_by_subject.values() for t in ts} | {s.class_group.teacher_main_id for s in slots_qs}
+
+    # 已有课次占用：本校区的教室 + 候选老师（老师跨校区也算占用）
+    busy = defaultdict(list)
+    lessons = (Lesson.objects
+               .filter(date__gte=cycle.date_from, date__lte=cycle.date_to, status='scheduled')
+               .filter(Q(campus_id=cycle.campus_id) | Q(teacher_id__in=pool) | Q(class_group__teacher_main_id__in=pool))
+               .exclude(class_group_id__in=cg_ids)
+               .values_list('date', 'start_time', 'end_time', 'campus_id', 'room_id', 'teacher_id',
+                            'class_group__room_default_id', 'class_group__teacher_main_id'))
+    for d, st, et, campus_id, room_id, teacher_id, room_default_id, teacher_main_id in lessons:
+        wd, span = d.isoweekday(), (_minutes(st), _minutes(et))
+        if campus_id == cycle.campus_id and (room_id or room_default_id):
+            busy[(ROOM, room_id or room_default_id, wd)].append(span)
+        if (teacher_id or teacher_main_id) in pool:
+            busy[(TEACHER, teacher_id or teacher_main_id, wd)].append(span)
+
+    slots = []
+    for s in slots_qs:
+        cg = s.class_group
+        slots.append({
+            'id': s.id,
+            'class_group_id': cg.id,
+            'subject_id': cg.subject_id,
+            'weekday': s.weekday,
+            'start': _minutes(s.start_time),
+            'end': _minutes(s.end_time),
+            'demand': demand.get(cg.id, 0),
+            'room_id': (s.room_override_id if keep_overrides and s.room_override_id else cg.room_default_id),
+            'teacher_id': (s.teacher_override_id if keep_overrides and s.teacher_override_id else cg.teacher_main_id),
+            'fixed_room': bool(keep_overrides and s.room_override_id),
+            'fixed_teacher': bool(keep_overrides and s.teacher_override_id),
+        })
+    return {'slots': slots, 'rooms': rooms, 'busy': dict(busy), 'teachers_by_subject': dict(teachers_by_subject)}
+
+
+def solve_assignment(slots, rooms, busy=None, teachers_by_subject=None,
+                     max_backtracks: int = DEFAULT_MAX_BACKTRACKS) -> dict:
+    """
+    纯内存求解，入参见 load_solver_input
+    返回 {assignments: {slot_id: {room_id, teacher_id}}, unplaced: [{slot_id, reason}], backtracks}
+    """
+    busy = busy or {}
+    teachers_by_subject = teachers_by_subject or {}
+    by_id = {s['id']: s for s in slots}
+    room_cap = {r['id']: r['capacity'] for r in rooms}
+
+    # 每个槽位的候选（有序）：首选在前
+    def _room_candidates(s):
+        if s['fixed_room']:
+            return [s['room_id']]
+        fits = [r['id'] for r in rooms if r['capacity'] is None or r['capacity'] >= s['demand']]
+        # 容量最贴合的优先（不限容量的放最后），班级默认教室永远第一
+        fits.sort(key=lambda rid: (room_cap[rid] is None, room_cap[rid] or 0, rid))
+        if s['room_id'] in fits:
+            fits.remove(s['room_id'])
+            fits.insert(0, s['room_id'])
+        return fits
+
+    def _teacher_candidates(s):
+        if s['fixed_teacher'] or not s['teacher_id']:
+            return [s['teacher_id']] if s['teacher_id'] else []
+        return [s['teacher_id']] + [t for t in teachers_by_subject.get(s['subject_id'], []) if t != s['teacher_id']]
+
+    cands = {s['id']: {ROOM: _room_candidates(s), TEACHER: _teacher_candidates(s)} for s in slots}
+
+    # 占用：(kind, id, weekday) → [(start, end, slot_id)]；已有课次的 slot_id 为 None
+    occ = defaultdict(list)
+    for key, spans in busy.items():
+        occ[key].extend((st, et, None) for st, et in spans)
+
+    def _blockers(kind, rid, s):
+        return [b for st, et, b in occ[(kind, rid, s['weekday'])] if st < s['end'] and s['start'] < et]
+
+    def _take(kind, rid, s):
+        occ[(kind, rid, s['weekday'])].append((s['start'], s['end'], s['id']))
+
+    def _release(kind, rid, s):
+        lst = occ[(kind, rid, s['weekday'])]
+        for i, item in enumerate(lst):
+            if item[2] == s['id']:
+                del lst[i]
+                return
+
+    assign = {}
+    state = {'backtracks': 0}
+
+    def _relocate(kind, rid, s):
+        """有限回溯：把 rid 上与 s 冲突的已排槽位挪到各自的其它候选；全部挪开才生效"""
+        blockers = _blockers(kind, rid, s)
+        if not blockers or any(b is None or by_id[b]['fixed_' + kind] for b in blockers):
+            return False
+        if state['backtracks'] >= max_backtracks:
+            return False
+        state['backtracks'] += 1
+
+        moved = []
+        for b in dict.fromkeys(blockers):
+            bs = by_id[b]
+            _release(kind, rid, bs)
+            alt = next((c for c in cands[b][kind] if c != rid and not _blockers(kind, c, bs)), None)
+            if alt is None:
+                _take(kind, rid, bs)
+                for mb, old, new in moved:  # 回滚
+                    _release(kind, new, by_id[mb])
+                    _take(kind, old, by_id[mb])
+                    assign[mb][kind] = old
+                return False
+            _take(kind, alt, bs)
+            assign[b][kind] = alt
+            moved.append((b, rid, alt))
+        return True
+
+    def _pick(kind, s):
+        options = cands[s['id']][kind]
+        for c in options:
+            if not _blockers(kind, c, s):
+                return c
+        for c in options:
+            if _relocate(kind, c, s):
+                return c
+        return None
+
+    order = sorted(slots, key=lambda s: (
+        not (s['fixed_room'] or s['fixed_teacher']),
+        len(cands[s['id']][ROOM]),
+        -(s['end'] - s['start']),
+        s['weekday'], s['start'], s['id'],
+    ))
+
+    unplaced = []
+    for s in order:
+        if not cands[s['id']][TEACHER]:
+            unplaced.append({'slot_id': s['id'], 'reason': 'no_teacher'})
+            continue
+        if not cands[s['id']][ROOM]:
+            unplaced.append({'slot_id': s['id'], 'reason': 'no_room_with_capacity'})
+            continue
+        assign[s['id']] = {ROOM: None, TEACHER: None}
+        teacher = _pick(TEACHER, s)
+        if teacher is None:
+            del assign[s['id']]
+            unplaced.append({'slot_id': s['id'], 'reason': 'teacher_busy'})
+            continue
+        _take(TEACHER, teacher, s)
+        assign[s['id']][TEACHER] = teacher
+        room = _pick(ROOM, s)
+        if room is None:
+            _release(TEACHER, teacher, s)
+            del assign[s['id']]
+            unplaced.append({'slot_id': s['id'], 'reason': 'room_busy'})
+            continue
+        _take(ROOM, room, s)
+        assign[s['id']][ROOM] = room
+
+    return {
+        'assignments': {sid: {'room_id': a[ROOM], 'teacher_id': a[TEACHER]} for sid, a in assign.items()},
+        'unplaced': unplaced,
+        'backtracks': state['backtracks'],
+    }
+
+
+def solve_cycle(cycle, keep_overrides: bool = True, max_backtracks: int = DEFAULT_MAX_BACKTRACKS) -> dict:
+    """读库 + 求解，返回接口结构"""
+    data = load_solver_input(cycle, keep_overrides=keep_overrides)
+    t0 = _time.perf_counter()
+    result = solve_assignment(data['slots'], data['rooms'], data['busy'], data['teachers_by_subject'],
+                              max_backtracks=max_backtracks)
+    elapsed_ms = round((_time.perf_counter() - t0) * 1000, 1)
+
+    by_id = {s['id']: s for s in data['slots']}
+
+    def _slot_info(s):
+        return {'slot_id': s['id'], 'class_group_id': s['class_group_id'], 'weekday': s['weekday'],
+                'start_time': _hhmm(s['start']), 'end_time': _hhmm(s['end'])}
+
+    assignments = []
+    for sid, a in sorted(result['assignments'].items()):
+        s = by_id[sid]
+        assignments.append({
+            **_slot_info(s),
+            'room_id': a['room_id'],
+            'teacher_id': a['teacher_id'],
+            'room_changed': a['room_id'] != s['room_id'],
+            'teacher_changed': a['teacher_id'] != s['teacher_id'],
+        })
+    unplaced = [{**_slot_info(by_id[u['slot_id']]), 'reason': u['reason']} for u in result['unplaced']]
+    return {
+        'assignments': assignments,
+        'unplaced': unplaced,
+        'stats': {
+            'slots': len(data['slots']),
+            'placed': len(assignments),
+            'unplaced': len(unplaced),
+            'backtracks': result['backtracks'],
+            'solve_ms': elapsed_ms,
+        },
+    }
+
+
+def apply_assignment(cycle, assignments) -> int:
+    """写回 override；与班级默认一致则置空，返回更新的槽位数"""
+    by_slot = {a['slot_id']: a for a in assignments}
+    slots = list(CyclePreplanSlot.objects.filter(cycle=cycle, id__in=list(by_slot)).select_related('class_group'))
+    for s in slots:
+        a = by_slot[s.id]
+        s.room_override_id = a['room_id'] if a['room_id'] != s.class_group.room_default_id else None
+        s.teacher_override_id = a['teacher_id'] if a['teacher_id'] != s.class_group.teacher_main_id else None
+    CyclePreplanSlot.objects.bulk_update(slots, ['room_override', 'teacher_override'])
+    if slots:
+        bump_version(PREPLAN)  # bulk_update 不触发信号
+    return len(slots)
+
+
+# —— 冲突报告 ——
+def _sweep(intervals):
+    """
+    intervals: [(start, end, slot_id, tag)]，同一资源同一周几
+    排序后扫描，返回重叠对 [(slot_a, slot_b, overlap_start, overlap_end)]
+    tag 为学生的 A/B 轨：两者都有且不同则不算冲突（分轨上课日期不重合）
+    """
+    out = []
+    active = []
+    for st, et, sid, tag in sorted(intervals, key=lambda x: (x[0], x[1], x[2])):  # tag 可能为 None，不参与排序
+        active = [a for a in active if a[1] > st]
+        for ast, aet, asid, atag in active:
+            if asid != sid and (atag is None or tag is None or atag == tag):
+                out.append((min(asid, sid), max(asid, sid), st, min(aet, et)))
+        active.append((st, et, sid, tag))
+    return out
+
+
+def preplan_conflicts(cycle) -> dict:
+    """
+    本周期全部预排槽位的冲突：
+    - teacher / room：有效值 = override 或班级默认
+    - student：按 CycleRoster 名册（同一学生在两个重叠槽位的班级里）
+    同一对槽位的学生冲突合并为一条（student_ids 列表）
+    """
+    slots = list(CyclePreplanSlot.objects.filter(cycle=cycle)
+                 .select_related('class_group')
+                 .only('id', 'weekday', 'start_time', 'end_time', 'teacher_override_id', 'room_override_id',
+                       'class_group__id', 'class_group__teacher_main_id', 'class_group__room_default_id'))
+
+    buckets = defaultdict(list)  # (kind, id, weekday) → intervals
+    cg_slots = defaultdict(list)
+    for s in slots:
+        cg = s.class_group
+        span = (_minutes(s.start_time), _minutes(s.end_time))
+        teacher_id = s.teacher_override_id or cg.teacher_main_id
+        room_id = s.room_override_id or cg.room_default_id
+        if teacher_id:
+            buckets[(TEACHER, teacher_id, s.weekday)].append((*span, s.id, None))
+        if room_id:
+            buckets[(ROOM, room_id, s.weekday)].append((*span, s.id, None))
+        cg_slots[cg.id].append((s.weekday, span, s.id))
+
+    for cg_id, student_id, track in (CycleRoster.objects
+                                     .filter(cycle=cycle, class_group_id__in=list(cg_slots))
+                                     .values_list('class_group_id', 'student_id', 'track')):
+        for wd, span, sid in cg_slots[cg_id]:
+            buckets[('student', student_id, wd)].append((*span, sid, track))
+
+    conflicts = []
+    student_pairs = {}
+    for (kind, rid, wd), intervals in buckets.items():
+        if len(intervals) < 2:
+            continue
+        for a, b, ost, oet in _sweep(intervals):
+            if kind == 'student':
+                item = student_pairs.get((a, b))
+                if item is None:
+                    item = student_pairs[(a, b)] = {
+                        'type': 'student', 'weekday': wd, 'slot_ids': [a, b],
+                        'start_time': _hhmm(ost), 'end_time': _hhmm(oet), 'student_ids': [],
+                    }
+                if rid not in item['student_ids']:
+                    item['student_ids'].append(rid)
+            else:
+                conflicts.append({
+                    'type': kind, 'resource_id': rid, 'weekday': wd, 'slot_ids': [a, b],
+                    'start_time': _hhmm(ost), 'end_time': _hhmm(oet),
+                })
+    conflicts.extend(student_pairs.values())
+    conflicts.sort(key=lambda c: (c['weekday'], c['start_time'], c['type'], c['slot_ids']))
+
+    by_slot = defaultdict(set)
+    for c in conflicts:
+        for sid in c['slot_ids']:
+            by_slot[sid].add(c['type'])
+    return {
+        'conflicts': conflicts,
+        'by_slot': {sid: sorted(types) for sid, types in sorted(by_slot.items())},
+        'counts': {t: sum(1 for c in conflicts if c['type'] == t) for t in (TEACHER, ROOM, 'student')},
+    }
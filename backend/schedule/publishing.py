@@ -0,0 +1,381 @@
+# backend/schedule/publishing.py
+"""
+周期发布：把周期名册（CycleRoster）按日期映射写成 LessonParticipant
+- build_date_maps：解析 map / tracks（按 scope 过滤今天/之后）
+- compute_publish_plan：只读计算目标集与差异（need_add / need_remove）
+- apply_publish_changes：批量写入一组差异
+- 预演计划令牌：dry-run 把差异存进 CyclePublishLog 并签发令牌，执行时令牌指纹未变则直接写入
+- run_publish_job：后台任务，按班级分块、每块一个事务；进度靠 CyclePublishItem 追踪，崩溃后可续跑（最多 JOB_MAX_ATTEMPTS 次）
+CyclePublishView（同步）与 run_publish_jobs 命令（异步）共用这里的逻辑。
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.core import signing
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import (
+    CycleRoster, CyclePublishLog, CyclePublishItem, CyclePublishJob,
+    Lesson, LessonParticipant
+)
+from .versioning import (
+    TIMETABLE, cycle_roster_scope, cycle_publish_scope, get_versions, bump_version, make_etag
+)
+
+WEEKDAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']  # 与前端约定（isoweekday - 1）
+
+JOB_STALE_AFTER = timedelta(minutes=5)  # running 状态超过该时间无心跳，视为 worker 已崩溃，可被重新领取
+JOB_MAX_ATTEMPTS = 3  # 同一任务最多被领取几次；超过仍超时则判失败，避免反复崩溃的任务无限重试
+PLAN_TOKEN_SALT = 'schedule.cycle-publish-plan'
+PLAN_TOKEN_MAX_AGE = 60 * 60 * 2  # 秒；预演后超过该时长需重新预演
+
+
+def expand_cycle_pattern(cycle, start: date, end: date, exclude=()):
+    """
+    按 Cycle.pattern 一次遍历日历，生成 map / tracks（map="auto" 时使用）：
+    - weekly：[start, end] 每天按周几归入 weekday_map
+    - ab_fixed6：上六休一，跳过 rest_weekday；工作日按在一周内的位置固定分 A/B（第 1、3、5 个为 A，第 2、4、6 个为 B），节假日不改变 A/B
+    - ab_custom：跳过 rest_weekday；工作日按先后顺序 A/B 交替，节假日跳过且不占位（之后的 A/B 顺延）
+    exclude：节假日等不上课的日期（date 集合）
+    返回 (weekday_map, tracks_map)；无 track 的名册走 weekday_map（全部工作日）
+    """
+    exclude = set(exclude or ())
+    weekday_map = defaultdict(list)
+    tracks_map = {}
+    ab = cycle.pattern in (cycle.PATTERN_AB_FIXED6, cycle.PATTERN_AB_CUSTOM)
+    if ab:
+        tracks_map = {'A': defaultdict(list), 'B': defaultdict(list)}
+
+    # 周内工作日序号（ab_fixed6 用）：rest_weekday 之外的 6 天依次编号 0..5
+    work_index = {}
+    for wd in range(1, 8):
+        if wd != cycle.rest_weekday:
+            work_index[wd] = len(work_index)
+
+    seq = 0  # ab_custom 的工作日流水号
+    d = start
+    while d <= end:
+        wd = d.isoweekday()
+        name = WEEKDAY_NAMES[wd - 1]
+        if ab and wd == cycle.rest_weekday:
+            d += timedelta(days=1)
+            continue
+        if d in exclude:
+            d += timedelta(days=1)
+            continue
+        weekday_map[name].append(d)
+        if ab:
+            idx = work_index[wd] if cycle.pattern == cycle.PATTERN_AB_FIXED6 else seq
+            tracks_map['A' if idx % 2 == 0 else 'B'][name].append(d)
+            seq += 1
+        d += timedelta(days=1)
+    return weekday_map, tracks_map
+
+
+def _parse_dates(values):
+    out = set()
+    for s in (values or []):
+        try:
+            out.add(date.fromisoformat(s))
+        except (TypeError, ValueError):
+            pass
+    return out
+
+
+def build_date_maps(cycle, scope: str, payload: dict, today=None):
+    """
+    构造 源列(周几)→目标自然日 集合（按 scope 过滤今天/之后）：
+      map:    {"Mon":["2025-10-01"], "Fri":["2025-10-02", ...]} 或 "auto"
+      tracks: {"A": {...}, "B": {...}}  # 可选（暑/寒）；map="auto" 时由 Cycle.pattern 生成
+      exclude: ["2025-10-01", ...]       # map="auto" 时排除的节假日
+      until:   "2025-10-31"               # map="auto" 时展开到哪天（默认且最多到 cycle.date_to）
+    返回 (weekday_map, tracks_map)
+    """
+    today = today or timezone.localdate()
+    lower = cycle.date_from if scope == 'include_today' else max(today, cycle.date_from)
+    map_ = payload.get('map') or {}
+
+    if map_ == 'auto':
+        if scope not in ('include_today', 'future_only'):
+            return defaultdict(list), {}
+        until = _parse_dates([payload.get('until')])
+        until = min(until.pop(), cycle.date_to) if until else cycle.date_to
+        return expand_cycle_pattern(cycle, lower, until, _parse_dates(payload.get('exclude')))
+
+    def _valid_date(s):
+        try:
+            d = date.fromisoformat(s)
+            return d if scope in ('include_today', 'future_only') and d >= lower else None
+        except Exception:
+            return None
+
+    weekday_map = defaultdict(list)
+    for w, arr in map_.items():
+        for s in (arr or []):
+            d = _valid_date(s)
+            if d: weekday_map[w].append(d)
+
+    tracks_map = {}
+    for trk, m in (payload.get('tracks') or {}).items():
+        mm = defaultdict(list)
+        for w, arr in (m or {}).items():
+            for s in (arr or []):
+                d = _valid_date(s)
+                if d: mm[w].append(d)
+        tracks_map[trk] = mm
+    return weekday_map, tracks_map
+
+
+def compute_publish_plan(cycle, weekday_map, tracks_map) -> dict:
+    """
+    只读：计算本次应存在的 (lesson_id, student_id) 集合与现存明细的差异
+    返回 {target, existing_items, need_add, need_remove, missing}
+      target: {(lesson_id, student_id): roster}（同一对取首个命中的 roster，用于反查 type/track）
+    """
+    rosters = list(CycleRoster.objects.filter(cycle=cycle)
+                   .only('id', 'class_group_id', 'student_id', 'type', 'track'))
+
+    # 目标日全集（用于一次性拉 lesson 做匹配）
+    all_target_dates = set()
+    for arr in weekday_map.values(): all_target_dates.update(arr)
+    for mm in tracks_map.values():
+        for arr in mm.values(): all_target_dates.update(arr)
+
+    # 只取本校区的课次（Lesson.campus 冗余字段）
+    lessons = Lesson.objects.filter(
+        campus_id=cycle.campus_id,
+        date__in=list(all_target_dates),
+        status='scheduled'
+    ).only('id', 'class_group_id', 'date')
+
+    # 索引：班级+日期 → lesson 列表（一个日期可能多节不同时间档）
+    by_cg_date = defaultdict(list)
+    for l in lessons:
+        by_cg_date[(l.class_group_id, l.date)].append(l)
+
+    # 现存由本周期发布产生的明细（用于差异删除）
+    existing_items = {(it.lesson_id, it.student_id): it
+                      for it in CyclePublishItem.objects.filter(cycle=cycle).select_related('roster')}
+
+    target, missing = {}, []
+    for r in rosters:
+        # 选择映射表：有 track 用 tracks_map[track]，否则 weekday_map
+        use_map = tracks_map.get(r.track) if r.track in tracks_map else weekday_map
+
+        # 周期的“源列”= 周一~周日。我们以“周几 → 目标自然日”映射，允许 1→多
+        for w, target_dates in use_map.items():
+            for d0 in target_dates:
+                ls = by_cg_date.get((r.class_group_id, d0), [])
+                if not ls:
+                    missing.append({'date': str(d0), 'class_group_id': r.class_group_id})
+                    continue
+                for l in ls:
+                    target.setdefault((l.id, r.student_id), r)
+
+    # 差异：仅针对本周期创建过的明细，不会动手工/其它周期
+    existing_pairs = set(existing_items.keys())
+    return {
+        'target': target,
+        'existing_items': existing_items,
+        'need_add': sorted(target.keys() - existing_pairs),
+        'need_remove': sorted(existing_pairs - target.keys()),
+        'missing': missing,
+    }
+
+
+def apply_publish_changes(cycle, plan: dict, add_pairs, remove_pairs, user):
+    """批量写入一组差异；调用方负责事务。返回 (added, removed)"""
+    target, existing_items = plan['target'], plan['existing_items']
+    added, removed = [], []
+
+    # 新增：participant 已存在（手工/其它来源）则复用，缺的批量创建
+    if add_pairs:
+        def _load_participants():
+            return {(lp.lesson_id, lp.student_id): lp.id for lp in LessonParticipant.objects.filter(
+                lesson_id__in={l for l, _ in add_pairs}, student_id__in={s for _, s in add_pairs}
+            ).only('id', 'lesson_id', 'student_id')}
+
+        lp_ids = _load_participants()
+        new_lps = []
+        for pair in add_pairs:
+            if pair in lp_ids:
+                continue
+            r = target[pair]
+            new_lps.append(LessonParticipant(
+                lesson_id=pair[0], student_id=pair[1], created_by=user,
+                type=(LessonParticipant.TYPE_TRIAL if r.type == CycleRoster.TYPE_TRIAL
+                      else LessonParticipant.TYPE_TEMP),
+            ))
+        if new_lps:
+            LessonParticipant.objects.bulk_create(new_lps)
+            lp_ids = _load_participants()  # 不依赖 bulk_create 回填主键（MySQL 不支持）
+
+        # 记录发布明细
+        CyclePublishItem.objects.bulk_create([
+            CyclePublishItem(
+                cycle=cycle, roster=target[pair], lesson_id=pair[0], student_id=pair[1],
+                participant_id=lp_ids.get(pair), type=target[pair].type, track=target[pair].track,
+            )
+            for pair in add_pairs
+        ])
+        added = [{'lesson_id': l, 'student_id': s} for l, s in add_pairs]
+
+    # 删除（只删本周期生成的明细及其 participant）
+    remove_items = [existing_items[pair] for pair in remove_pairs]
+    if remove_items:
+        CyclePublishItem.objects.filter(id__in=[it.id for it in remove_items]).delete()
+        LessonParticipant.objects.filter(
+            id__in=[it.participant_id for it in remove_items if it.participant_id]
+        ).delete()
+        removed = [{'lesson_id': it.lesson_id, 'student_id': it.student_id} for it in remove_items]
+
+    if added or removed:
+        bump_version(cycle_publish_scope(cycle.id))
+    return added, removed
+
+
+# —— 预演计划令牌 ——
+def plan_fingerprint(cycle, scope: str, payload: dict, today=None) -> str:
+    """
+    计划依赖的全部输入：名册版本、课表版本、本周期发布明细版本、周期本身、映射参数、当天日期（future_only 会按今天过滤）
+    任一变化，之前预演出来的差异就不再可信
+    """
+    today = today or timezone.localdate()
+    versions = get_versions(cycle_roster_scope(cycle.id), TIMETABLE, cycle_publish_scope(cycle.id))
+    return make_etag(cycle.id, cycle.updated_at, versions, scope, payload, today)
+
+
+def dump_plan(plan: dict) -> dict:
+    """差异的紧凑存储形态（存 CyclePublishLog.payload['plan']）"""
+    return {
+        'add': [[l, s, plan['target'][(l, s)].id] for l, s in plan['need_add']],
+        'remove': [[l, s, plan['existing_items'][(l, s)].id] for l, s in plan['need_remove']],
+    }
+
+
+def load_plan(stored: dict, cycle) -> dict:
+    """由 dump_plan 的结果还原出 apply_publish_changes 需要的结构（两次按主键查询，不再重算）"""
+    add = [(l, s, rid) for l, s, rid in stored.get('add') or []]
+    remove = [(l, s, iid) for l, s, iid in stored.get('remove') or []]
+    rosters = {r.id: r for r in CycleRoster.objects.filter(
+        cycle=cycle, id__in={rid for _, _, rid in add}).only('id', 'class_group_id', 'student_id', 'type', 'track')}
+    items = {it.id: it for it in CyclePublishItem.objects.filter(
+        cycle=cycle, id__in={iid for _, _, iid in remove}).select_related('roster')}
+    return {
+        'target': {(l, s): rosters[rid] for l, s, rid in add},
+        'existing_items': {(l, s): items[iid] for l, s, iid in remove},
+        'need_add': [(l, s) for l, s, _ in add],
+        'need_remove': [(l, s) for l, s, _ in remove],
+    }
+
+
+def make_plan_token(log, fingerprint: str) -> str:
+    return signing.dumps({'log': log.id, 'fp': fingerprint}, salt=PLAN_TOKEN_SALT, compress=True)
+
+
+def read_plan_token(token: str) -> dict:
+    """校验签名与有效期；失败抛 signing.BadSignature（SignatureExpired 是其子类）"""
+    return signing.loads(token, salt=PLAN_TOKEN_SALT, max_age=PLAN_TOKEN_MAX_AGE)
+
+
+# —— 后台任务 ——
+def claim_next_job():
+    """
+    领取一个待执行任务（queued，或心跳超时的 running）；用条件 UPDATE 防止多个 worker 抢同一个
+    超时任务已领取满 JOB_MAX_ATTEMPTS 次的，直接判失败，不再领取
+    """
+    now = timezone.now()
+    candidates = (CyclePublishJob.objects
+                  .filter(status__in=[CyclePublishJob.STATUS_QUEUED, CyclePublishJob.STATUS_RUNNING])
+                  .order_by('id')
+                  .values_list('id', 'status', 'heartbeat_at', 'attempts'))
+    for job_id, status, heartbeat_at, attempts in candidates:
+        if status == CyclePublishJob.STATUS_RUNNING and heartbeat_at and heartbeat_at > now - JOB_STALE_AFTER:
+            continue
+        same_state = CyclePublishJob.objects.filter(id=job_id, status=status, heartbeat_at=heartbeat_at)
+        if attempts >= JOB_MAX_ATTEMPTS:
+            same_state.update(status=CyclePublishJob.STATUS_FAILED, finished_at=now,
+                              errors=[{'error': f'worker 已中断 {attempts} 次，不再重试'}])
+            continue
+        changes = {'status': CyclePublishJob.STATUS_RUNNING, 'heartbeat_at': now, 'attempts': F('attempts') + 1}
+        if status == CyclePublishJob.STATUS_QUEUED:
+            changes['started_at'] = now  # 续跑超时任务时保留最初的开始时间
+        if same_state.update(**changes):
+            return CyclePublishJob.objects.select_related('cycle', 'created_by').get(id=job_id)
+    return None
+
+
+def fail_job(job, error) -> None:
+    """整体失败（计算差异、写日志等分块之外的异常）：记下错误并结束任务，不再被重新领取"""
+    job.status = CyclePublishJob.STATUS_FAILED
+    job.errors = [*(job.errors or []), {'error': str(error)}]  # 保留本次已记下的分块错误
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'errors', 'finished_at'])
+
+
+def _group_by_class_group(plan: dict):
+    """按班级分块：{class_group_id: ([add_pairs], [remove_pairs])}"""
+    chunks = defaultdict(lambda: ([], []))
+    for pair in plan['need_add']:
+        chunks[plan['target'][pair].class_group_id][0].append(pair)
+    for pair in plan['need_remove']:
+        chunks[plan['existing_items'][pair].roster.class_group_id][1].append(pair)
+    return chunks
+
+
+def run_publish_job(job) -> None:
+    """
+    执行/续跑一个发布任务：
+    - 每次（含崩溃后重启）都重新计算差异；已写入的明细在 CyclePublishItem 中，自然不会重复
+    - 按班级分块，每块一个短事务；单块失败记入 errors 并继续下一块
+    - errors 只反映本次执行：上次失败的班级差异仍在，会被重试，成功即不再报错
+    - 分块之外的异常（如计算差异失败）整体判失败，见 fail_job
+    """
+    job.errors = []
+    try:
+        _run_publish_job(job)
+    except Exception as e:
+        fail_job(job, e)
+
+
+def _run_publish_job(job) -> None:
+    cycle = job.cycle
+    payload = job.payload or {}
+    weekday_map, tracks_map = build_date_maps(cycle, job.scope, payload)
+    plan = compute_publish_plan(cycle, weekday_map, tracks_map)
+
+    remaining = len(plan['need_add']) + len(plan['need_remove'])
+    if not job.total_pairs:
+        job.total_pairs = remaining
+    job.processed_pairs = max(0, job.total_pairs - remaining)
+    job.save(update_fields=['total_pairs', 'processed_pairs', 'errors'])
+
+    added_n = removed_n = 0
+    errors = []
+    for cg_id, (add_pairs, remove_pairs) in sorted(_group_by_class_group(plan).items()):
+        try:
+            with transaction.atomic():
+                added, removed = apply_publish_changes(cycle, plan, add_pairs, remove_pairs, job.created_by)
+        except Exception as e:  # 单个班级失败不影响其它班级
+            errors.append({'class_group_id': cg_id, 'error': str(e)})
+            job.errors = errors
+            job.heartbeat_at = timezone.now()
+            job.save(update_fields=['errors', 'heartbeat_at'])
+            continue
+        added_n += len(added)
+        removed_n += len(removed)
+        job.processed_pairs += len(added) + len(removed)
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=['processed_pairs', 'heartbeat_at'])
+
+    stats = {'add': added_n, 'remove': removed_n, 'missing_lessons': plan['missing'], 'job_id': job.id}
+    log = CyclePublishLog.objects.create(
+        cycle=cycle, scope=job.scope, mode=job.mode, payload=payload,
+        diff_stats=stats, published_by=job.created_by
+    )
+    job.log = log
+    job.status = CyclePublishJob.STATUS_FAILED if errors else CyclePublishJob.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.save(update_fields=['log', 'status', 'finished_at'])
@@ -1,4 +1,3 @@
-from datetime import timedelta, date, datetime
 from decimal import Decimal
 from typing import List
 
@@ -12,8 +11,10 @@ from .models import (
     Lesson, ClassEnrollment, LessonLeave, Attendance, TeacherWorklog,
     LessonParticipant
 )
-from .utils import days_to_mask, mask_to_days, find_teacher_or_room_conflicts, get_student_deduct, \
-    capacity_default, capacity_max, check_balance_sufficient, apply_deduction, revert_deduction, dt_combine
+from .utils import days_to_mask, mask_to_days, get_student_deduct, \
+    capacity_default, capacity_max, check_balance_sufficient, apply_deduction, revert_deduction, dt_combine, \
+    expand_weekly_occurrences, expand_custom_occurrences, find_bulk_teacher_or_room_conflicts
+from .versioning import TIMETABLE, bump_version
 
 User = get_user_model()
 
@@ -99,7 +100,16 @@ class ClassGroupCreateIn(serializers.Serializer):
             room = Room.objects.get(id=validated_data['room_default_id'])
         teacher = User.objects.get(id=validated_data['teacher_main_id'])
 
+        occurrences = self._expand_occurrences(term)
+
         with transaction.atomic():
+            # 整体展开规则 → 一次性批量查冲突（全部冲突一起返回）；在事务内查，避免并发创建同时通过校验
+            conflicts = find_bulk_teacher_or_room_conflicts(
+                teacher_id=teacher.id, room_id=(room.id if room else None), occurrences=occurrences
+            )
+            if conflicts:
+                raise serializers.ValidationError({'conflicts': conflicts})
+
             cg = ClassGroup.objects.create(
                 term=term,
                 course_mode=validated_data['course_mode'],
@@ -110,59 +120,69 @@ class ClassGroupCreateIn(serializers.Serializer):
                 name=validated_data.get('name') or '',
                 capacity=validated_data.get('capacity'),
             )
-            # 生成规则与课次
+            # 保存规则
             if validated_data['rule_type'] == 'weekly':
                 w = self.validated_data['weekly']  # ✅ 已经是 python 对象
-                rule = ScheduleRule.objects.create(
+                ScheduleRule.objects.create(
                     class_group=cg, type='weekly',
                     weekly_days_mask=days_to_mask(w['days']),
                     weekly_start_time=w['start_time'],
                     weekly_duration=w['duration_minutes'],
                 )
-                # 在 Term 范围内展开
-                self._generate_weekly_lessons(cg, rule, term)
             else:
                 rule = ScheduleRule.objects.create(class_group=cg, type='custom')
-                # 保存子项并生成课次（均为 python 对象）
-                for e in self.validated_data['custom']:  # ✅ 不再用 initial_data
-                    ce = ScheduleCustomEntry.objects.create(
-                        rule=rule, date=e['date'], start_time=e['start_time'],
-                        duration_minutes=e['duration_minutes']
-                    )
-                    self._create_lesson_or_raise(cg, ce.date, ce.start_time, e['duration_minutes'])
+                ScheduleCustomEntry.objects.bulk_create([
+                    ScheduleCustomEntry(rule=rule, date=e['date'], start_time=e['start_time'],
+                                        duration_minutes=e['duration_minutes'])
+                    for e in self.validated_data['custom']  # ✅ 不再用 initial_data
+                ])
+
+            # 批量生成课次
+            Lesson.objects.bulk_create([
+                Lesson(class_group=cg, date=o['date'],
+                       start_time=o['start_time'], end_time=o['end_time'],
+                       duration_minutes=o['duration_minutes'],
+                       room=room, teacher=teacher, status='scheduled',
+                       campus_id=(room.campus_id if room else None))
+                for o in occurrences
+            ])
+            bump_version(TIMETABLE)  # bulk_create 不触发信号
 
         return cg
 
-    def _generate_weekly_lessons(self, cg: ClassGroup, rule: ScheduleRule, term: Term):
-        days = set(mask_to_days(rule.weekly_days_mask or 0))
-        if not days:
-            raise serializers.ValidationError('weekly 规则的天数无效')
-
-        d = term.start_date
-        while d <= term.end_date:
-            # Django: isoweekday: 周一=1 ... 周日=7
-            if d.isoweekday() in days:
-                self._create_lesson_or_raise(cg, d, rule.weekly_start_time, rule.weekly_duration)
-            d += timedelta(days=1)
-
-    def _create_lesson_or_raise(self, cg: ClassGroup, the_date, start_time, duration_minutes: int):
-        # 计算结束时间（start_time 确保为 datetime.time）
-        end_time = (datetime.combine(date.today(), start_time) + timedelta(minutes=duration_minutes)).time()
-
-        # 老师/教室冲突（阻塞）
-        conflicts = find_teacher_or_room_conflicts(
-            teacher_id=cg.teacher_main_id,
-            room_id=cg.room_default_id,
-            the_date=the_date, start_time=start_time, end_time=end_time
-        )
-        if conflicts:
-            raise serializers.ValidationError({'conflicts': conflicts})
-
-        Lesson.objects.create(
-            class_group=cg, date=the_date,
-            start_time=start_time, end_time=end_time, duration_minutes=duration_minutes,
-            room=cg.room_default, teacher=cg.teacher_main, status='scheduled'
+    def preview(self):
+        """
+        预览：展开规则并批量查老师/教室冲突，不写库、不开事务
+        返回 {lessons: [...], conflicts: [...], lesson_count, conflict_count}
+        """
+        v = self.validated_data
+        term = Term.objects.filter(id=v['term_id']).first()
+        if not term:
+            raise serializers.ValidationError({'term_id': '学期不存在'})
+
+        occurrences = self._expand_occurrences(term)
+        conflicts = find_bulk_teacher_or_room_conflicts(
+            teacher_id=v['teacher_main_id'], room_id=v.get('room_default_id'), occurrences=occurrences
         )
+        hit = {(c['date'], c['start_time']) for c in conflicts}
+        lessons = []
+        for o in occurrences:
+            d, st = str(o['date']), str(o['start_time'])
+            lessons.append({'date': d, 'start_time': st, 'end_time': str(o['end_time']),
+                            'duration': o['duration_minutes'], 'has_conflict': (d, st) in hit})
+        return {'lessons': lessons, 'conflicts': conflicts,
+                'lesson_count': len(lessons), 'conflict_count': len(conflicts)}
+
+    def _expand_occurrences(self, term: Term):
+        """把规则展开为候选课次（weekly 在 Term 范围内展开）"""
+        if self.validated_data['rule_type'] == 'weekly':
+            w = self.validated_data['weekly']
+            days = mask_to_days(days_to_mask(w['days']))
+            if not days:
+                raise serializers.ValidationError('weekly 规则的天数无效')
+            return expand_weekly_occurrences(days, w['start_time'], w['duration_minutes'],
+                                             term.start_date, term.end_date)
+        return expand_custom_occurrences(self.validated_data['custom'])
 
 
 class ClassGroupOut(serializers.ModelSerializer):
@@ -200,6 +220,8 @@ class LessonsQuery(serializers.Serializer):
     grades = serializers.ListField(child=serializers.IntegerField(), required=False)
     teachers = serializers.ListField(child=serializers.IntegerField(), required=False)
     subjects = serializers.ListField(child=serializers.IntegerField(), required=False)
+    # full（默认）：每节课带完整名册；normalized：课次 + class_groups 映射
+    shape = serializers.ChoiceField(choices=['full', 'normalized'], required=False, default='full')
 
     def validate(self, attrs):
         if attrs['date_from'] > attrs['date_to']:
@@ -223,6 +245,39 @@ class AttendanceCommitIn(serializers.Serializer):
     all_present = serializers.BooleanField(required=False, default=False)  # 一键签到（除已请假者）
     items = serializers.ListField(child=AttendanceItem(), required=False)
 
+MAX_BULK_ATTENDANCE_LESSONS = 200
+
+class AttendanceBulkLessonIn(AttendanceCommitIn):
+    lesson_id = serializers.IntegerField()
+
+class AttendanceBulkCommitIn(serializers.Serializer):
+    lessons = serializers.ListField(child=AttendanceBulkLessonIn(), allow_empty=False,
+                                    max_length=MAX_BULK_ATTENDANCE_LESSONS)
+
+    def validate_lessons(self, value):
+        ids = [it['lesson_id'] for it in value]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError('同一课次不能重复提交')
+        return value
+
+MAX_BULK_REVERT_LESSONS = 500
+
+class AttendanceBulkRevertIn(serializers.Serializer):
+    """批量撤销范围：lesson_ids / class_group_id（可加日期）/ 日期区间（可加校区），至少给一种"""
+    lesson_ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+    class_group_id = serializers.IntegerField(required=False)
+    campus_id = serializers.IntegerField(required=False)
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+
+    def validate(self, attrs):
+        if not (attrs.get('lesson_ids') or attrs.get('class_group_id')):
+            if not (attrs.get('date_from') and attrs.get('date_to')):
+                raise serializers.ValidationError('需提供 lesson_ids、class_group_id 或完整的 date_from/date_to')
+        if attrs.get('date_from') and attrs.get('date_to') and attrs['date_from'] > attrs['date_to']:
+            raise serializers.ValidationError('date_from 不能晚于 date_to')
+        return attrs
+
 class AttendanceOut(serializers.ModelSerializer):
     student_name = serializers.CharField(source='student.name', read_only=True)
     class Meta:
@@ -0,0 +1,66 @@
+# backend/schedule/signals.py
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from students.models import Student
+
+from .models import (
+    Lesson, ClassEnrollment, LessonLeave, ClassGroup, Room, Subject,
+    CycleRoster, CyclePreplanSlot
+)
+from .utils import sync_lesson_campus
+from .versioning import TIMETABLE, PREPLAN, cycle_roster_scope, bump_version
+
+
+@receiver([post_save, post_delete], sender=Lesson)
+@receiver([post_save, post_delete], sender=ClassEnrollment)
+@receiver([post_save, post_delete], sender=LessonLeave)
+@receiver([post_save, post_delete], sender=ClassGroup)
+@receiver([post_save, post_delete], sender=Room)     # 课表里展示教室名
+@receiver([post_save, post_delete], sender=Subject)  # 课表里展示科目名
+def bump_timetable_version(sender, **kwargs):
+    # 注意：bulk_create / queryset.update 不触发信号，调用方需自行 bump_version(TIMETABLE)
+    bump_version(TIMETABLE)
+
+
+# 课表缓存 / 课次与看板 ETag 里带学生姓名、老师姓名：改名同样要失效
+NAME_FIELDS = {'name', 'username'}
+
+
+@receiver(post_save, sender=Student)
+@receiver(post_save, sender=get_user_model())
+def bump_timetable_on_rename(sender, instance, created=False, update_fields=None, **kwargs):
+    # 新建的学生/用户还不在任何课表里；只更新其它字段（如登录写 last_login）的不影响展示
+    if created or (update_fields is not None and not NAME_FIELDS & set(update_fields)):
+        return
+    bump_version(TIMETABLE)
+
+
+# —— Lesson.campus 冗余同步 ——
+@receiver(post_save, sender=Lesson)
+def sync_campus_on_lesson_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'room', 'class_group'} & set(update_fields):
+        sync_lesson_campus(Lesson.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Room)
+def sync_campus_on_room_save(sender, instance, **kwargs):
+    sync_lesson_campus(Lesson.objects.filter(Q(room_id=instance.pk) | Q(class_group__room_default_id=instance.pk)))
+
+
+@receiver(post_save, sender=ClassGroup)
+def sync_campus_on_class_group_save(sender, instance, created=False, **kwargs):
+    if not created:
+        sync_lesson_campus(Lesson.objects.filter(class_group_id=instance.pk))
+
+
+@receiver([post_save, post_delete], sender=CycleRoster)
+def bump_cycle_roster_version(sender, instance, **kwargs):
+    bump_version(cycle_roster_scope(instance.cycle_id))
+
+
+@receiver([post_save, post_delete], sender=CyclePreplanSlot)
+def bump_preplan_version(sender, **kwargs):
+    bump_version(PREPLAN)
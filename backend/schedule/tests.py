@@ -1,3 +1,1228 @@
-from django.test import TestCase
+import datetime as dt
+import io
+import json
+import multiprocessing
+from collections import defaultdict
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from academics.models import Enrollment
+from students.models import School, Student
+from . import publishing
+from .attendance import AttendanceConflict, apply_attendance_plan, compute_attendance_plan
+from .serializers import MAX_BULK_ATTENDANCE_LESSONS
+from .timetable import expand_lesson, iter_lesson_lines
+from .preplan import ROOM, TEACHER, preplan_conflicts, solve_assignment, solve_cycle
+from .models import (
+    Term, Subject, Room, Campus, ClassGroup, ClassEnrollment, Lesson, Cycle, CycleRoster,
+    CyclePublishJob, CyclePublishItem, CyclePreplanSlot, LessonLeave, Attendance, TeacherWorklog, ScheduleRule,
+    LessonParticipant,
+)
+from .versioning import TIMETABLE, get_version
+
+from .utils import (
+    apply_deduction, deduct_enrollment, revert_deduction,
+    expand_weekly_occurrences, expand_custom_occurrences, find_bulk_teacher_or_room_conflicts,
+    find_students_conflicts,
+)
+
+D = Decimal
+User = get_user_model()
+
+
+class ScheduleFixtureMixin:
+    """排课类测试的公共数据：学期/科目/教室/老师/学校 + 建班、建课次的快捷方法"""
+
+    @classmethod
+    def make_base(cls):
+        cls.admin = User.objects.create(username='admin', role='admin', is_staff=True)
+        cls.teacher = User.objects.create(username='t1', name='王老师', role='teacher')
+        cls.campus = Campus.objects.create(name='本部')
+        cls.term = Term.objects.create(name='暑假', type='summer', year=2025,
+                                       start_date=dt.date(2025, 7, 1), end_date=dt.date(2025, 8, 31))
+        cls.subject = Subject.objects.create(name='数学')
+        cls.room = Room.objects.create(name='R1', campus=cls.campus)
+        cls.school = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+
+    @classmethod
+    def make_students(cls, n, prefix='学生'):
+        return [Student.objects.create(name=f'{prefix}{i}', grade=8, school=cls.school, visit_channel='walk_in')
+                for i in range(n)]
+
+    @classmethod
+    def make_class(cls, students, course_mode='small_class', teacher=None):
+        cg = ClassGroup.objects.create(term=cls.term, course_mode=course_mode, grade=8, subject=cls.subject,
+                                       room_default=cls.room, teacher_main=teacher or cls.teacher)
+        for s in students:
+            ClassEnrollment.objects.create(student=s, class_group=cg)
+        return cg
+
+    @classmethod
+    def make_lesson(cls, cg, day=dt.date(2025, 7, 2), start=dt.time(9), minutes=120, teacher=None):
+        end = (dt.datetime.combine(day, start) + dt.timedelta(minutes=minutes)).time()
+        return Lesson.objects.create(class_group=cg, date=day, start_time=start, end_time=end,
+                                     duration_minutes=minutes, room=cls.room, teacher=teacher or cls.teacher)
+
+    def client_for(self, user):
+        c = APIClient()
+        c.force_authenticate(user)
+        return c
+
+
+def _deduct_worker(args):
+    """子进程：连续扣课 rounds 次，返回 (付费合计, 赠送合计, 余额不足次数)"""
+    student_id, course_mode, unit, qty, rounds = args
+    connections.close_all()  # 不复用父进程的连接
+    paid = gift = D('0')
+    failed = 0
+    for _ in range(rounds):
+        try:
+            p, g, _src = apply_deduction(student_id, course_mode, unit, qty)
+        except ValueError:
+            failed += 1
+            continue
+        paid += p
+        gift += g
+    connections.close_all()
+    return str(paid), str(gift), failed
+
+
+def _credit_worker(args):
+    """子进程：连续回补（撤销消课）rounds 次"""
+    student_id, course_mode, unit, qty, rounds = args
+    connections.close_all()
+    for _ in range(rounds):
+        revert_deduction(student_id, course_mode, unit, qty, D('0'))
+    connections.close_all()
+    return rounds
+
+
+class ConcurrentDeductionTests(TransactionTestCase):
+    """多进程同时对同一账户扣课/回补：余额守恒、不丢更新、不扣成负数"""
+
+    workers = 4
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # settings 默认给测试库配了文件名；只有被改回内存库时才跳过
+            self.skipTest('内存测试库无法被多个进程共享')
+        try:
+            self.ctx = multiprocessing.get_context('fork')
+        except ValueError:
+            self.skipTest('当前平台不支持 fork')
+        school = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+        self.student = Student.objects.create(name='并发', grade=8, school=school, visit_channel='walk_in')
+
+    def _account(self, **balances):
+        return Enrollment.objects.create(student=self.student, course_mode='one_to_one',
+                                         deduct_unit='hours', status='active', **balances)
+
+    def _run(self, jobs):
+        connections.close_all()  # fork 前关闭连接，子进程各自重连
+        with self.ctx.Pool(len(jobs)) as pool:
+            results = [pool.apply_async(fn, (args,)) for fn, args in jobs]
+            return [r.get(timeout=120) for r in results]
+
+    def test_paid_then_gift_never_overdrawn(self):
+        en = self._account(remaining_hours=D('30'), remaining_hours_gift=D('10'))
+        args = (self.student.id, 'one_to_one', 'hours', D('1.00'), 15)
+        results = self._run([(_deduct_worker, args)] * self.workers)
+
+        paid = sum(D(p) for p, _, _ in results)
+        gift = sum(D(g) for _, g, _ in results)
+        failed = sum(f for _, _, f in results)
+        en.refresh_from_db()
+        self.assertEqual((paid, gift, failed), (D('30'), D('10'), self.workers * 15 - 40))
+        self.assertEqual((en.remaining_hours, en.remaining_hours_gift), (D('0'), D('0')))
+
+    def test_concurrent_deduct_and_credit_conserve_balance(self):
+        en = self._account(remaining_hours=D('20'), remaining_hours_gift=D('5'))
+        deduct = (self.student.id, 'one_to_one', 'hours', D('1.50'), 10)
+        credit = (self.student.id, 'one_to_one', 'hours', D('1.00'), 10)
+        results = self._run([(_deduct_worker, deduct), (_deduct_worker, deduct),
+                             (_credit_worker, credit), (_credit_worker, credit)])
+
+        paid = sum(D(r[0]) for r in results[:2])
+        gift = sum(D(r[1]) for r in results[:2])
+        en.refresh_from_db()
+        self.assertEqual(en.remaining_hours, D('20') + D('20') - paid)
+        self.assertEqual(en.remaining_hours_gift, D('5') - gift)
+        self.assertGreaterEqual(en.remaining_hours, 0)
+        self.assertGreaterEqual(en.remaining_hours_gift, 0)
+
+
+class DeductEnrollmentTests(TestCase):
+    """单账户扣减的拆分：先付费后赠送，余额不足不改动"""
+
+    @classmethod
+    def setUpTestData(cls):
+        school = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+        cls.student = Student.objects.create(name='扣课', grade=8, school=school, visit_channel='walk_in')
+
+    def _account(self, **balances):
+        return Enrollment.objects.create(student=self.student, course_mode='one_to_one',
+                                         deduct_unit='hours', status='active', **balances)
+
+    def test_paid_first_then_gift(self):
+        en = self._account(remaining_hours=D('3'), remaining_hours_gift=D('2'))
+        self.assertEqual(deduct_enrollment(en.id, 'hours', D('2')), (D('2'), D('0')))
+        self.assertEqual(deduct_enrollment(en.id, 'hours', D('1.5')), (D('1'), D('0.5')))
+        self.assertEqual(deduct_enrollment(en.id, 'hours', D('1.5')), (D('0'), D('1.5')))
+        en.refresh_from_db()
+        self.assertEqual((en.remaining_hours, en.remaining_hours_gift), (D('0'), D('0')))
+
+    def test_insufficient_balance_leaves_account_untouched(self):
+        en = self._account(remaining_hours=D('1'), remaining_hours_gift=D('0.5'))
+        with self.assertRaises(ValueError):
+            deduct_enrollment(en.id, 'hours', D('2'))
+        en.refresh_from_db()
+        self.assertEqual((en.remaining_hours, en.remaining_hours_gift), (D('1'), D('0.5')))
+
+    def test_missing_account(self):
+        with self.assertRaisesMessage(ValueError, '账户不存在'):
+            deduct_enrollment(999999, 'hours', D('1'))
+
+    def test_read_back_without_update_returning(self):
+        en = self._account(remaining_hours=D('1'), remaining_hours_gift=D('2'))
+        with mock.patch('schedule.utils._update_returning_supported', return_value=False):
+            self.assertEqual(deduct_enrollment(en.id, 'hours', D('1.5')), (D('1'), D('0.5')))
+            with self.assertRaisesMessage(ValueError, '余额不足'):
+                deduct_enrollment(en.id, 'hours', D('2'))
+        en.refresh_from_db()
+        self.assertEqual((en.remaining_hours, en.remaining_hours_gift), (D('0'), D('1.5')))
+
+    def test_sessions_unit(self):
+        en = Enrollment.objects.create(student=self.student, course_mode='small_class', deduct_unit='sessions',
+                                       status='active', remaining_sessions=1, remaining_sessions_gift=1)
+        self.assertEqual(deduct_enrollment(en.id, 'sessions', D('1')), (D('1'), D('0')))
+        self.assertEqual(deduct_enrollment(en.id, 'sessions', D('1')), (D('0'), D('1')))
+        en.refresh_from_db()
+        self.assertEqual((en.remaining_sessions, en.remaining_sessions_gift), (0, 0))
+
+
+class TimetableRenameTests(ScheduleFixtureMixin, TestCase):
+    """课表缓存与 ETag 带学生/老师姓名：改名后必须失效"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.student = cls.make_students(1)[0]
+        cls.lesson = cls.make_lesson(cls.make_class([cls.student]))
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(self.admin)
+
+    def _lessons(self, **headers):
+        return self.client.get('/api/schedule/lessons', {
+            'term_id': self.term.id, 'date_from': '2025-07-01', 'date_to': '2025-07-07',
+        }, **headers)
+
+    def test_student_rename_refreshes_cached_timetable(self):
+        row = self._lessons().json()['data'][0]
+        self.assertEqual([s['name'] for s in row['roster']], ['学生0'])
+        self.student.name = '改名'
+        self.student.save()
+        row = self._lessons().json()['data'][0]
+        self.assertEqual([s['name'] for s in row['roster']], ['改名'])
+
+    def test_teacher_rename_refreshes_cached_timetable(self):
+        self.assertEqual(self._lessons().json()['data'][0]['teacher'], '王老师')
+        self.teacher.name = '李老师'
+        self.teacher.save(update_fields=['name'])
+        self.assertEqual(self._lessons().json()['data'][0]['teacher'], '李老师')
+
+    def test_unrelated_user_update_keeps_version(self):
+        etag = self._lessons()['ETag']
+        self.teacher.last_login = dt.datetime(2025, 7, 1, tzinfo=dt.timezone.utc)
+        self.teacher.save(update_fields=['last_login'])
+        self.assertEqual(self._lessons(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class ScheduleETagRenameTests(ScheduleFixtureMixin, TestCase):
+    """LessonsView / CycleBoardView 的 ETag：改名后不能再回 304"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.student = cls.make_students(1)[0]
+        cls.make_lesson(cls.make_class([cls.student]))
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(self.admin)
+
+    def _lessons(self, **headers):
+        return self.client.get('/api/schedule/lessons', {
+            'term_id': self.term.id, 'date_from': '2025-07-01', 'date_to': '2025-07-07',
+        }, **headers)
+
+    def _board(self, **headers):
+        return self.client.get(f'/api/schedule/cycle-schedule/cycles/{self.cycle.id}/board', **headers)
+
+    def test_lessons_etag_changes_on_student_rename(self):
+        etag = self._lessons()['ETag']
+        self.assertEqual(self._lessons(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.student.name = '改名'
+        self.student.save()
+        resp = self._lessons(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+
+    def test_board_etag_changes_on_teacher_rename(self):
+        resp = self._board()
+        self.assertEqual(resp.status_code, 200)
+        etag = resp['ETag']
+        self.assertEqual(self._board(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.teacher.username = 'wang'
+        self.teacher.save()
+        resp = self._board(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('wang', str(resp.json()))
+
+
+class PublishJobTests(ScheduleFixtureMixin, TestCase):
+    """后台发布任务：领取、超时续跑、状态只反映本次执行"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+        students = cls.make_students(2)
+        cls.groups = []
+        for _ in range(2):
+            cg = cls.make_class([])
+            cls.make_lesson(cg, day=dt.date(2025, 7, 2))  # 周三
+            for stu in students:
+                CycleRoster.objects.create(cycle=cls.cycle, class_group=cg, student=stu)
+            cls.groups.append(cg)
+
+    def _job(self, **kw):
+        return CyclePublishJob.objects.create(cycle=self.cycle, scope='include_today', created_by=self.admin,
+                                              payload={'map': {'Wed': ['2025-07-02']}}, **kw)
+
+    def test_claim_queued_job_once(self):
+        job = self._job()
+        claimed = publishing.claim_next_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, CyclePublishJob.STATUS_RUNNING)
+        self.assertIsNotNone(claimed.started_at)
+        # 心跳新鲜的 running 任务不会被再次领取
+        self.assertIsNone(publishing.claim_next_job())
+
+    def test_reclaim_stale_job_keeps_started_at(self):
+        started = timezone.now() - dt.timedelta(hours=1)
+        job = self._job(status=CyclePublishJob.STATUS_RUNNING, started_at=started,
+                        heartbeat_at=timezone.now() - publishing.JOB_STALE_AFTER - dt.timedelta(minutes=1))
+        claimed = publishing.claim_next_job()
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.started_at, started)
+        self.assertGreater(claimed.heartbeat_at, started)
+
+    def test_failed_class_group_marks_job_failed_then_resume_succeeds(self):
+        job = self._job()
+        bad_group = self.groups[0].id
+        real_apply = publishing.apply_publish_changes
+
+        def flaky_apply(cycle, plan, add_pairs, remove_pairs, user):
+            if plan['target'][add_pairs[0]].class_group_id == bad_group:
+                raise RuntimeError('boom')
+            return real_apply(cycle, plan, add_pairs, remove_pairs, user)
+
+        with mock.patch.object(publishing, 'apply_publish_changes', flaky_apply):
+            publishing.run_publish_job(publishing.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, CyclePublishJob.STATUS_FAILED)
+        self.assertEqual([e['class_group_id'] for e in job.errors], [bad_group])
+        self.assertEqual(CyclePublishItem.objects.filter(cycle=self.cycle).count(), 2)
+
+        # 续跑：上次失败的班级这次成功 → 任务完成，不再带旧错误
+        job.status = CyclePublishJob.STATUS_RUNNING
+        job.save(update_fields=['status'])
+        publishing.run_publish_job(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, CyclePublishJob.STATUS_DONE)
+        self.assertEqual(job.errors, [])
+        self.assertEqual(job.processed_pairs, job.total_pairs)
+        self.assertEqual(CyclePublishItem.objects.filter(cycle=self.cycle).count(), 4)
+
+    def test_claim_counts_attempts(self):
+        job = self._job(status=CyclePublishJob.STATUS_RUNNING, attempts=1,
+                        heartbeat_at=timezone.now() - publishing.JOB_STALE_AFTER - dt.timedelta(minutes=1))
+        self.assertEqual(publishing.claim_next_job().attempts, 2)
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 2)
+
+    def test_stale_job_over_attempt_cap_is_failed_not_reclaimed(self):
+        job = self._job(status=CyclePublishJob.STATUS_RUNNING, attempts=publishing.JOB_MAX_ATTEMPTS,
+                        heartbeat_at=timezone.now() - publishing.JOB_STALE_AFTER - dt.timedelta(minutes=1))
+        self.assertIsNone(publishing.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, CyclePublishJob.STATUS_FAILED)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(len(job.errors), 1)
+
+    def test_plan_error_fails_job_with_message(self):
+        job = self._job()
+        with mock.patch.object(publishing, 'compute_publish_plan', side_effect=RuntimeError('plan boom')):
+            publishing.run_publish_job(publishing.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, CyclePublishJob.STATUS_FAILED)
+        self.assertEqual(job.errors, [{'error': 'plan boom'}])
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(publishing.claim_next_job())  # 失败任务不会被再次领取
+        self.assertFalse(CyclePublishItem.objects.filter(cycle=self.cycle).exists())
+
+    def test_command_marks_failed_job_and_keeps_draining(self):
+        first, second = self._job(), self._job()
+        real_compute = publishing.compute_publish_plan
+        calls = []
+
+        def compute_once_broken(*args):
+            calls.append(1)
+            if len(calls) == 1:
+                raise RuntimeError('plan boom')
+            return real_compute(*args)
+
+        with mock.patch.object(publishing, 'compute_publish_plan', compute_once_broken):
+            call_command('run_publish_jobs', '--once', stdout=io.StringIO(), stderr=io.StringIO())
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.status, second.status), (CyclePublishJob.STATUS_FAILED, CyclePublishJob.STATUS_DONE))
+        self.assertEqual(CyclePublishItem.objects.filter(cycle=self.cycle).count(), 4)
+
+    def test_auto_map_until_clamped_to_cycle_end(self):
+        weekday_map, _ = publishing.build_date_maps(self.cycle, 'include_today', {'map': 'auto', 'until': '2025-12-31'})
+        days = [d for arr in weekday_map.values() for d in arr]
+        self.assertEqual(max(days), self.cycle.date_to)
+        self.assertEqual(len(days), 7)
+
+
+class PreplanConflictTests(ScheduleFixtureMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+
+    def _slot(self, cg, start, end):
+        return CyclePreplanSlot.objects.create(cycle=self.cycle, class_group=cg, weekday=1,
+                                               start_time=start, end_time=end)
+
+    def test_mixed_none_and_track_roster_does_not_crash(self):
+        (stu,) = self.make_students(1)
+        cg1, cg2 = self.make_class([]), self.make_class([])
+        s1 = self._slot(cg1, dt.time(9), dt.time(11))
+        s2 = self._slot(cg2, dt.time(10), dt.time(12))
+        # 同一学生同一班既有不分轨名册又有 A 轨名册：排序遇到 (start, end, slot) 全相同的区间
+        CycleRoster.objects.create(cycle=self.cycle, class_group=cg1, student=stu, track=None)
+        CycleRoster.objects.create(cycle=self.cycle, class_group=cg1, student=stu, track='A')
+        CycleRoster.objects.create(cycle=self.cycle, class_group=cg2, student=stu, track='B')
+
+        result = preplan_conflicts(self.cycle)
+        student_conflicts = [c for c in result['conflicts'] if c['type'] == 'student']
+        # 不分轨那条名册与 B 轨重叠 → 冲突；A 与 B 不算
+        self.assertEqual(len(student_conflicts), 1)
+        self.assertEqual(student_conflicts[0]['slot_ids'], sorted([s1.id, s2.id]))
+        self.assertEqual(student_conflicts[0]['student_ids'], [stu.id])
+
+
+def _solver_slot(sid, start, end, room_id, teacher_id, weekday=1, demand=10, subject_id=1, **kw):
+    return {'id': sid, 'class_group_id': sid, 'subject_id': subject_id, 'weekday': weekday,
+            'start': start * 60, 'end': end * 60, 'demand': demand, 'room_id': room_id, 'teacher_id': teacher_id,
+            'fixed_room': False, 'fixed_teacher': False, **kw}
+
+
+class PreplanSolverTests(TestCase):
+    """solve_assignment：纯内存求解（时间以整点小时给出）"""
+
+    ROOMS = [{'id': 1, 'capacity': 12}, {'id': 2, 'capacity': 30}, {'id': 3, 'capacity': None}]
+
+    def assertValid(self, slots, rooms, result, busy=None):
+        """不超容量；同一老师/教室同一天的已排槽位之间、以及与已有课次之间都不重叠"""
+        by_id = {s['id']: s for s in slots}
+        cap = {r['id']: r['capacity'] for r in rooms}
+        spans = defaultdict(list)
+        for key, lst in (busy or {}).items():
+            spans[key].extend(lst)
+        for sid, a in result['assignments'].items():
+            s = by_id[sid]
+            self.assertTrue(cap[a['room_id']] is None or cap[a['room_id']] >= s['demand'], (sid, a))
+            spans[(ROOM, a['room_id'], s['weekday'])].append((s['start'], s['end']))
+            spans[(TEACHER, a['teacher_id'], s['weekday'])].append((s['start'], s['end']))
+        for key, lst in spans.items():
+            lst.sort()
+            for (_, prev_end), (start, _) in zip(lst, lst[1:]):
+                self.assertLessEqual(prev_end, start, key)
+        placed = set(result['assignments']) | {u['slot_id'] for u in result['unplaced']}
+        self.assertEqual(placed, set(by_id))
+
+    def test_room_capacity(self):
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=100, demand=20),
+                 _solver_slot(2, 13, 15, room_id=1, teacher_id=100, demand=8)]
+        result = solve_assignment(slots, self.ROOMS)
+        self.assertValid(slots, self.ROOMS, result)
+        self.assertEqual(result['assignments'][1]['room_id'], 2)  # 默认教室装不下 → 容量最贴合的
+        self.assertEqual(result['assignments'][2]['room_id'], 1)
+
+    def test_no_room_with_capacity(self):
+        rooms = [{'id': 1, 'capacity': 12}]
+        result = solve_assignment([_solver_slot(1, 9, 11, room_id=1, teacher_id=100, demand=20)], rooms)
+        self.assertEqual(result['assignments'], {})
+        self.assertEqual(result['unplaced'], [{'slot_id': 1, 'reason': 'no_room_with_capacity'}])
+
+    def test_overlapping_slots_get_distinct_teacher_and_room(self):
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=100),
+                 _solver_slot(2, 10, 12, room_id=1, teacher_id=100),
+                 _solver_slot(3, 10, 12, room_id=1, teacher_id=100, weekday=2)]  # 别的周几不冲突
+        result = solve_assignment(slots, self.ROOMS, teachers_by_subject={1: [100, 200]})
+        self.assertValid(slots, self.ROOMS, result)
+        a = result['assignments']
+        self.assertEqual({a[1]['teacher_id'], a[2]['teacher_id']}, {100, 200})
+        self.assertNotEqual(a[1]['room_id'], a[2]['room_id'])
+        self.assertEqual(a[3], {'room_id': 1, 'teacher_id': 100})
+
+    def test_busy_teacher_and_room_from_existing_lessons(self):
+        busy = {(ROOM, 1, 1): [(9 * 60, 10 * 60)], (TEACHER, 100, 1): [(10 * 60, 11 * 60)]}
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=100)]
+        result = solve_assignment(slots, self.ROOMS, busy, teachers_by_subject={1: [100, 200]})
+        self.assertValid(slots, self.ROOMS, result, busy)
+        self.assertEqual(result['assignments'][1], {'room_id': 2, 'teacher_id': 200})
+
+    def test_unplaced_reasons(self):
+        rooms = [{'id': 1, 'capacity': None}]
+        busy = {(ROOM, 1, 1): [(14 * 60, 16 * 60)]}
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=None),
+                 _solver_slot(2, 9, 11, room_id=1, teacher_id=100, fixed_teacher=True),
+                 _solver_slot(3, 10, 12, room_id=1, teacher_id=100, fixed_teacher=True),
+                 _solver_slot(4, 14, 15, room_id=1, teacher_id=300)]
+        result = solve_assignment(slots, rooms, busy)
+        self.assertValid(slots, rooms, result, busy)
+        self.assertEqual(set(result['assignments']), {2})
+        self.assertEqual(sorted((u['slot_id'], u['reason']) for u in result['unplaced']),
+                         [(1, 'no_teacher'), (3, 'teacher_busy'), (4, 'room_busy')])
+
+    def test_backtracking_moves_placed_slot(self):
+        # 槽位 1 锁定老师 → 先排，占了默认教室 1；槽位 2 人多只能进教室 1 → 回溯把 1 挪到教室 2
+        rooms = [{'id': 1, 'capacity': 30}, {'id': 2, 'capacity': 10}]
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=100, demand=5, fixed_teacher=True),
+                 _solver_slot(2, 9, 11, room_id=1, teacher_id=200, demand=20)]
+        result = solve_assignment(slots, rooms)
+        self.assertValid(slots, rooms, result)
+        self.assertEqual(result['backtracks'], 1)
+        self.assertEqual(result['assignments'][1]['room_id'], 2)
+        self.assertEqual(result['assignments'][2]['room_id'], 1)
+
+        capped = solve_assignment(slots, rooms, max_backtracks=0)
+        self.assertEqual(capped['unplaced'], [{'slot_id': 2, 'reason': 'room_busy'}])
+
+    def test_fixed_room_blocker_is_not_moved(self):
+        rooms = [{'id': 1, 'capacity': 30}, {'id': 2, 'capacity': 10}]
+        slots = [_solver_slot(1, 9, 11, room_id=1, teacher_id=100, demand=5, fixed_room=True),
+                 _solver_slot(2, 9, 11, room_id=1, teacher_id=200, demand=20)]
+        result = solve_assignment(slots, rooms)
+        self.assertEqual(result['assignments'][1]['room_id'], 1)
+        self.assertEqual(result['unplaced'], [{'slot_id': 2, 'reason': 'room_busy'}])
+
+
+class PreplanSolveCycleTests(ScheduleFixtureMixin, TestCase):
+    """solve_cycle：读库后避开已有课次，人数取名册与在读名单的较大者"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+        cls.teacher2 = User.objects.create(username='t2', name='李老师', role='teacher')
+        cls.small = Room.objects.create(name='R2', campus=cls.campus, capacity=3)
+        cls.big = Room.objects.create(name='R3', campus=cls.campus, capacity=20)
+        # 已有课次：周三 9~11 点，老师 t1、教室 R1
+        cls.make_lesson(cls.make_class([]), day=dt.date(2025, 7, 2))
+        cls.make_class([], teacher=cls.teacher2)  # t2 带过数学 → 可作为候选老师
+
+    def _slot(self, cg, weekday=3, start=dt.time(10), end=dt.time(12)):
+        return CyclePreplanSlot.objects.create(cycle=self.cycle, class_group=cg, weekday=weekday,
+                                               start_time=start, end_time=end)
+
+    def test_avoids_existing_lessons_and_small_rooms(self):
+        cg = self.make_class(self.make_students(5))
+        slot = self._slot(cg)
+        result = solve_cycle(self.cycle)
+        self.assertEqual(result['unplaced'], [])
+        (a,) = result['assignments']
+        self.assertEqual((a['slot_id'], a['teacher_id'], a['room_id']), (slot.id, self.teacher2.id, self.big.id))
+        self.assertTrue(a['teacher_changed'] and a['room_changed'])
+
+    def test_slots_in_the_same_cycle_do_not_double_book(self):
+        slots = [self._slot(self.make_class([]), weekday=1) for _ in range(4)]
+        result = solve_cycle(self.cycle)
+        # 3 间教室、2 位老师：只能排 2 个，其余以老师不足报出
+        placed = result['assignments']
+        self.assertEqual(len(placed), 2)
+        self.assertEqual(len({a['teacher_id'] for a in placed}), 2)
+        self.assertEqual(len({a['room_id'] for a in placed}), 2)
+        self.assertEqual([u['reason'] for u in result['unplaced']], ['teacher_busy'] * 2)
+        self.assertEqual({u['slot_id'] for u in result['unplaced']} | {a['slot_id'] for a in placed},
+                         {s.id for s in slots})
+        self.assertEqual(result['stats']['unplaced'], 2)
+
+
+class AttendanceFixtureMixin(ScheduleFixtureMixin):
+    """签到类测试：课次都在过去（已下课），账户按需创建"""
+
+    @classmethod
+    def make_account(cls, student, course_mode='small_class', **balances):
+        unit = 'sessions' if course_mode == 'small_class' else 'hours'
+        return Enrollment.objects.create(student=student, course_mode=course_mode, deduct_unit=unit,
+                                         status='active', **balances)
+
+    def commit(self, les, body=None, user=None):
+        return self.client_for(user or self.admin).post(f'/api/schedule/lessons/{les.id}/attendance',
+                                                        body or {'all_present': True}, format='json')
+
+
+class AttendancePipelineTests(AttendanceFixtureMixin, TestCase):
+    """单课次提交签到：余额预检、请假、工时、课次加锁"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.s_paid, cls.s_gift, cls.s_none = cls.make_students(3)
+        cls.acc_paid = cls.make_account(cls.s_paid, remaining_sessions=2)
+        cls.acc_gift = cls.make_account(cls.s_gift, remaining_sessions_gift=1)
+        cls.cg = cls.make_class([cls.s_paid, cls.s_gift, cls.s_none])
+        cls.les = cls.make_lesson(cls.cg)
+
+    def test_insufficient_balance_blocks_the_lesson(self):
+        resp = self.commit(self.les)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['data']['insufficient'], [self.s_none.id])
+        self.les.refresh_from_db()
+        self.assertFalse(self.les.lock_attendance)
+        self.assertFalse(Attendance.objects.filter(lesson=self.les).exists())
+        self.acc_paid.refresh_from_db()
+        self.assertEqual(self.acc_paid.remaining_sessions, 2)
+
+    def test_leave_is_recorded_without_deduction(self):
+        LessonLeave.objects.create(lesson=self.les, student=self.s_none)
+        resp = self.commit(self.les)
+        self.assertEqual(resp.status_code, 200, resp.content)
+
+        rows = {a.student_id: a for a in Attendance.objects.filter(lesson=self.les)}
+        self.assertEqual(rows[self.s_none.id].status, 'leave')
+        self.assertIsNone(rows[self.s_none.id].paid_used)
+        self.assertEqual((rows[self.s_paid.id].deduct_from, rows[self.s_paid.id].paid_used), ('paid', D('1.00')))
+        self.assertEqual((rows[self.s_gift.id].deduct_from, rows[self.s_gift.id].gift_used), ('gift', D('1.00')))
+        self.acc_paid.refresh_from_db()
+        self.acc_gift.refresh_from_db()
+        self.assertEqual((self.acc_paid.remaining_sessions, self.acc_gift.remaining_sessions_gift), (1, 0))
+
+    def test_items_override_all_present(self):
+        resp = self.commit(self.les, {'all_present': True, 'items': [{'student_id': self.s_none.id, 'status': 'absent'}]})
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(Attendance.objects.get(lesson=self.les, student=self.s_none).status, 'absent')
+
+    def test_worklog_hours(self):
+        LessonLeave.objects.create(lesson=self.les, student=self.s_none)
+        self.assertEqual(self.commit(self.les).status_code, 200)
+        wl = TeacherWorklog.objects.get(lesson=self.les)
+        self.assertEqual((wl.teacher_id, wl.work_hours, wl.rule_code), (self.teacher.id, D('2.00'), 'small_class_x2'))
+
+        # 一对一：按时长四舍五入到 0.5 小时，学生同样扣 1.5 小时；课次指定老师优先于班级主讲
+        other = User.objects.create(username='t2', name='李老师', role='teacher')
+        (stu,) = self.make_students(1, prefix='一对一')
+        acc = self.make_account(stu, 'one_to_one', remaining_hours=D('10'))
+        les = self.make_lesson(self.make_class([stu], 'one_to_one'), minutes=95, teacher=other)
+        self.assertEqual(self.commit(les).status_code, 200)
+        wl = TeacherWorklog.objects.get(lesson=les)
+        self.assertEqual((wl.teacher_id, wl.work_hours, wl.rule_code), (other.id, D('1.50'), 'normal'))
+        acc.refresh_from_db()
+        self.assertEqual(acc.remaining_hours, D('8.5'))
+
+    def test_lesson_is_locked_after_commit(self):
+        LessonLeave.objects.create(lesson=self.les, student=self.s_none)
+        plan = compute_attendance_plan([self.les], {self.les.id: {'all_present': True}})
+        self.assertEqual(self.commit(self.les).status_code, 200)
+        self.les.refresh_from_db()
+        self.assertEqual((self.les.status, self.les.lock_attendance), ('finished', True))
+
+        resp = self.commit(self.les)
+        self.assertEqual(resp.status_code, 400)
+        # 读到旧状态的并发提交：课次条件 UPDATE 命中 0 行 → 冲突，整体回滚，不会重复扣课
+        with self.assertRaises(AttendanceConflict):
+            apply_attendance_plan(plan, self.admin)
+        self.acc_paid.refresh_from_db()
+        self.assertEqual(self.acc_paid.remaining_sessions, 1)
+        self.assertEqual(Attendance.objects.filter(lesson=self.les).count(), 3)
+
+    def test_concurrent_commit_after_precheck_is_409(self):
+        LessonLeave.objects.create(lesson=self.les, student=self.s_none)
+        Enrollment.objects.filter(id=self.acc_gift.id).update(remaining_sessions_gift=2)  # 余额预检两次都能过
+        self.assertEqual(self.commit(self.les).status_code, 200)
+        # 预检读到的是未提交状态，写入时课次已被别人锁定
+        with mock.patch('schedule.views.attendance_commit_gate', return_value=None):
+            resp = self.commit(self.les)
+        self.assertEqual(resp.status_code, 409, resp.content)
+        self.assertEqual(resp.json()['message'], '课次已被其他人提交签到')
+        self.assertEqual(Attendance.objects.filter(lesson=self.les).count(), 3)
+
+
+class AttendanceBulkCommitTests(AttendanceFixtureMixin, TestCase):
+    """多课次提交：任一课次不通过则整批不写"""
+
+    url = '/api/schedule/lessons/attendance/bulk'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.other_teacher = User.objects.create(username='t2', name='李老师', role='teacher')
+        cls.stu, = cls.make_students(1)
+        cls.acc = cls.make_account(cls.stu, remaining_sessions=1)
+        cls.mine = cls.make_class([cls.stu])
+        cls.theirs = cls.make_class([cls.stu], teacher=cls.other_teacher)
+        cls.les1 = cls.make_lesson(cls.mine, day=dt.date(2025, 7, 2))
+        cls.les2 = cls.make_lesson(cls.mine, day=dt.date(2025, 7, 3))
+        cls.les_other = cls.make_lesson(cls.theirs, day=dt.date(2025, 7, 4), teacher=cls.other_teacher)
+
+    def _post(self, lessons, user=None):
+        body = {'lessons': [{'lesson_id': les.id, 'all_present': True} for les in lessons]}
+        return self.client_for(user or self.admin).post(self.url, body, format='json')
+
+    def assertNothingWritten(self):
+        self.assertFalse(Attendance.objects.exists())
+        self.assertFalse(TeacherWorklog.objects.exists())
+        self.assertFalse(Lesson.objects.filter(lock_attendance=True).exists())
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.remaining_sessions, 1)
+
+    def test_partial_permission_failure_rejects_batch(self):
+        resp = self._post([self.les1, self.les_other], user=self.teacher)
+        self.assertEqual(resp.status_code, 400)
+        results = {r['lesson_id']: r for r in resp.json()['data']['results']}
+        self.assertFalse(results[self.les1.id]['ok'])
+        self.assertEqual(results[self.les1.id]['message'], '同批其它课次未通过校验，未提交')
+        self.assertTrue(results[self.les_other.id]['message'].startswith('无权限'))
+        self.assertNothingWritten()
+
+    def test_balance_is_accumulated_across_lessons(self):
+        # 只够 1 节：第二节（按上课先后）余额不足 → 整批回滚
+        resp = self._post([self.les2, self.les1])
+        self.assertEqual(resp.status_code, 400)
+        results = {r['lesson_id']: r for r in resp.json()['data']['results']}
+        self.assertEqual(results[self.les2.id]['insufficient'], [self.stu.id])
+        self.assertNotIn('insufficient', results[self.les1.id])
+        self.assertNothingWritten()
+
+    def test_whole_batch_committed(self):
+        self.acc.remaining_sessions = 3
+        self.acc.save()
+        resp = self._post([self.les1, self.les2, self.les_other])
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertTrue(all(r['ok'] for r in resp.json()['data']['results']))
+        self.assertEqual(Lesson.objects.filter(lock_attendance=True).count(), 3)
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.remaining_sessions, 0)
+
+    def test_conflict_rolls_back_everything(self):
+        # 校验通过后写入时才发现课次已被提交（并发）：账户扣减、出勤、工时一起回滚
+        Enrollment.objects.filter(id=self.acc.id).update(remaining_sessions=3)
+        Lesson.objects.filter(id=self.les2.id).update(lock_attendance=True)
+        with mock.patch('schedule.views.attendance_commit_gate', return_value=None):
+            resp = self._post([self.les1, self.les2])
+        self.assertEqual(resp.status_code, 409)
+        self.assertFalse(Attendance.objects.exists())
+        self.assertFalse(TeacherWorklog.objects.exists())
+        self.assertEqual(list(Lesson.objects.filter(lock_attendance=True).values_list('id', flat=True)), [self.les2.id])
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.remaining_sessions, 3)
+
+    def test_lesson_cap(self):
+        body = {'lessons': [{'lesson_id': i, 'all_present': True} for i in range(1, MAX_BULK_ATTENDANCE_LESSONS + 2)]}
+        resp = self.client_for(self.admin).post(self.url, body, format='json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('lessons', str(resp.json()))
+        # 上限以内不会被数量校验拦下（课次不存在按单课次报错）
+        body['lessons'] = body['lessons'][:MAX_BULK_ATTENDANCE_LESSONS]
+        resp = self.client_for(self.admin).post(self.url, body, format='json')
+        self.assertEqual(len(resp.json()['data']['results']), MAX_BULK_ATTENDANCE_LESSONS)
+
+
+class AttendanceRevertTests(AttendanceFixtureMixin, TestCase):
+    """撤销消课：按账户与扣课单位回补"""
+
+    url = '/api/schedule/lessons/attendance/revert/bulk'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.stu, cls.newcomer = cls.make_students(2)
+        cls.acc = cls.make_account(cls.stu, remaining_sessions=5, remaining_hours=D('0'))
+        cls.cg = cls.make_class([cls.stu, cls.newcomer])
+        cls.les1 = cls.make_lesson(cls.cg, day=dt.date(2025, 7, 2))
+        cls.les2 = cls.make_lesson(cls.cg, day=dt.date(2025, 7, 3))
+
+    def _submitted(self, les, student, unit, paid, gift):
+        """直接造已提交的出勤（历史数据里同一账户可能有不同扣课单位）"""
+        Lesson.objects.filter(id=les.id).update(status='finished', lock_attendance=True)
+        Attendance.objects.create(lesson=les, student=student, status='present', deduct_unit=unit,
+                                  deduct_qty=paid + gift, paid_used=paid, gift_used=gift,
+                                  deduct_from='paid' if paid else 'gift')
+
+    def _revert(self, **body):
+        return self.client_for(self.admin).post(self.url, body, format='json')
+
+    def test_mixed_units_are_credited_separately(self):
+        self._submitted(self.les1, self.stu, 'sessions', D('1'), D('0'))
+        self._submitted(self.les2, self.stu, 'hours', D('1.5'), D('0.5'))
+        resp = self._revert(class_group_id=self.cg.id)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()['data']['accounts'], 1)
+        self.acc.refresh_from_db()
+        self.assertEqual((self.acc.remaining_sessions, self.acc.remaining_hours, self.acc.remaining_hours_gift),
+                         (6, D('1.5'), D('0.5')))
+        self.assertFalse(Attendance.objects.exists())
+        self.assertFalse(Lesson.objects.filter(lock_attendance=True).exists())
+
+    def test_missing_account_is_created_with_every_unit(self):
+        self._submitted(self.les1, self.newcomer, 'sessions', D('0'), D('1'))
+        self._submitted(self.les2, self.newcomer, 'hours', D('2'), D('0'))
+        self.assertEqual(self._revert(lesson_ids=[self.les1.id, self.les2.id]).status_code, 200)
+        en = Enrollment.objects.get(student=self.newcomer)
+        self.assertEqual((en.remaining_sessions_gift, en.remaining_hours), (1, D('2')))
+
+    def test_commit_then_revert_restores_balance(self):
+        LessonLeave.objects.create(lesson=self.les1, student=self.newcomer)
+        self.assertEqual(self.commit(self.les1).status_code, 200)
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.remaining_sessions, 4)
+        self.assertEqual(self._revert(lesson_ids=[self.les1.id]).status_code, 200)
+        self.acc.refresh_from_db()
+        self.assertEqual(self.acc.remaining_sessions, 5)
+        self.assertFalse(TeacherWorklog.objects.exists())
+
+
+class ClassGroupCreateConflictTests(ScheduleFixtureMixin, TestCase):
+    """建班：规则展开 + 一次查询的老师/教室/自身冲突检测"""
+
+    url = '/api/schedule/class-groups'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.other_teacher = User.objects.create(username='t2', name='李老师', role='teacher')
+        cls.room2 = Room.objects.create(name='R2', campus=cls.campus)
+
+    def _existing(self, day, start, end, teacher, room, status='scheduled'):
+        cg = ClassGroup.objects.create(term=self.term, course_mode='small_class', grade=8, subject=self.subject,
+                                       room_default=room, teacher_main=teacher)
+        return Lesson.objects.create(class_group=cg, date=day, start_time=start, end_time=end, teacher=teacher,
+                                     room=room, duration_minutes=120, status=status)
+
+    def _body(self, **rule):
+        body = {'term_id': self.term.id, 'course_mode': 'small_class', 'grade': 8, 'subject_id': self.subject.id,
+                'room_default_id': self.room.id, 'teacher_main_id': self.teacher.id}
+        body.update(rule)
+        return body
+
+    def test_weekly_expansion_crosses_week_and_month(self):
+        occ = expand_weekly_occurrences([7, 1], dt.time(9), 90, dt.date(2025, 7, 27), dt.date(2025, 8, 4))
+        self.assertEqual([o['date'] for o in occ],
+                         [dt.date(2025, 7, 27), dt.date(2025, 7, 28), dt.date(2025, 8, 3), dt.date(2025, 8, 4)])
+        self.assertTrue(all(o['end_time'] == dt.time(10, 30) and o['duration_minutes'] == 90 for o in occ))
+        # 首尾两天都包含；区间内没有匹配的周几则为空
+        self.assertEqual(len(expand_weekly_occurrences([3], dt.time(9), 60, dt.date(2025, 7, 2), dt.date(2025, 7, 2))), 1)
+        self.assertEqual(expand_weekly_occurrences([3], dt.time(9), 60, dt.date(2025, 7, 3), dt.date(2025, 7, 8)), [])
+
+    def test_custom_expansion_is_sorted(self):
+        occ = expand_custom_occurrences([
+            {'date': dt.date(2025, 8, 1), 'start_time': dt.time(9), 'duration_minutes': 60},
+            {'date': dt.date(2025, 7, 31), 'start_time': dt.time(23, 30), 'duration_minutes': 20},
+            {'date': dt.date(2025, 7, 31), 'start_time': dt.time(8), 'duration_minutes': 45},
+        ])
+        self.assertEqual([(o['date'], o['start_time'], o['end_time']) for o in occ], [
+            (dt.date(2025, 7, 31), dt.time(8), dt.time(8, 45)),
+            (dt.date(2025, 7, 31), dt.time(23, 30), dt.time(23, 50)),
+            (dt.date(2025, 8, 1), dt.time(9), dt.time(10)),
+        ])
+
+    def test_teacher_room_and_self_clashes_in_one_query(self):
+        t_clash = self._existing(dt.date(2025, 7, 2), dt.time(9), dt.time(11), self.teacher, self.room2)
+        r_clash = self._existing(dt.date(2025, 7, 3), dt.time(10), dt.time(12), self.other_teacher, self.room)
+        self._existing(dt.date(2025, 7, 5), dt.time(9), dt.time(11), self.teacher, self.room, status='canceled')
+        self._existing(dt.date(2025, 7, 2), dt.time(11), dt.time(12), self.teacher, self.room)  # 首尾相接不算
+        occ = expand_custom_occurrences([
+            {'date': dt.date(2025, 7, 2), 'start_time': dt.time(10), 'duration_minutes': 60},
+            {'date': dt.date(2025, 7, 3), 'start_time': dt.time(9), 'duration_minutes': 90},
+            {'date': dt.date(2025, 7, 4), 'start_time': dt.time(9), 'duration_minutes': 120},
+            {'date': dt.date(2025, 7, 4), 'start_time': dt.time(10), 'duration_minutes': 60},
+            {'date': dt.date(2025, 7, 5), 'start_time': dt.time(9), 'duration_minutes': 60},
+        ])
+        with self.assertNumQueries(1):
+            conflicts = find_bulk_teacher_or_room_conflicts(self.teacher.id, self.room.id, occ)
+        by_day = {(c['date'], c['start_time']): c['conflicts'] for c in conflicts}
+        self.assertEqual(by_day, {
+            ('2025-07-02', '10:00:00'): [{'type': 'teacher', 'lesson_ids': [t_clash.id]}],
+            ('2025-07-03', '09:00:00'): [{'type': 'room', 'lesson_ids': [r_clash.id]}],
+            ('2025-07-04', '10:00:00'): [{'type': 'self', 'lesson_ids': []}],
+        })
+
+    def test_create_rejects_all_conflicts_without_writing(self):
+        self._existing(dt.date(2025, 7, 2), dt.time(9), dt.time(11), self.teacher, self.room2)
+        self._existing(dt.date(2025, 7, 9), dt.time(9), dt.time(11), self.other_teacher, self.room)
+        before = (ClassGroup.objects.count(), Lesson.objects.count())
+        body = self._body(rule_type='weekly', weekly={'days': [3], 'start_time': '10:00', 'duration_minutes': 60})
+        resp = self.client_for(self.admin).post(self.url, body, format='json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(str(resp.content, 'utf-8').count('"type"'), 2)
+        self.assertEqual((ClassGroup.objects.count(), Lesson.objects.count()), before)
+
+    def test_create_generates_every_weekly_lesson(self):
+        body = self._body(rule_type='weekly', weekly={'days': [3], 'start_time': '10:00', 'duration_minutes': 60})
+        resp = self.client_for(self.admin).post(self.url, body, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        lessons = Lesson.objects.filter(class_group_id=resp.json()['data']['id'])
+        # 暑假 7/1~8/31 的周三共 9 个
+        self.assertEqual(lessons.count(), 9)
+        self.assertEqual(set(lessons.values_list('campus_id', flat=True)), {self.campus.id})
+
+    def test_preview_reports_conflicts_without_writing(self):
+        clash = self._existing(dt.date(2025, 7, 2), dt.time(9), dt.time(11), self.teacher, self.room2)
+        body = self._body(rule_type='weekly', weekly={'days': [3], 'start_time': '10:00', 'duration_minutes': 60})
+        before = (ClassGroup.objects.count(), Lesson.objects.count(), ScheduleRule.objects.count())
+        version = get_version(TIMETABLE)
+        resp = self.client_for(self.admin).post(self.url + '/preview', body, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        data = resp.json()['data']
+        self.assertEqual((data['lesson_count'], data['conflict_count']), (9, 1))
+        self.assertEqual(data['conflicts'][0]['conflicts'], [{'type': 'teacher', 'lesson_ids': [clash.id]}])
+        self.assertEqual([les['date'] for les in data['lessons'] if les['has_conflict']], ['2025-07-02'])
+        self.assertEqual((ClassGroup.objects.count(), Lesson.objects.count(), ScheduleRule.objects.count()), before)
+        self.assertEqual(get_version(TIMETABLE), version)
+
+    def test_preview_requires_scheduler_role(self):
+        body = self._body(rule_type='custom', custom=[{'date': '2025-07-02', 'start_time': '10:00', 'duration_minutes': 60}])
+        self.assertEqual(self.client_for(self.teacher).post(self.url + '/preview', body, format='json').status_code, 403)
+
+
+class StudentConflictMatrixTests(ScheduleFixtureMixin, TestCase):
+    """加入班级：学生 × 本班课次 冲突矩阵（在读班级 + 临时/试听参与）"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.enrolled, cls.participant, cls.free, cls.left = cls.make_students(4)
+        cls.target = cls.make_class([])
+        cls.t1 = cls.make_lesson(cls.target, day=dt.date(2025, 7, 2), start=dt.time(9))
+        cls.t2 = cls.make_lesson(cls.target, day=dt.date(2025, 7, 3), start=dt.time(14))
+
+        other = cls.make_class([cls.enrolled])
+        cls.make_lesson(other, day=dt.date(2025, 7, 2), start=dt.time(10))     # 与 t1 重叠
+        cls.make_lesson(other, day=dt.date(2025, 7, 3), start=dt.time(16))     # 与 t2 首尾相接，不算
+        ClassEnrollment.objects.create(student=cls.left, class_group=other, left_at=timezone.now())
+
+        trial = cls.make_class([])
+        les = cls.make_lesson(trial, day=dt.date(2025, 7, 3), start=dt.time(15))  # 与 t2 重叠
+        LessonParticipant.objects.create(lesson=les, student=cls.participant, type=LessonParticipant.TYPE_TRIAL)
+        canceled = cls.make_lesson(trial, day=dt.date(2025, 7, 2), start=dt.time(9))
+        canceled.status = 'canceled'
+        canceled.save()
+        LessonParticipant.objects.create(lesson=canceled, student=cls.free, type=LessonParticipant.TYPE_TEMP)
+
+    def test_matrix_covers_enrollments_and_participants(self):
+        ids = [self.enrolled.id, self.participant.id, self.free.id, self.left.id]
+        with self.assertNumQueries(4):
+            result = find_students_conflicts(ids, self.target.id)
+        self.assertEqual(result, {self.enrolled.id: [self.t1.id], self.participant.id: [self.t2.id]})
+
+    def test_enroll_returns_every_conflict_and_writes_nothing(self):
+        resp = self.client_for(self.admin).post(f'/api/schedule/class-groups/{self.target.id}/enroll', {
+            'student_ids': [self.enrolled.id, self.participant.id, self.free.id],
+        }, format='json')
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json()['data'], {str(self.enrolled.id): [self.t1.id], str(self.participant.id): [self.t2.id]})
+        self.assertFalse(ClassEnrollment.objects.filter(class_group=self.target).exists())
+
+    def test_enroll_without_conflicts(self):
+        resp = self.client_for(self.admin).post(f'/api/schedule/class-groups/{self.target.id}/enroll', {
+            'student_ids': [self.free.id, self.left.id],
+        }, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp.json()['data']['created'], 2)
+
+
+class LessonsViewOutputTests(ScheduleFixtureMixin, TestCase):
+    """LessonsView：ETag/304、NDJSON 与 normalized 输出和默认 JSON 一致"""
+
+    url = '/api/schedule/lessons'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.other_teacher = User.objects.create(username='t2', name='李老师', role='teacher')
+        students = cls.make_students(3)
+        cls.cg1 = cls.make_class(students[:2])
+        cls.cg2 = cls.make_class(students[1:], course_mode='one_to_two', teacher=cls.other_teacher)
+        cls.lessons = [
+            cls.make_lesson(cls.cg1, day=dt.date(2025, 7, 2), start=dt.time(9)),
+            cls.make_lesson(cls.cg2, day=dt.date(2025, 7, 2), start=dt.time(9)),
+            cls.make_lesson(cls.cg1, day=dt.date(2025, 7, 3), start=dt.time(14), teacher=cls.other_teacher),
+            cls.make_lesson(cls.cg2, day=dt.date(2025, 7, 4), start=dt.time(8)),
+            cls.make_lesson(cls.cg1, day=dt.date(2025, 7, 5), start=dt.time(18)),
+        ]
+        canceled = cls.make_lesson(cls.cg1, day=dt.date(2025, 7, 6))
+        Lesson.objects.filter(id=canceled.id).update(status='canceled')
+        LessonLeave.objects.create(lesson=cls.lessons[0], student=students[0])
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(self.admin)
+
+    def _get(self, headers=None, **params):
+        query = {'term_id': self.term.id, 'date_from': '2025-07-01', 'date_to': '2025-07-07'}
+        query.update(params)
+        return self.client.get(self.url, query, **(headers or {}))
+
+    def test_if_none_match_returns_304_until_a_write(self):
+        first = self._get()
+        etag = first['ETag']
+        resp = self._get({'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.content, b'')
+        self.assertEqual(resp['ETag'], etag)
+        # 查询参数不同 → ETag 不同
+        self.assertNotEqual(self._get(grades=8)['ETag'], etag)
+
+        LessonLeave.objects.create(lesson=self.lessons[1], student_id=self.cg2.student_enrollments.first().student_id)
+        resp = self._get({'HTTP_IF_NONE_MATCH': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertNotEqual(resp.json()['data'], first.json()['data'])
+
+    def _ndjson(self, **params):
+        resp = self._get(format='ndjson', **params)
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['Content-Type'].startswith('application/x-ndjson'))
+        body = b''.join(resp.streaming_content).decode('utf-8')
+        return [json.loads(line) for line in body.splitlines()]
+
+    def test_ndjson_lines_equal_json_payload(self):
+        data = self._get().json()['data']
+        self.assertEqual(len(data), 5)
+        self.assertEqual(self._ndjson(), data)
+        # 过滤条件同样生效（课次老师或班级主讲）
+        self.assertEqual(self._ndjson(teachers=self.other_teacher.id), self._get(teachers=self.other_teacher.id).json()['data'])
+
+    def test_ndjson_chunks_do_not_change_lines(self):
+        data = self._get().json()['data']
+        lines = [json.loads(line) for line in iter_lesson_lines(self.term.id, dt.date(2025, 7, 1), dt.date(2025, 7, 7),
+                                                                 chunk_size=2)]
+        self.assertEqual(lines, data)
+
+    def test_normalized_shape_expands_to_default_payload(self):
+        default = self._get().json()['data']
+        resp = self._get(shape='normalized')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], self._get()['ETag'])
+        data = resp.json()['data']
+        self.assertEqual(set(data['class_groups']), {str(self.cg1.id), str(self.cg2.id)})
+        self.assertNotIn('roster', data['lessons'][0])
+        expanded = [expand_lesson(les, data['class_groups'][str(les['class_group_id'])]) for les in data['lessons']]
+        self.assertEqual(expanded, default)
+
+    def test_normalized_only_ships_used_class_groups(self):
+        data = self._get(shape='normalized', teachers=self.other_teacher.id, date_to='2025-07-02').json()['data']
+        self.assertEqual([les['id'] for les in data['lessons']], [self.lessons[1].id])
+        self.assertEqual(list(data['class_groups']), [str(self.cg2.id)])
+
+
+class LessonCampusSyncTests(ScheduleFixtureMixin, TestCase):
+    """Lesson.campus 冗余：课次教室的校区，否则班级默认教室的校区；教室/班级/课次变更后重算"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.branch = Campus.objects.create(name='分校')
+        cls.branch_room = Room.objects.create(name='B1', campus=cls.branch)
+
+    def _campus(self, les):
+        return Lesson.objects.values_list('campus_id', flat=True).get(id=les.id)
+
+    def test_room_moved_to_another_campus(self):
+        les = self.make_lesson(self.make_class([]))
+        self.assertEqual(self._campus(les), self.campus.id)
+        self.room.campus = self.branch
+        self.room.save()
+        self.assertEqual(self._campus(les), self.branch.id)
+
+    def test_class_group_default_room_changed(self):
+        cg = self.make_class([])
+        les = self.make_lesson(cg)
+        Lesson.objects.filter(id=les.id).update(room=None)
+        # 课次没有教室：跟随班级默认教室
+        cg.room_default = self.branch_room
+        cg.save()
+        self.assertEqual(self._campus(les), self.branch.id)
+        # 班级默认教室所在校区变了，也要同步到只靠默认教室定位的课次
+        self.branch_room.campus = self.campus
+        self.branch_room.save()
+        self.assertEqual(self._campus(les), self.campus.id)
+
+    def test_lesson_room_override_wins(self):
+        les = self.make_lesson(self.make_class([]))
+        les.room = self.branch_room
+        les.save()
+        self.assertEqual(self._campus(les), self.branch.id)
+        les.room = None
+        les.save(update_fields=['room'])
+        self.assertEqual(self._campus(les), self.campus.id)
+
+
+class CyclePublishWriteTests(ScheduleFixtureMixin, TestCase):
+    """同步发布：批量写入 participant 与发布明细，复用已有 participant，撤名册只删本周期生成的"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+        cls.normal, cls.trial, cls.manual = cls.make_students(3)
+        cls.cg = cls.make_class([])
+        cls.lessons = [cls.make_lesson(cls.cg, day=dt.date(2025, 7, 2)),   # 周三
+                       cls.make_lesson(cls.cg, day=dt.date(2025, 7, 4))]   # 周五
+        CycleRoster.objects.create(cycle=cls.cycle, class_group=cls.cg, student=cls.normal)
+        CycleRoster.objects.create(cycle=cls.cycle, class_group=cls.cg, student=cls.trial, type=CycleRoster.TYPE_TRIAL)
+        CycleRoster.objects.create(cycle=cls.cycle, class_group=cls.cg, student=cls.manual)
+        # 手工加过的临时学员：发布时复用，不重复创建
+        cls.manual_lp = LessonParticipant.objects.create(lesson=cls.lessons[0], student=cls.manual,
+                                                         type=LessonParticipant.TYPE_TEMP)
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(self.admin)
+
+    def _publish(self, **body):
+        body = {'scope': 'include_today', 'dry_run': False,
+                'map': {'Wed': ['2025-07-02'], 'Fri': ['2025-07-04']}, **body}
+        resp = self.client.post(f'/api/schedule/cycle-schedule/cycles/{self.cycle.id}/publish', body, format='json')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()['data']
+
+    def test_publish_writes_participants_and_items(self):
+        data = self._publish()
+        expected = {(les.id, stu.id) for les in self.lessons for stu in (self.normal, self.trial, self.manual)}
+        self.assertEqual({(a['lesson_id'], a['student_id']) for a in data['added']}, expected)
+        self.assertEqual(data['removed'], [])
+
+        lps = {(lp.lesson_id, lp.student_id): lp for lp in LessonParticipant.objects.all()}
+        self.assertEqual(set(lps), expected)
+        self.assertEqual(lps[(self.lessons[0].id, self.manual.id)].id, self.manual_lp.id)
+        for les in self.lessons:
+            self.assertEqual(lps[(les.id, self.trial.id)].type, LessonParticipant.TYPE_TRIAL)
+            self.assertEqual(lps[(les.id, self.normal.id)].type, LessonParticipant.TYPE_TEMP)
+
+        items = CyclePublishItem.objects.filter(cycle=self.cycle)
+        self.assertEqual({(it.lesson_id, it.student_id): it.participant_id for it in items},
+                         {pair: lp.id for pair, lp in lps.items()})
+
+        # 再发布一次：无差异，不重复写
+        again = self._publish()
+        self.assertEqual((again['added'], again['removed']), ([], []))
+        self.assertEqual(LessonParticipant.objects.count(), len(expected))
+
+    def test_narrowed_map_removes_only_published_rows(self):
+        self._publish()
+        # 手工建在周五、不属于本周期的 participant：撤周五时不能被删
+        other = Student.objects.create(name='旁听', grade=8, school=self.school, visit_channel='walk_in')
+        extra = LessonParticipant.objects.create(lesson=self.lessons[1], student=other, type=LessonParticipant.TYPE_TEMP)
+
+        data = self._publish(map={'Wed': ['2025-07-02']})
+        friday = self.lessons[1].id
+        self.assertEqual({(r['lesson_id'], r['student_id']) for r in data['removed']},
+                         {(friday, stu.id) for stu in (self.normal, self.trial, self.manual)})
+        self.assertEqual(list(LessonParticipant.objects.filter(lesson_id=friday).values_list('id', flat=True)), [extra.id])
+        self.assertFalse(CyclePublishItem.objects.filter(cycle=self.cycle, lesson_id=friday).exists())
+        self.assertEqual(CyclePublishItem.objects.filter(cycle=self.cycle).count(), 3)
+        self.assertTrue(LessonParticipant.objects.filter(id=self.manual_lp.id).exists())
+
+    def _dry_run(self):
+        data = self._publish(dry_run=True)
+        self.assertEqual(data['add'], 6)
+        return data['plan_token']
+
+    def test_plan_token_applies_stored_plan(self):
+        data = self._publish(plan_token=self._dry_run())
+        self.assertEqual(len(data['added']), 6)
+        self.assertEqual(CyclePublishItem.objects.filter(cycle=self.cycle).count(), 6)
+
+    def test_stale_plan_token_is_rejected(self):
+        token = self._dry_run()
+        late = Student.objects.create(name='插班', grade=8, school=self.school, visit_channel='walk_in')
+        CycleRoster.objects.create(cycle=self.cycle, class_group=self.cg, student=late)
+        resp = self.client.post(f'/api/schedule/cycle-schedule/cycles/{self.cycle.id}/publish',
+                                {'dry_run': False, 'plan_token': token}, format='json')
+        self.assertEqual(resp.status_code, 409, resp.content)
+        self.assertFalse(CyclePublishItem.objects.exists())
+        self.assertEqual(LessonParticipant.objects.count(), 1)
+
+    def test_fingerprint_ignores_payload_key_order(self):
+        a = publishing.plan_fingerprint(self.cycle, 'include_today', {'map': {'Wed': ['2025-07-02']}, 'tracks': {}})
+        b = publishing.plan_fingerprint(self.cycle, 'include_today', {'tracks': {}, 'map': {'Wed': ['2025-07-02']}})
+        self.assertEqual(a, b)
+
+
+class MasterRosterCursorTests(ScheduleFixtureMixin, TestCase):
+    """名册游标分页：逐页读完每行恰好出现一次（含同名学生），与偏移分页结果一致"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.make_base()
+        cls.cycle = Cycle.objects.create(term=cls.term, term_type='summer', year=2025, campus=cls.campus,
+                                         name='暑假一期', date_from=dt.date(2025, 7, 1), date_to=dt.date(2025, 7, 7))
+        names = ['张三', '李四', '张三', '王五', '张三', '李四', '赵六']  # 同名跨页
+        for _ in range(2):
+            cg = cls.make_class([])
+            for name in names:
+                stu = Student.objects.create(name=name, grade=8, school=cls.school, visit_channel='walk_in')
+                CycleRoster.objects.create(cycle=cls.cycle, class_group=cg, student=stu)
+
+    def setUp(self):
+        cache.clear()
+        self.client = self.client_for(self.admin)
+
+    def _page(self, **params):
+        resp = self.client.get(f'/api/schedule/cycle-schedule/cycles/{self.cycle.id}/roster', params)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()['data']
+
+    def test_cursor_pages_yield_every_row_once(self):
+        expected = list(CycleRoster.objects.filter(cycle=self.cycle)
+                        .order_by('class_group_id', 'student__name', 'id').values_list('id', flat=True))
+        for size in (1, 2, 3, 5):
+            seen, cursor = [], ''
+            while cursor is not None:
+                data = self._page(cursor=cursor, page_size=size)
+                self.assertLessEqual(len(data['results']), size)
+                seen += [r['roster_id'] for r in data['results']]
+                cursor = data['next']
+            self.assertEqual(seen, expected, size)
+
+    def test_cursor_matches_offset_pages(self):
+        offset = [r['roster_id'] for p in (1, 2, 3) for r in self._page(page=p, page_size=5)['results']]
+        first = self._page(cursor='', page_size=5)
+        second = self._page(cursor=first['next'], page_size=5)
+        self.assertEqual([r['roster_id'] for r in first['results'] + second['results']], offset[:10])
+
+    def test_invalid_cursor(self):
+        resp = self.client.get(f'/api/schedule/cycle-schedule/cycles/{self.cycle.id}/roster', {'cursor': '***'})
+        self.assertEqual(resp.status_code, 400)
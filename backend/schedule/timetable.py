@@ -0,0 +1,255 @@
+# backend/schedule/timetable.py
+"""
+课表快照缓存（LessonsView 使用）
+- 以 (term, date) 为粒度缓存“当天全部课次”的组装结果（不含 grades/teachers/subjects 过滤）
+- 缓存里存规范化形态：课次 core + 班级信息（名册/科目/老师/教室只存一份），两种响应形态都由它派生
+- 缓存键带 TIMETABLE 版本号：任一相关写入使版本 +1，所有 worker 的旧条目同时失效
+- 过滤在内存中完成，同一周反复查看直接命中缓存
+"""
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+from rest_framework.renderers import BaseRenderer
+
+from .models import Lesson, ClassEnrollment, LessonLeave
+from .versioning import TIMETABLE, get_version
+
+LESSONS_CACHE_TIMEOUT = 60 * 30  # 秒；版本变化后旧键不会再被读取，超时仅用于回收
+STREAM_CHUNK_SIZE = 500          # NDJSON 流式输出时每批从库里取的课次数
+
+
+def _cache_key(version: int, term_id: int, d) -> str:
+    return f'schedule:lessons:v{version}:t{term_id}:{d}'
+
+
+def build_day_payloads(term_id: int, dates) -> dict:
+    """
+    从数据库组装若干天的课次（规范化形态）：
+    {date: {'lessons': [(meta, core), ...], 'class_groups': {cg_id: info}}}
+    meta = (grade, teacher_id, teacher_main_id, subject_id)，仅用于内存过滤
+    """
+    lessons = list(
+        Lesson.objects
+        .filter(class_group__term_id=term_id, date__in=list(dates))
+        .exclude(status='canceled')
+        .select_related('class_group', 'class_group__subject', 'class_group__teacher_main',
+                        'class_group__room_default', 'teacher', 'room')
+        .order_by('date', 'start_time', 'id')
+    )
+
+    # —— 一次性取出“全部学生”（在读）：构建 {cg_id: [ {id, name}, ... ]} ——
+    cg_ids = {les.class_group_id for les in lessons}
+    by_cg_students = defaultdict(list)
+    if cg_ids:
+        for row in (ClassEnrollment.objects
+                    .filter(class_group_id__in=cg_ids, left_at__isnull=True)
+                    .values('class_group_id', 'student_id', 'student__name')
+                    .order_by('id')):
+            by_cg_students[row['class_group_id']].append(
+                {'id': row['student_id'], 'name': row['student__name'] or ''}
+            )
+
+    # —— 批量统计请假数，避免循环 count ——
+    leaves_map = {}
+    if lessons:
+        for r in (LessonLeave.objects
+                  .filter(lesson_id__in=[les.id for les in lessons])
+                  .values('lesson_id')
+                  .annotate(cnt=Count('id'))):
+            leaves_map[r['lesson_id']] = r['cnt']
+
+    days = {d: {'lessons': [], 'class_groups': {}} for d in dates}
+    for les in lessons:
+        cg = les.class_group
+        day = days[les.date]
+        if cg.id not in day['class_groups']:
+            day['class_groups'][cg.id] = class_group_info(cg, by_cg_students.get(cg.id, []))
+        meta = (cg.grade, les.teacher_id, cg.teacher_main_id, cg.subject_id)
+        day['lessons'].append((meta, lesson_core(les, leaves_map.get(les.id, 0))))
+    return days
+
+
+def _user_name(u):
+    return (getattr(u, 'name', None) or getattr(u, 'username', None)) if u else None
+
+
+def class_group_info(cg, roster: list) -> dict:
+    """班级级别、每节课都相同的信息（规范化响应里只出现一次）"""
+    return {
+        'id': cg.id,
+        'name': cg.name or '',
+        'title': f'{cg.name or ""}{cg.subject.name}-{cg.course_mode}',
+        'grade': cg.grade,
+        'course_mode': cg.course_mode,
+        'subject': cg.subject.name,
+        'teacher': _user_name(cg.teacher_main),
+        'room': (cg.room_default.name if cg.room_default else None),
+        'capacity': cg.capacity,          # small_class 为 null
+        'roster': roster,                 # [{id, name}, ...]
+        'roster_count': len(roster),
+    }
+
+
+def lesson_core(les: Lesson, leave_count: int) -> dict:
+    """课次自身字段；老师/教室仅在覆盖了班级默认值时给出"""
+    cg = les.class_group
+    core = {
+        'id': les.id,
+        'class_group_id': cg.id,
+        'date': str(les.date),
+        'start_time': str(les.start_time),
+        'end_time': str(les.end_time),
+        'duration': les.duration_minutes,
+        'leave_count': leave_count,
+        'status': les.status,
+    }
+    if les.teacher_id and les.teacher_id != cg.teacher_main_id:
+        core['teacher'] = _user_name(les.teacher)
+    if les.room_id and les.room_id != cg.room_default_id:
+        core['room'] = les.room.name
+    return core
+
+
+def expand_lesson(core: dict, cg: dict) -> dict:
+    """规范化 → 完整单条（LessonsView 默认响应结构）"""
+    roster = cg['roster']
+    return {
+        'id': core['id'],
+        'class_group_id': core['class_group_id'],
+        'title': cg['title'],
+        'date': core['date'],
+        'start_time': core['start_time'],
+        'end_time': core['end_time'],
+        'duration': core['duration'],
+        'grade': cg['grade'],
+        'course_mode': cg['course_mode'],
+        'subject': cg['subject'],
+        'room': core.get('room', cg['room']),
+        'teacher': core.get('teacher', cg['teacher']),
+
+        # ✅ 新增：完整学生数组（全量）
+        'roster': roster,                                  # [{id, name}, ...]
+
+        # 兼容 & 汇总
+        'roster_preview': [s['name'] for s in roster][:5],  # 预览（前5个名字）
+        'roster_count': cg['roster_count'],                # 总人数
+        'enrolled': cg['roster_count'],                    # 保持前端已用的字段
+        'capacity': cg['capacity'],                        # small_class 为 null
+        'leave_count': core['leave_count'],
+        'status': core['status'],
+    }
+
+
+def get_day_payloads(term_id: int, date_from, date_to, version: int = None):
+    """
+    按天读缓存，未命中的天一次性补齐
+    返回 (rows, class_groups)：rows 为按日期顺序的 [(meta, core), ...]，class_groups 为 {cg_id: info}
+    """
+    if version is None:
+        version = get_version(TIMETABLE)
+    dates = []
+    d = date_from
+    while d <= date_to:
+        dates.append(d)
+        d += timedelta(days=1)
+
+    keys = {d: _cache_key(version, term_id, d) for d in dates}
+    cached = cache.get_many(list(keys.values()))
+    missing = [d for d in dates if keys[d] not in cached]
+    if missing:
+        built = build_day_payloads(term_id, missing)
+        cache.set_many({keys[d]: built[d] for d in missing}, LESSONS_CACHE_TIMEOUT)
+        for d in missing:
+            cached[keys[d]] = built[d]
+
+    rows, class_groups = [], {}
+    for d in dates:
+        day = cached[keys[d]]
+        rows.extend(day['lessons'])
+        class_groups.update(day['class_groups'])
+    return rows, class_groups
+
+
+def filter_day_payloads(rows, grades=None, teachers=None, subjects=None) -> list:
+    """按年级/老师/科目在内存中过滤，返回课次 core 列表"""
+    grades = set(grades or ())
+    teachers = set(teachers or ())
+    subjects = set(subjects or ())
+    data = []
+    for (grade, teacher_id, teacher_main_id, subject_id), core in rows:
+        if grades and grade not in grades:
+            continue
+        if teachers and teacher_id not in teachers and teacher_main_id not in teachers:
+            continue
+        if subjects and subject_id not in subjects:
+            continue
+        data.append(core)
+    return data
+
+
+# —— NDJSON 流式输出（?format=ndjson；大范围查询不走缓存，内存占用与范围无关） ——
+class NDJSONRenderer(BaseRenderer):
+    """仅用于内容协商与错误/304 响应；正常数据由 iter_lesson_lines 流式写出"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def iter_lesson_lines(term_id: int, date_from, date_to, grades=None, teachers=None, subjects=None,
+                      chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    按块迭代课次，每行一个 JSON（与 LessonsView 普通响应中的单条结构一致）
+    - 名册按班级懒加载（只保留本次出现过的班级），请假数按块统计
+    """
+    qs = (Lesson.objects
+          .filter(class_group__term_id=term_id, date__gte=date_from, date__lte=date_to)
+          .exclude(status='canceled')
+          .select_related('class_group', 'class_group__subject', 'class_group__teacher_main',
+                          'class_group__room_default', 'teacher', 'room')
+          .order_by('date', 'start_time', 'id'))
+    if grades:
+        qs = qs.filter(class_group__grade__in=grades)
+    if teachers:
+        qs = qs.filter(Q(teacher_id__in=teachers) | Q(class_group__teacher_main_id__in=teachers))
+    if subjects:
+        qs = qs.filter(class_group__subject_id__in=subjects)
+
+    class_groups = {}
+    batch = []
+    for les in qs.iterator(chunk_size=chunk_size):
+        batch.append(les)
+        if len(batch) >= chunk_size:
+            yield from _render_batch(batch, class_groups)
+            batch = []
+    if batch:
+        yield from _render_batch(batch, class_groups)
+
+
+def _render_batch(batch, class_groups: dict):
+    new_cgs = {les.class_group_id: les.class_group for les in batch if les.class_group_id not in class_groups}
+    if new_cgs:
+        rosters = defaultdict(list)
+        for row in (ClassEnrollment.objects
+                    .filter(class_group_id__in=list(new_cgs), left_at__isnull=True)
+                    .values('class_group_id', 'student_id', 'student__name')
+                    .order_by('id')):
+            rosters[row['class_group_id']].append({'id': row['student_id'], 'name': row['student__name'] or ''})
+        for cg_id, cg in new_cgs.items():
+            class_groups[cg_id] = class_group_info(cg, rosters.get(cg_id, []))
+
+    leaves_map = dict(LessonLeave.objects
+                      .filter(lesson_id__in=[les.id for les in batch])
+                      .values('lesson_id')
+                      .annotate(cnt=Count('id'))
+                      .values_list('lesson_id', 'cnt'))
+    for les in batch:
+        payload = expand_lesson(lesson_core(les, leaves_map.get(les.id, 0)), class_groups[les.class_group_id])
+        yield json.dumps(payload, ensure_ascii=False) + '\n'
@@ -1,8 +1,9 @@
 from django.urls import re_path
 from .views import (
     TermListCreate, RoomList, SubjectList, TeacherList,
-    ClassGroupListCreate, ClassGroupEnroll, ClassGroupUnenroll,
-    LessonsView, LessonLeaveView, AttendanceCommitView, AttendanceRevertView,
+    ClassGroupListCreate, ClassGroupPreview, ClassGroupEnroll, ClassGroupUnenroll,
+    LessonsView, LessonLeaveView, AttendanceCommitView, AttendanceRevertView, AttendanceBulkCommitView,
+    AttendanceBulkRevertView,
     # 新增导入
     LessonParticipantViewSet
 )
@@ -12,9 +13,9 @@ from .views_cycle import (
     CycleListCreateView, CycleDetailView,
     CycleBoardView,
     CycleRosterView,
-    CyclePublishView,
+    CyclePublishView, CyclePublishJobView,
     CycleMasterRosterView,PreplanSlotListCreateView,
-    PreplanSlotDetailView
+    PreplanSlotDetailView, PreplanSolveView, PreplanConflictsView
 )
 
 # 新增：把 ViewSet 映射为函数视图（保持与你其它 re_path 风格一致）
@@ -30,6 +31,7 @@ urlpatterns = [
 
     # 班级
     re_path(r'^class-groups/?$', ClassGroupListCreate.as_view()),
+    re_path(r'^class-groups/preview/?$', ClassGroupPreview.as_view()),
     re_path(r'^class-groups/(?P<pk>\d+)/enroll/?$', ClassGroupEnroll.as_view()),
     re_path(r'^class-groups/(?P<pk>\d+)/unenroll/?$', ClassGroupUnenroll.as_view()),
 
@@ -42,6 +44,8 @@ urlpatterns = [
     # 签到/消课（课后）
     re_path(r'^lessons/(?P<pk>\d+)/attendance/?$', AttendanceCommitView.as_view()),
     re_path(r'^lessons/(?P<pk>\d+)/attendance/revert/?$', AttendanceRevertView.as_view()),
+    re_path(r'^lessons/attendance/bulk/?$', AttendanceBulkCommitView.as_view()),  # 多课次一次提交
+    re_path(r'^lessons/attendance/revert/bulk/?$', AttendanceBulkRevertView.as_view()),  # 批量撤销消课
 
     # ========= 新增：试听 / 临时排课一次 =========
     # 列表 + 批量创建
@@ -56,8 +60,11 @@ urlpatterns = [
     re_path(r'^cycle-schedule/cycles/(?P<cycle_id>\d+)/class-groups/(?P<class_group_id>\d+)/roster/?$',
             CycleRosterView.as_view()),
     re_path(r'^cycle-schedule/cycles/(?P<pk>\d+)/publish/?$', CyclePublishView.as_view()),
+    re_path(r'^cycle-schedule/publish-jobs/(?P<pk>\d+)/?$', CyclePublishJobView.as_view()),
     re_path(r'^cycle-schedule/cycles/(?P<cycle_id>\d+)/roster/?$', CycleMasterRosterView.as_view()),
     re_path(r'^cycle-schedule/preplan/slots/?$', PreplanSlotListCreateView.as_view()),
     re_path(r'^cycle-schedule/preplan/slots/(?P<pk>\d+)/?$', PreplanSlotDetailView.as_view()),
+    re_path(r'^cycle-schedule/cycles/(?P<pk>\d+)/preplan/solve/?$', PreplanSolveView.as_view()),
+    re_path(r'^cycle-schedule/cycles/(?P<pk>\d+)/preplan/conflicts/?$', PreplanConflictsView.as_view()),
 
 ]
@@ -1,10 +1,13 @@
 from datetime import datetime, timedelta, date
 from decimal import Decimal, ROUND_HALF_UP
-from typing import List, Tuple, Optional
-from django.db.models import Q
+from typing import List, Tuple, Optional, Dict
+from collections import defaultdict
+from django.db import connection, transaction
+from django.db.models import F, Q, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
-from .models import Lesson, ClassGroup
+from .models import Lesson, ClassGroup, ClassEnrollment, LessonParticipant, Room
 from academics.models import Enrollment
 
 # —— 周几 <-> 位掩码（bit0=周一 ... bit6=周日）
@@ -51,6 +54,18 @@ def capacity_max(course_mode: str) -> Optional[int]:
         return 4
     return None  # small_class 不限
 
+# —— 课次冗余校区
+def lesson_campus_expression():
+    """生效校区：课次教室的校区，否则回退班级默认教室的校区"""
+    return Coalesce(
+        Subquery(Room.objects.filter(pk=OuterRef('room_id')).values('campus_id')[:1]),
+        Subquery(ClassGroup.objects.filter(pk=OuterRef('class_group_id')).values('room_default__campus_id')[:1]),
+    )
+
+def sync_lesson_campus(qs) -> int:
+    """按教室/班级默认教室重算 Lesson.campus（单条 UPDATE）"""
+    return qs.update(campus_id=lesson_campus_expression())
+
 # —— 时间重叠判断与冲突
 def time_overlap(start_a, end_a, start_b, end_b) -> bool:
     return (start_a < end_b) and (end_a > start_b)
@@ -70,6 +85,86 @@ def find_teacher_or_room_conflicts(teacher_id, room_id, the_date, start_time, en
             conflicts.append({'type': 'room', 'lesson_ids': list(r_qs.values_list('id', flat=True))})
     return conflicts
 
+def calc_end_time(start_time, duration_minutes: int):
+    return (datetime.combine(date.today(), start_time) + timedelta(minutes=duration_minutes)).time()
+
+def expand_weekly_occurrences(days: List[int], start_time, duration_minutes: int, date_from, date_to) -> List[Dict]:
+    """
+    周规则展开为候选课次（不落库）：[{date, start_time, end_time, duration_minutes}, ...]
+    days 为 isoweekday（周一=1 ... 周日=7）
+    """
+    days = set(days)
+    end_time = calc_end_time(start_time, duration_minutes)
+    occurrences = []
+    d = date_from
+    while d <= date_to:
+        if d.isoweekday() in days:
+            occurrences.append({'date': d, 'start_time': start_time, 'end_time': end_time,
+                                'duration_minutes': duration_minutes})
+        d += timedelta(days=1)
+    return occurrences
+
+def expand_custom_occurrences(entries: List[Dict]) -> List[Dict]:
+    """自定义多段展开为候选课次（按日期、开始时间排序）"""
+    occurrences = [{'date': e['date'], 'start_time': e['start_time'],
+                    'end_time': calc_end_time(e['start_time'], e['duration_minutes']),
+                    'duration_minutes': e['duration_minutes']} for e in entries]
+    occurrences.sort(key=lambda o: (o['date'], o['start_time']))
+    return occurrences
+
+def find_bulk_teacher_or_room_conflicts(teacher_id, room_id, occurrences: List[Dict]) -> List[Dict]:
+    """
+    批量版 find_teacher_or_room_conflicts：
+    一次查询拉出日期跨度内该老师/教室的全部课次，在内存中判断重叠。
+    候选课次之间互相重叠（同一老师同一时间两节）记为 type=self。
+    返回：[{date, start_time, end_time, conflicts: [{type, lesson_ids}, ...]}, ...]（仅含有冲突的课次）
+    """
+    if not occurrences or not (teacher_id or room_id):
+        return []
+
+    cond = Q()
+    if teacher_id:
+        cond |= Q(teacher_id=teacher_id)
+    if room_id:
+        cond |= Q(room_id=room_id)
+    rows = (Lesson.objects
+            .filter(date__gte=min(o['date'] for o in occurrences),
+                    date__lte=max(o['date'] for o in occurrences))
+            .filter(cond)
+            .exclude(status='canceled')
+            .values_list('id', 'date', 'start_time', 'end_time', 'teacher_id', 'room_id'))
+    by_date = defaultdict(list)
+    for row in rows:
+        by_date[row[1]].append(row)
+
+    pending = defaultdict(list)  # date -> 已展开的候选课次下标
+    result = []
+    for idx, o in enumerate(occurrences):
+        t_ids, r_ids = [], []
+        for lid, _, st, et, t_id, r_id in by_date.get(o['date'], []):
+            if not time_overlap(o['start_time'], o['end_time'], st, et):
+                continue
+            if teacher_id and t_id == teacher_id:
+                t_ids.append(lid)
+            if room_id and r_id == room_id:
+                r_ids.append(lid)
+        self_hits = [j for j in pending[o['date']]
+                     if time_overlap(o['start_time'], o['end_time'],
+                                     occurrences[j]['start_time'], occurrences[j]['end_time'])]
+        pending[o['date']].append(idx)
+
+        conflicts = []
+        if t_ids:
+            conflicts.append({'type': 'teacher', 'lesson_ids': t_ids})
+        if r_ids:
+            conflicts.append({'type': 'room', 'lesson_ids': r_ids})
+        if self_hits:
+            conflicts.append({'type': 'self', 'lesson_ids': []})
+        if conflicts:
+            result.append({'date': str(o['date']), 'start_time': str(o['start_time']),
+                           'end_time': str(o['end_time']), 'conflicts': conflicts})
+    return result
+
 def student_has_conflict(student_id: int, lesson: Lesson, class_group_id: int) -> bool:
     # 学生在同日同时间段其它班级是否有课（不含当前班级）
     qs = Lesson.objects.filter(
@@ -80,6 +175,56 @@ def student_has_conflict(student_id: int, lesson: Lesson, class_group_id: int) -
     qs = qs.filter(start_time__lt=lesson.end_time, end_time__gt=lesson.start_time)
     return qs.exists()
 
+def find_students_conflicts(student_ids: List[int], class_group_id: int) -> Dict[int, List[int]]:
+    """
+    批量版 student_has_conflict：学生 × 本班课次 的冲突矩阵
+    - 本班未取消课次一次取出
+    - 候选学生的占用时段一次取出：其它班级的有效 ClassEnrollment 课次 + LessonParticipant 课次
+    - 内存求交，返回 {student_id: [冲突的本班 lesson_id, ...]}（仅含有冲突的学生）
+    """
+    lessons = list(Lesson.objects.filter(class_group_id=class_group_id).exclude(status='canceled')
+                   .values_list('id', 'date', 'start_time', 'end_time'))
+    if not lessons or not student_ids:
+        return {}
+    date_from = min(l[1] for l in lessons)
+    date_to = max(l[1] for l in lessons)
+
+    # 学生 -> 在读的其它班级
+    cg_students = defaultdict(set)
+    for sid, cg_id in (ClassEnrollment.objects
+                       .filter(student_id__in=student_ids, left_at__isnull=True)
+                       .exclude(class_group_id=class_group_id)
+                       .values_list('student_id', 'class_group_id')):
+        cg_students[cg_id].add(sid)
+
+    busy = defaultdict(lambda: defaultdict(list))  # sid -> date -> [(start, end)]
+    if cg_students:
+        for cg_id, d, st, et in (Lesson.objects
+                                 .filter(class_group_id__in=list(cg_students), date__gte=date_from, date__lte=date_to)
+                                 .exclude(status='canceled')
+                                 .values_list('class_group_id', 'date', 'start_time', 'end_time')):
+            for sid in cg_students[cg_id]:
+                busy[sid][d].append((st, et))
+
+    for sid, d, st, et in (LessonParticipant.objects
+                           .filter(student_id__in=student_ids,
+                                   lesson__date__gte=date_from, lesson__date__lte=date_to)
+                           .exclude(lesson__status='canceled')
+                           .exclude(lesson__class_group_id=class_group_id)
+                           .values_list('student_id', 'lesson__date', 'lesson__start_time', 'lesson__end_time')):
+        busy[sid][d].append((st, et))
+
+    result = {}
+    for sid in student_ids:
+        days = busy.get(sid)
+        if not days:
+            continue
+        hits = [lid for lid, d, st, et in lessons
+                if any(time_overlap(st, et, bs, be) for bs, be in days.get(d, ()))]
+        if hits:
+            result[sid] = hits
+    return result
+
 # —— 扣课前校验与执行
 def ensure_enrollment(student_id: int, course_mode: str, unit: str) -> Enrollment:
     en, _ = Enrollment.objects.get_or_create(
@@ -91,57 +236,78 @@ def ensure_enrollment(student_id: int, course_mode: str, unit: str) -> Enrollmen
         en.save(update_fields=['deduct_unit'])
     return en
 
+def balance_fields(unit: str) -> Tuple[str, str]:
+    """扣课单位对应的 (付费余额字段, 赠送余额字段)"""
+    if unit == 'hours':
+        return 'remaining_hours', 'remaining_hours_gift'
+    return 'remaining_sessions', 'remaining_sessions_gift'
+
 def check_balance_sufficient(student_id: int, course_mode: str, unit: str, qty: Decimal) -> bool:
     en = ensure_enrollment(student_id, course_mode, unit)
-    if unit == 'hours':
-        paid = Decimal(en.remaining_hours or 0)
-        gift = Decimal(getattr(en, 'remaining_hours_gift', 0) or 0)
-    else:
-        paid = Decimal(en.remaining_sessions or 0)
-        gift = Decimal(getattr(en, 'remaining_sessions_gift', 0) or 0)
+    paid_f, gift_f = balance_fields(unit)
+    paid = Decimal(getattr(en, paid_f) or 0)
+    gift = Decimal(getattr(en, gift_f) or 0)
     return (paid + gift) >= qty
 
+def deduct_enrollment(enrollment_id: int, unit: str, qty: Decimal) -> Tuple[Decimal, Decimal]:
+    """
+    原子扣减一个账户：先扣付费，再扣赠送；返回 (paid_used, gift_used)
+    - 一条条件 UPDATE：付费扣 MIN(付费, qty)，赠送扣 qty - MIN(付费, qty)，WHERE 付费 + 赠送 >= qty
+      拆分由数据库按行的当前值计算，不先读余额、不在 Python 里持锁，也没有比较重试
+    - 付费部分同时写进 last_deduct_paid 并 RETURNING（SQLite 3.35+ / PostgreSQL）；
+      其它库在同一事务里回读（该行已被本次 UPDATE 锁住）
+    - SET 里只引用最后才赋值的付费列：无论按旧值（SQLite/PG）还是按从左到右的新值（MySQL）求值，结果都一样
+    余额不足或账户不存在抛 ValueError
+    """
+    paid_f, gift_f = balance_fields(unit)
+    qty = Decimal(qty)
+    qn = connection.ops.quote_name
+    table = qn(Enrollment._meta.db_table)
+    paid, gift, last = qn(paid_f), qn(gift_f), qn('last_deduct_paid')
+    q = 'CAST(%s AS DECIMAL(7, 2))'
+    used = f'CASE WHEN {paid} < {q} THEN {paid} ELSE {q} END'
+    sql = (f'UPDATE {table} SET {gift} = {gift} - ({q} - {used}), {last} = {used}, {paid} = {paid} - {used} '
+           f'WHERE {qn(Enrollment._meta.pk.column)} = %s AND {paid} + {gift} >= {q}')
+    params = [qty] * 7 + [enrollment_id, qty]
+    with transaction.atomic(), connection.cursor() as cur:
+        if _update_returning_supported():
+            cur.execute(sql + f' RETURNING {last}', params)
+            row = cur.fetchone()
+        else:
+            cur.execute(sql, params)
+            row = None
+            if cur.rowcount:
+                row = Enrollment.objects.filter(pk=enrollment_id).values_list('last_deduct_paid').get()
+    if not row:
+        if not Enrollment.objects.filter(pk=enrollment_id).exists():
+            raise ValueError('账户不存在')
+        raise ValueError('余额不足')
+    paid_used = Decimal(str(row[0])).quantize(Decimal('0.00'))
+    return paid_used, qty - paid_used
+
+def _update_returning_supported() -> bool:
+    """UPDATE ... RETURNING：PostgreSQL，及 SQLite 3.35+（MySQL/MariaDB 不支持）"""
+    if connection.vendor == 'postgresql':
+        return True
+    return connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 35)
+
+def credit_enrollment(enrollment_id: int, unit: str, paid: Decimal, gift: Decimal) -> None:
+    """原子回补余额（撤销消课）：UPDATE ... SET 余额 = 余额 + x"""
+    paid_f, gift_f = balance_fields(unit)
+    Enrollment.objects.filter(pk=enrollment_id).update(
+        **{paid_f: F(paid_f) + (paid or 0), gift_f: F(gift_f) + (gift or 0)}
+    )
+
 def apply_deduction(student_id: int, course_mode: str, unit: str, qty: Decimal) -> Tuple[Decimal, Decimal, str]:
     """
     先扣付费，再扣赠送；返回 (paid_used, gift_used, main_source)
+    扣减为条件 UPDATE（见 deduct_enrollment），并发提交不会丢更新
     """
     en = ensure_enrollment(student_id, course_mode, unit)
-    if unit == 'hours':
-        paid_bal = Decimal(en.remaining_hours or 0)
-        gift_bal = Decimal(getattr(en, 'remaining_hours_gift', 0) or 0)
-    else:
-        paid_bal = Decimal(en.remaining_sessions or 0)
-        gift_bal = Decimal(getattr(en, 'remaining_sessions_gift', 0) or 0)
-
-    need = qty
-    paid_used = min(paid_bal, need)
-    need -= paid_used
-    gift_used = min(gift_bal, need)
-    need -= gift_used
-
-    if need > 0:
-        raise ValueError('余额不足')  # 调用方已预检，这里理论不会触发
-
-    # 写回
-    if unit == 'hours':
-        en.remaining_hours = (paid_bal - paid_used)
-        en.remaining_hours_gift = (gift_bal - gift_used)
-        en.save(update_fields=['remaining_hours', 'remaining_hours_gift'])
-    else:
-        en.remaining_sessions = (paid_bal - paid_used)
-        en.remaining_sessions_gift = (gift_bal - gift_used)
-        en.save(update_fields=['remaining_sessions', 'remaining_sessions_gift'])
-
+    paid_used, gift_used = deduct_enrollment(en.id, unit, qty)
     main = 'paid' if paid_used > 0 else 'gift'
     return (paid_used.quantize(Decimal('0.00')), gift_used.quantize(Decimal('0.00')), main)
 
 def revert_deduction(student_id: int, course_mode: str, unit: str, paid_used: Decimal, gift_used: Decimal):
     en = ensure_enrollment(student_id, course_mode, unit)
-    if unit == 'hours':
-        en.remaining_hours = Decimal(en.remaining_hours or 0) + (paid_used or 0)
-        en.remaining_hours_gift = Decimal(getattr(en, 'remaining_hours_gift', 0) or 0) + (gift_used or 0)
-        en.save(update_fields=['remaining_hours', 'remaining_hours_gift'])
-    else:
-        en.remaining_sessions = Decimal(en.remaining_sessions or 0) + (paid_used or 0)
-        en.remaining_sessions_gift = Decimal(getattr(en, 'remaining_sessions_gift', 0) or 0) + (gift_used or 0)
-        en.save(update_fields=['remaining_sessions', 'remaining_sessions_gift'])
+    credit_enrollment(en.id, unit, paid_used, gift_used)
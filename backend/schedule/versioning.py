@@ -0,0 +1,80 @@
+# backend/schedule/versioning.py
+"""
+变更版本号：读端缓存/ETag 的失效依据
+- TIMETABLE：Lesson / ClassEnrollment / LessonLeave / ClassGroup 任一写入即 +1
+- cycle_roster_scope(cycle_id)：该周期 CycleRoster 写入即 +1
+- cycle_publish_scope(cycle_id)：该周期发布写入 CyclePublishItem 后 +1（批量写不触发信号，由发布逻辑显式调用）
+- PREPLAN：任一 CyclePreplanSlot 写入即 +1
+- 计数存数据库（ScheduleVersion），多 worker 进程看到的是同一个值
+"""
+import hashlib
+import json
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from rest_framework.response import Response
+
+from .models import ScheduleVersion
+
+TIMETABLE = 'timetable'
+PREPLAN = 'preplan'
+
+
+def cycle_roster_scope(cycle_id) -> str:
+    return f'cycle_roster:{cycle_id}'
+
+
+def cycle_publish_scope(cycle_id) -> str:
+    return f'cycle_publish:{cycle_id}'
+
+
+def get_version(scope: str) -> int:
+    v = ScheduleVersion.objects.filter(scope=scope).values_list('version', flat=True).first()
+    return v or 0
+
+
+def get_versions(*scopes) -> tuple:
+    """一次查询取多个 scope 的版本号，按入参顺序返回"""
+    rows = dict(ScheduleVersion.objects.filter(scope__in=scopes).values_list('scope', 'version'))
+    return tuple(rows.get(s, 0) for s in scopes)
+
+
+def bump_version(scope: str) -> None:
+    if ScheduleVersion.objects.filter(scope=scope).update(version=F('version') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ScheduleVersion.objects.create(scope=scope, version=1)
+    except IntegrityError:
+        # 并发下别人刚创建：再 +1 一次，保证本次写入一定使旧版本失效
+        ScheduleVersion.objects.filter(scope=scope).update(version=F('version') + 1)
+
+
+# —— ETag / If-None-Match ——
+def make_etag(*parts) -> str:
+    """
+    由廉价的变更标记（版本号、updated_at、查询参数）算出强 ETag，无需先构造响应体
+    按规范 JSON（键排序、紧凑分隔、日期等转 str）取摘要：与 dict 插入顺序、repr 格式无关，跨进程/版本稳定
+    """
+    raw = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return '"%s"' % hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def etag_matches(request, etag: str) -> bool:
+    header = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in {t.strip() for t in header.split(',')}
+
+
+def not_modified(etag: str) -> Response:
+    resp = Response(status=304)
+    return with_etag(resp, etag)
+
+
+def with_etag(resp, etag: str):
+    resp['ETag'] = etag
+    resp['Cache-Control'] = 'private, no-cache'  # 浏览器每次带 If-None-Match 回源校验
+    return resp
@@ -1,13 +1,12 @@
 from datetime import timedelta
-from decimal import Decimal
 from typing import List, Dict
-from collections import defaultdict
 
 from django.contrib.auth import get_user_model
 from django.db import transaction
-from django.db.models import Count
+from django.http import StreamingHttpResponse
 from django.utils import timezone
 from rest_framework import viewsets, status
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
@@ -15,17 +14,22 @@ from rest_framework.permissions import IsAuthenticated
 from .models import (
     Term, Room, Subject, ClassGroup, Lesson,
     ClassEnrollment, LessonLeave, Attendance,
-    TeacherWorklog,LessonParticipant
+    LessonParticipant
 )
 from .serializers import (
     TermIn, TermOut, ClassGroupCreateIn, ClassGroupOut,
-    EnrollIn, UnenrollIn, LessonsQuery, LeaveIn, AttendanceCommitIn,
+    EnrollIn, UnenrollIn, LessonsQuery, LeaveIn, AttendanceCommitIn, AttendanceBulkCommitIn,
+    AttendanceBulkRevertIn, MAX_BULK_REVERT_LESSONS,
     AttendanceOut,LessonParticipantSerializer
 )
 from .utils import (
-    get_student_deduct, find_teacher_or_room_conflicts, student_has_conflict,
-    capacity_default, capacity_max, dt_combine, check_balance_sufficient, apply_deduction, revert_deduction,
-    round_to_half_hours
+    find_teacher_or_room_conflicts, find_students_conflicts,
+    capacity_default, capacity_max, dt_combine
+)
+from .attendance import commit_attendance, revert_attendance, AttendanceConflict
+from .timetable import get_day_payloads, filter_day_payloads, expand_lesson, iter_lesson_lines, NDJSONRenderer
+from .versioning import (
+    TIMETABLE, bump_version, get_version, make_etag, etag_matches, not_modified, with_etag
 )
 
 User = get_user_model()
@@ -134,101 +138,43 @@ class TeacherList(APIView):
 
 class LessonsView(APIView):
     permission_classes = [IsAuthenticated]
+    # ?format=ndjson：逐行流式输出（整学期等大范围查询）
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [NDJSONRenderer]
 
     def get(self, request):
         s = LessonsQuery(data=request.query_params)
         s.is_valid(raise_exception=True)
         v = s.validated_data
 
-        qs = (
-            Lesson.objects
-            .filter(
-                class_group__term_id=v['term_id'],
-                date__gte=v['date_from'],
-                date__lte=v['date_to']
+        # ETag：课表版本号 + 查询参数；未变化直接 304，不组装响应体
+        version = get_version(TIMETABLE)
+        etag = make_etag('lessons', version, sorted(request.query_params.lists()))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
+        if request.accepted_renderer.format == 'ndjson':
+            resp = StreamingHttpResponse(
+                iter_lesson_lines(v['term_id'], v['date_from'], v['date_to'], grades=v.get('grades'),
+                                  teachers=v.get('teachers'), subjects=v.get('subjects')),
+                content_type='application/x-ndjson; charset=utf-8',
             )
-            .exclude(status='canceled')
-            .select_related('class_group', 'class_group__subject', 'teacher', 'room')
-            .order_by('date', 'start_time', 'id')
-        )
+            return with_etag(resp, etag)
 
-        # 过滤条件保持不变
-        if v.get('grades'):
-            qs = qs.filter(class_group__grade__in=v['grades'])
-        if v.get('teachers'):
-            qs = qs.filter(teacher_id__in=v['teachers']) | qs.filter(class_group__teacher_main_id__in=v['teachers'])
-        if v.get('subjects'):
-            qs = qs.filter(class_group__subject_id__in=v['subjects'])
-
-        # —— 批量取当页涉及的班级与课次 ——
-        cg_ids = set(qs.values_list('class_group_id', flat=True))
-        lesson_ids = set(qs.values_list('id', flat=True))
-
-        # —— 一次性取出“全部学生”（在读）：构建 {cg_id: [ {id, name}, ... ]} ——
-        from collections import defaultdict
-        by_cg_students = defaultdict(list)
-        if cg_ids:
-            enroll_rows = (
-                ClassEnrollment.objects
-                .filter(class_group_id__in=cg_ids, left_at__isnull=True)
-                .select_related('student')
-                .values('class_group_id', 'student_id', 'student__name')
-                .order_by('id')
-            )
-            for row in enroll_rows:
-                by_cg_students[row['class_group_id']].append(
-                    {'id': row['student_id'], 'name': row['student__name'] or ''}
-                )
-
-        # —— 批量统计请假数，避免循环 count ——
-        from django.db.models import Count
-        leaves_map = {lid: 0 for lid in lesson_ids}
-        if lesson_ids:
-            for r in (LessonLeave.objects
-                      .filter(lesson_id__in=lesson_ids)
-                      .values('lesson_id')
-                      .annotate(cnt=Count('id'))):
-                leaves_map[r['lesson_id']] = r['cnt']
-
-        # —— 组装返回（新增 roster 完整数组；保留 roster_preview/roster_count/enrolled）——
-        data = []
-        for les in qs:
-            cg = les.class_group
-            teacher = les.teacher or cg.teacher_main
-            room = les.room or cg.room_default
-
-            roster = by_cg_students.get(cg.id, [])               # 全量学生 [{id,name}, ...]
-            roster_count = len(roster)
-            roster_preview = [s['name'] for s in roster][:5]
-            leave_count = leaves_map.get(les.id, 0)
-
-            data.append({
-                'id': les.id,
-                'class_group_id': cg.id,
-                'title': f'{cg.name or ""}{cg.subject.name}-{cg.course_mode}',
-                'date': str(les.date),
-                'start_time': str(les.start_time),
-                'end_time': str(les.end_time),
-                'duration': les.duration_minutes,
-                'grade': cg.grade,
-                'course_mode': cg.course_mode,
-                'subject': cg.subject.name,
-                'room': (room.name if room else None),
-                'teacher': (getattr(teacher, 'name', None) or getattr(teacher, 'username', None)),
-
-                # ✅ 新增：完整学生数组（全量）
-                'roster': roster,                  # [{id, name}, ...]
-
-                # 兼容 & 汇总
-                'roster_preview': roster_preview,  # 预览（前5个名字）
-                'roster_count': roster_count,      # 总人数
-                'enrolled': roster_count,          # 保持前端已用的字段
-                'capacity': cg.capacity,           # small_class 为 null
-                'leave_count': leave_count,
-                'status': les.status,
-            })
+        # 按 (term, date) 读快照缓存，未命中的天一次性从库里组装；过滤在内存完成
+        rows, class_groups = get_day_payloads(v['term_id'], v['date_from'], v['date_to'], version=version)
+        lessons = filter_day_payloads(rows, grades=v.get('grades'), teachers=v.get('teachers'),
+                                      subjects=v.get('subjects'))
 
-        return ok(data)
+        # ?shape=normalized：课次只引用 class_group_id，名册/科目/老师/教室在 class_groups 中各出现一次
+        if v.get('shape') == 'normalized':
+            used = {les['class_group_id'] for les in lessons}
+            return with_etag(ok({
+                'lessons': lessons,
+                'class_groups': {str(cg_id): class_groups[cg_id] for cg_id in used},
+            }), etag)
+
+        data = [expand_lesson(les, class_groups[les['class_group_id']]) for les in lessons]
+        return with_etag(ok(data), etag)
 
 
 # --------- 班级 ---------
@@ -253,6 +199,22 @@ class ClassGroupListCreate(APIView):
         return ok(ClassGroupOut(cg).data, '创建成功')
 
 
+class ClassGroupPreview(APIView):
+    """
+    POST /api/schedule/class-groups/preview
+    body 同创建班级；只展开规则并返回课次与按日期的冲突清单，不写库
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if not user_has_role(request.user, ['admin', 'teacher_manager']):
+            return bad('无权限', 403)
+        s = ClassGroupCreateIn(data=request.data)
+        s.is_valid(raise_exception=True)
+        data = s.preview()
+        return ok(data, '存在冲突' if data['conflicts'] else '无冲突')
+
+
 class ClassGroupEnroll(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -282,29 +244,21 @@ class ClassGroupEnroll(APIView):
             if cap is not None and (curr + len(student_ids) > cap):
                 return bad(f'容量超限：当前{curr}，新增{len(student_ids)}，上限{cap}')
 
-            # 冲突校验：学生时间撞课
-            conflicts = {}
-            sample_lesson = cg.lessons.first()
-            for sid in student_ids:
-                # 遍历本班全部课次，任一重叠即冲突
-                hit = False
-                for les in cg.lessons.exclude(status='canceled'):
-                    if student_has_conflict(sid, les, cg.id):
-                        conflicts.setdefault(str(sid), []).append(les.id)
-                        hit = True
-                        break
-                if hit:
-                    continue
-
+            # 冲突校验：学生时间撞课（批量冲突矩阵，返回每个学生的全部冲突课次）
+            conflicts = {str(sid): lesson_ids
+                         for sid, lesson_ids in find_students_conflicts(student_ids, cg.id).items()}
             if conflicts:
                 return Response({'code': 400, 'message': '学生时间冲突', 'data': conflicts}, status=400)
 
-            # 写入关系
-            created = 0
-            for sid in student_ids:
-                obj, created_flag = ClassEnrollment.objects.get_or_create(student_id=sid, class_group=cg,
-                                                                          left_at__isnull=True)
-                if created_flag: created += 1
+            # 写入关系（已在班的跳过）
+            existing = set(ClassEnrollment.objects.filter(class_group=cg, student_id__in=student_ids,
+                                                          left_at__isnull=True)
+                           .values_list('student_id', flat=True))
+            new_ids = [sid for sid in dict.fromkeys(student_ids) if sid not in existing]
+            ClassEnrollment.objects.bulk_create([ClassEnrollment(student_id=sid, class_group=cg) for sid in new_ids])
+            created = len(new_ids)
+            if created:
+                bump_version(TIMETABLE)
 
         return ok({'created': created}, '加入成功')
 
@@ -324,6 +278,8 @@ class ClassGroupUnenroll(APIView):
         student_ids = s.validated_data['student_ids']
         n = ClassEnrollment.objects.filter(class_group=cg, student_id__in=student_ids, left_at__isnull=True) \
             .update(left_at=timezone.now())
+        if n:
+            bump_version(TIMETABLE)
         return ok({'updated': n}, '移除成功')
 
 
@@ -416,6 +372,20 @@ class LessonLeaveView(APIView):
 
 
 # --------- 签到/消课（课后；一键支持 all_present） ---------
+def attendance_commit_gate(user, les):
+    """课次能否由该用户提交签到：可以返回 None，否则返回 (message, code)"""
+    # 权限：任课老师/teacher_manager/admin
+    teacher_id = (les.teacher_id or les.class_group.teacher_main_id)
+    if not (is_admin(user) or user_has_role(user, ['teacher_manager']) or user.id == teacher_id):
+        return '无权限：仅任课老师/teacher_manager/admin 可提交', 403
+    # 时间限制：仅课后
+    if timezone.now() <= dt_combine(les.date, les.end_time):
+        return '尚未到下课时间，不能提交签到', 400
+    if les.lock_attendance:
+        return '已提交过签到，无法重复提交', 400
+    return None
+
+
 class AttendanceCommitView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -453,95 +423,77 @@ class AttendanceCommitView(APIView):
         except Lesson.DoesNotExist:
             return bad('课次不存在', 404)
 
-        teacher_id = (les.teacher_id or les.class_group.teacher_main_id)
-        if not (is_admin(request.user) or user_has_role(request.user,
-                                                        ['teacher_manager']) or request.user.id == teacher_id):
-            return bad('无权限：仅任课老师/teacher_manager/admin 可提交', 403)
-
-        # 时间限制：仅课后
-        if timezone.now() <= dt_combine(les.date, les.end_time):
-            return bad('尚未到下课时间，不能提交签到', 400)
-
-        if les.lock_attendance:
-            return bad('已提交过签到，无法重复提交', 400)
+        gate = attendance_commit_gate(request.user, les)
+        if gate:
+            return bad(*gate)
 
         s = AttendanceCommitIn(data=request.data)
         s.is_valid(raise_exception=True)
         v = s.validated_data
 
-        # 学生清单
-        members = list(
-            ClassEnrollment.objects.filter(class_group=les.class_group, left_at__isnull=True).values_list('student_id',
-                                                                                                          flat=True))
-        if not members:
-            return bad('班内无学生', 400)
-
-        # 已请假
-        pre_leaves = set(
-            LessonLeave.objects.filter(lesson=les, student_id__in=members).values_list('student_id', flat=True))
-
-        # 组装最终状态
-        final = {sid: ('leave' if sid in pre_leaves else 'absent') for sid in members}
-
-        # 一键签到：全部置为 present（已请假的仍保持 leave）
-        if v.get('all_present'):
-            for sid in members:
-                if sid not in pre_leaves:
-                    final[sid] = 'present'
-
-        # 明细覆盖
-        items = v.get('items') or []
-        for it in items:
-            sid = it['student_id']
-            if sid in final:
-                final[sid] = it['status']
-
-        # 扣课口径
-        unit, qty = get_student_deduct(les.class_group.course_mode, les.duration_minutes)
-
-        # 预检余额（仅 present）
-        insufficient = []
-        for sid, st in final.items():
-            if st == 'present' and not check_balance_sufficient(sid, les.class_group.course_mode, unit, qty):
-                insufficient.append(sid)
-        if insufficient:
-            return Response({'code': 400, 'message': '部分学生余额不足', 'data': {'insufficient': insufficient}},
-                            status=400)
-
-        # 入库：Attendance + 扣课 + 工时（事务）
-        with transaction.atomic():
-            records = []
-            for sid, st in final.items():
-                paid_used = gift_used = None
-                deduct_from = None
-                if st == 'present':
-                    paid_used, gift_used, deduct_from = apply_deduction(sid, les.class_group.course_mode, unit, qty)
-                att = Attendance.objects.create(
-                    lesson=les, student_id=sid, status=st,
-                    deduct_unit=(unit if st == 'present' else None),
-                    deduct_qty=(qty if st == 'present' else None),
-                    deduct_from=deduct_from,
-                    paid_used=paid_used, gift_used=gift_used,
-                    operator=request.user, confirmed_at=timezone.now()
-                )
-                records.append(att.id)
-
-            # 工时：小班=2小时；其它按时长（四舍五入0.5）
-            work_hours = Decimal('2.00') if les.class_group.course_mode == 'small_class' else round_to_half_hours(
-                les.duration_minutes)
-            TeacherWorklog.objects.update_or_create(
-                lesson=les, teacher_id=teacher_id,
-                defaults={'work_hours': work_hours,
-                          'rule_code': ('small_class_x2' if les.class_group.course_mode == 'small_class' else 'normal')}
-            )
-
-            les.status = 'finished'
-            les.lock_attendance = True
-            les.save(update_fields=['status', 'lock_attendance'])
+        # 批量流水线：在班/请假/账户各一次查询，余额内存预检，扣课与写入为固定条数语句
+        try:
+            errors, ids = commit_attendance([les], {les.id: v}, request.user)
+        except AttendanceConflict as e:
+            # 预检之后被并发写入抢先（课次已被别人提交 / 余额被改）：409，前端刷新名单后再处理
+            return bad(str(e), 409)
+        if errors:
+            e = errors[les.id]
+            if 'insufficient' in e:
+                return Response({'code': 400, 'message': e['message'], 'data': {'insufficient': e['insufficient']}},
+                                status=400)
+            return bad(e['message'], 400)
+        records = ids[les.id]
 
         return ok({'attendance_ids': records}, '签到已提交')
 
 
+class AttendanceBulkCommitView(APIView):
+    """
+    多课次一次提交签到（老师一天 / 校区一天）
+    POST /api/schedule/lessons/attendance/bulk
+      {"lessons": [{"lesson_id": 1, "all_present": true, "items": [{"student_id": 3, "status": "absent"}]}, ...]}
+    - 先逐课次校验（存在、权限、已下课、未提交、班内有学生、余额），任一课次不通过则整批不写，返回各课次结果
+    - 全部通过后在一个事务里批量扣课、写出勤、写工时（同一学生跨课次的扣课按上课先后累计）
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        s = AttendanceBulkCommitIn(data=request.data)
+        s.is_valid(raise_exception=True)
+        payloads = {}
+        for it in s.validated_data['lessons']:
+            payloads[it.pop('lesson_id')] = it
+
+        lessons = {les.id: les for les in Lesson.objects.select_related('class_group').filter(id__in=list(payloads))}
+        errors = {}
+        for lid in payloads:
+            les = lessons.get(lid)
+            gate = ('课次不存在', 404) if les is None else attendance_commit_gate(request.user, les)
+            if gate:
+                errors[lid] = {'message': gate[0]}
+
+        ids = {}
+        if not errors:
+            try:
+                errors, ids = commit_attendance(list(lessons.values()), payloads, request.user)
+            except AttendanceConflict as e:
+                return bad(str(e), 409)
+
+        results = []
+        for lid in payloads:
+            if lid in errors:
+                results.append({'lesson_id': lid, 'ok': False, **errors[lid]})
+            elif errors:
+                results.append({'lesson_id': lid, 'ok': False, 'message': '同批其它课次未通过校验，未提交'})
+            else:
+                results.append({'lesson_id': lid, 'ok': True, 'attendance_ids': ids[lid]})
+        if errors:
+            return Response({'code': 400, 'message': f'{len(errors)} 个课次未通过校验，整批未提交',
+                             'data': {'results': results}}, status=400)
+        return ok({'results': results}, f'已提交 {len(results)} 个课次的签到')
+
+
 class AttendanceRevertView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -556,24 +508,54 @@ class AttendanceRevertView(APIView):
         if not les.lock_attendance:
             return bad('该课次尚未提交签到', 400)
 
-        atts = list(Attendance.objects.filter(lesson=les))
-        with transaction.atomic():
-            # 回滚扣课
-            for a in atts:
-                if a.status == 'present':
-                    revert_deduction(a.student_id, les.class_group.course_mode, a.deduct_unit,
-                                     a.paid_used or Decimal('0.00'), a.gift_used or Decimal('0.00'))
-            # 删除出勤记录
-            Attendance.objects.filter(lesson=les).delete()
-            # 删除工时
-            TeacherWorklog.objects.filter(lesson=les).delete()
-            # 课次状态回滚
-            les.status = 'scheduled'
-            les.lock_attendance = False
-            les.save(update_fields=['status', 'lock_attendance'])
+        try:
+            revert_attendance([les.id])
+        except AttendanceConflict:
+            return bad('该课次尚未提交签到', 400)
 
         return ok(message='已撤销消课')
 
+
+class AttendanceBulkRevertView(APIView):
+    """
+    批量撤销消课（整周提交错误、事后取消上课日等），仅 admin
+    POST /api/schedule/lessons/attendance/revert/bulk
+      {"lesson_ids": [1, 2]} | {"class_group_id": 3, "date_from"?, "date_to"?} | {"date_from", "date_to", "campus_id"?}
+    范围内已提交签到的课次一次撤销：按账户聚合回补课时，出勤/工时批量删除；未提交的课次忽略
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        if not is_admin(request.user):
+            return bad('无权限：仅 admin 可撤销消课', 403)
+        s = AttendanceBulkRevertIn(data=request.data)
+        s.is_valid(raise_exception=True)
+        v = s.validated_data
+
+        qs = Lesson.objects.filter(lock_attendance=True)
+        if v.get('lesson_ids'):
+            qs = qs.filter(id__in=v['lesson_ids'])
+        if v.get('class_group_id'):
+            qs = qs.filter(class_group_id=v['class_group_id'])
+        if v.get('campus_id'):
+            qs = qs.filter(campus_id=v['campus_id'])
+        if v.get('date_from'):
+            qs = qs.filter(date__gte=v['date_from'])
+        if v.get('date_to'):
+            qs = qs.filter(date__lte=v['date_to'])
+        lesson_ids = list(qs.order_by('date', 'start_time', 'id').values_list('id', flat=True)[:MAX_BULK_REVERT_LESSONS + 1])
+        if not lesson_ids:
+            return bad('范围内没有已提交签到的课次', 400)
+        if len(lesson_ids) > MAX_BULK_REVERT_LESSONS:
+            return bad(f'范围内超过 {MAX_BULK_REVERT_LESSONS} 个课次，请缩小范围', 400)
+
+        try:
+            summary = revert_attendance(lesson_ids)
+        except AttendanceConflict as e:
+            return bad(str(e), 409)
+        return ok(dict(summary, lesson_ids=lesson_ids), f"已撤销 {summary['lessons']} 个课次的消课")
+
+
 class StudentSearchView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -588,9 +570,9 @@ class StudentSearchView(APIView):
         except Exception:
             page_size = 20
 
-        qs = Student.objects.all().order_by('id')
-        if q:
-            qs = qs.filter(name__icontains=q)
+        from students.models import Student
+        from students.search import search_students
+        qs = search_students(Student.objects.all(), q).order_by('id')
 
         total = qs.count()
         start = (page - 1) * page_size
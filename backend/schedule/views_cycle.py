@@ -1,8 +1,11 @@
-from datetime import date, datetime, timedelta
+import base64
+import json
+from datetime import timedelta
 from collections import defaultdict
+from django.core import signing
+from django.core.cache import cache
 from django.db import transaction
 from django.db.models import Q
-from django.utils import timezone
 
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
@@ -10,8 +13,8 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from .models import (
-    Campus, Cycle, CycleRoster, CyclePublishLog, CyclePublishItem,
-    ClassGroup, Lesson, LessonParticipant , CyclePreplanSlot
+    Campus, Cycle, CycleRoster, CyclePublishLog, CyclePublishJob,
+    ClassGroup, Lesson, CyclePreplanSlot
 )
 from .serializers_cycle import (
     CampusSerializer, CycleSerializer, CycleRosterSerializer,
@@ -19,6 +22,15 @@ from .serializers_cycle import (
     CyclePreplanSlotSerializer
 )
 from .constants import TIME_SLOTS, SMALL_CLASS, NON_SMALL
+from .publishing import (
+    build_date_maps, compute_publish_plan, apply_publish_changes,
+    plan_fingerprint, dump_plan, load_plan, make_plan_token, read_plan_token
+)
+from .preplan import solve_cycle, apply_assignment, preplan_conflicts, DEFAULT_MAX_BACKTRACKS
+from .versioning import (
+    TIMETABLE, PREPLAN, cycle_roster_scope, get_versions,
+    make_etag, etag_matches, not_modified, with_etag
+)
 
 def ok(data=None, message='OK', code=0, http=200):
     return Response({'code': code, 'message': message, 'data': data}, status=http)
@@ -69,6 +81,11 @@ class CycleBoardView(APIView):
         cycle = Cycle.objects.filter(pk=pk).first()
         if not cycle: return err('cycle not found', 404, 404)
 
+        # ETag：周期 updated_at + 课表版本号
+        etag = make_etag('board', cycle.id, cycle.updated_at.isoformat(), get_versions(TIMETABLE))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
         # 列：date_from ~ date_to
         dates = []
         d = cycle.date_from
@@ -76,23 +93,11 @@ class CycleBoardView(APIView):
             dates.append(str(d))
             d += timedelta(days=1)
 
-        # 拉取该校区范围内的课次
-        # 校区判断：优先 Lesson.room.campus；否则回退 class_group.room_default.campus
+        # 拉取该校区范围内的课次（Lesson.campus 为冗余的生效校区，走 (campus, date, status) 索引）
         lessons = (Lesson.objects
-            .filter(date__gte=cycle.date_from, date__lte=cycle.date_to)
+            .filter(campus_id=cycle.campus_id, date__gte=cycle.date_from, date__lte=cycle.date_to)
             .filter(status='scheduled')
-            .select_related('class_group','teacher','room','class_group__room_default'))
-
-        # 过滤校区
-        def _lesson_in_campus(lesson):
-            c = None
-            if lesson.room and lesson.room.campus_id:
-                c = lesson.room.campus_id
-            elif lesson.class_group and lesson.class_group.room_default and lesson.class_group.room_default.campus_id:
-                c = lesson.class_group.room_default.campus_id
-            return c == cycle.campus_id
-
-        lessons = [l for l in lessons if _lesson_in_campus(l)]
+            .select_related('class_group', 'class_group__subject', 'teacher'))
 
         # 时间档归类
         def _bucket_key(cg_mode, start, end):
@@ -129,12 +134,12 @@ class CycleBoardView(APIView):
                 "days": { d: day_map.get(d, []) for d in dates }
             })
 
-        return ok({
+        return with_etag(ok({
             "dates": dates,
             "rows": rows,
             "pattern": cycle.pattern,
             "rest_weekday": cycle.rest_weekday
-        })
+        }), etag)
 
 # === 周期名册：查询/新增/删除 ===
 class CycleRosterView(APIView):
@@ -192,165 +197,139 @@ class CyclePublishView(APIView):
         # 映射：
         #   map: {"Mon":["2025-10-01"], "Fri":["2025-10-02", ...]}
         #   tracks: {"A": {...}, "B": {...}}  # 可选
+        #   map: "auto" → 由 Cycle.pattern 在服务端展开（可带 exclude 节假日、until 截止日）
         map_ = body.get('map') or {}
-        tracks = body.get('tracks') or {}
-
-        # 计算目标自然日集合（按 scope 过滤今天/之后）
-        today = timezone.localdate()
-        def _valid_date(s):
-            try:
-                d = date.fromisoformat(s)
-                return d if (scope=='include_today' and d>=cycle.date_from) or (scope=='future_only' and d>=max(today, cycle.date_from)) else None
-            except Exception:
-                return None
-
-        # 构造 源列(周几)→目标自然日 集合
-        weekday_map = defaultdict(list)  # "Mon"..."Sun"
-        for w, arr in (map_ or {}).items():
-            for s in (arr or []):
-                d = _valid_date(s)
-                if d: weekday_map[w].append(d)
-
-        # tracks 覆盖（暑/寒）
-        tracks_map = {}
-        for trk, m in (tracks or {}).items():
-            mm = defaultdict(list)
-            for w, arr in (m or {}).items():
-                for s in (arr or []):
-                    d = _valid_date(s)
-                    if d: mm[w].append(d)
-            tracks_map[trk] = mm
-
-        # 拉出本周期相关 roster
-        rosters = list(CycleRoster.objects.filter(cycle=cycle)
-                       .select_related('class_group','student'))
-
-        # 目标：生成 (lesson_id, student_id, roster_id) 列表
-        added, removed, missing = [], [], []
-
-        # 预先拉出目标区间内的 lesson（按校区过滤）
-        def _in_campus(lesson):
-            c = lesson.room.campus_id if (lesson.room and lesson.room.campus_id) else (
-                lesson.class_group.room_default.campus_id if (lesson.class_group and lesson.class_group.room_default and lesson.class_group.room_default.campus_id) else None
+        if map_ == 'auto':
+            payload = {'map': 'auto', 'exclude': body.get('exclude') or [], 'until': body.get('until')}
+        else:
+            payload = {'map': map_, 'tracks': body.get('tracks') or {}}
+
+        # 异步：大周期交给 run_publish_jobs 后台执行，立即返回任务号
+        if not dry_run and body.get('async'):
+            job = CyclePublishJob.objects.create(
+                cycle=cycle, scope=scope, mode=mode, payload=payload, created_by=request.user
             )
-            return c == cycle.campus_id
-
-        # 目标日全集（用于一次性拉 lesson 做匹配）
-        all_target_dates = set()
-        for arr in weekday_map.values(): all_target_dates.update(arr)
-        for mm in tracks_map.values():
-            for arr in mm.values(): all_target_dates.update(arr)
-
-        lessons_qs = Lesson.objects.filter(
-            date__in=list(all_target_dates),
-            status='scheduled'
-        ).select_related('class_group','room','class_group__room_default')
-        lessons = [l for l in lessons_qs if _in_campus(l)]
-
-        # 索引：班级+日期 → lesson 列表（一个日期可能多节不同时间档）
-        by_cg_date = defaultdict(list)
-        for l in lessons:
-            by_cg_date[(l.class_group_id, l.date)].append(l)
-
-        # 周几工具
-        def _weekday_name(d: date):
-            # 与前端约定：Mon,Tue,Wed,Thu,Fri,Sat,Sun
-            return ['Mon','Tue','Wed','Thu','Fri','Sat','Sun'][d.weekday()]
-
-        # 现存由本周期发布产生的明细（用于差异删除）
-        existing_items = {(it.lesson_id, it.student_id): it
-                          for it in CyclePublishItem.objects.filter(cycle=cycle)}
-
-        # 目标集：本次应存在的 (lesson_id, student_id) 集合
-        target_pairs = set()
-
-        # 组装目标
-        for r in rosters:
-            # 选择映射表：有 track 用 tracks_map[track]，否则 weekday_map
-            use_map = tracks_map.get(r.track) if r.track in tracks_map else weekday_map
-
-            # 周期的“源列”= 周一~周日。我们以“周几 → 目标自然日”一一映射
-            # 遍历目标自然日集合，挑选同一 weekday 源列的映射
-            # 注意：这里不强制 1→1，允许 1→多（你已确认）
-            for w, target_dates in use_map.items():
-                for d0 in target_dates:
-                    # 找到该班级在 d0 的所有 lesson
-                    ls = by_cg_date.get((r.class_group_id, d0), [])
-                    if not ls:
-                        missing.append({'date': str(d0), 'class_group_id': r.class_group_id})
-                        continue
-                    for l in ls:
-                        target_pairs.add((l.id, r.student_id))
-
-        # 差异：need_add / need_remove（仅针对本周期创建过的）
-        existing_pairs = set(existing_items.keys())
-        need_add = target_pairs - existing_pairs
-        need_remove = existing_pairs - target_pairs  # 仅删“本周期生成的”，不会动手工/其它周期
-
-        # dry-run 直接返回
+            return ok({'job_id': job.id, 'status': job.status}, 'queued', http=202)
+
+        # 执行预演过的计划：指纹未变则直接写入预演时的差异，不再重算
+        plan_token = body.get('plan_token')
+        if not dry_run and plan_token:
+            return self._apply_plan_token(request, cycle, plan_token)
+
+        fingerprint = plan_fingerprint(cycle, scope, payload)  # 先取指纹：计算期间若有写入，令牌随即失效
+        weekday_map, tracks_map = build_date_maps(cycle, scope, payload)
+        plan = compute_publish_plan(cycle, weekday_map, tracks_map)
+        missing = plan['missing']
+
+        # dry-run：保存差异并签发计划令牌
         if dry_run:
             stats = {
-                'add': len(need_add),
-                'remove': len(need_remove),
+                'add': len(plan['need_add']),
+                'remove': len(plan['need_remove']),
                 'missing_lessons': missing,
             }
-            # 记录一次预演日志（可选）
             log = CyclePublishLog.objects.create(
-                cycle=cycle, scope=scope, mode=mode, payload={'map': map_, 'tracks': tracks},
+                cycle=cycle, scope=scope, mode=mode, payload={**payload, 'plan': dump_plan(plan)},
                 diff_stats=stats, published_by=request.user
             )
-            return ok({'log_id': log.id, **stats}, 'dry-run')
+            return ok({'log_id': log.id, 'plan_token': make_plan_token(log, fingerprint), **stats}, 'dry-run')
 
-        # 执行
+        # 执行（批量写入）
         with transaction.atomic():
-            # 新增
-            for (lesson_id, student_id) in need_add:
-                # 查 roster（用于反查 type/track）
-                r = next((x for x in rosters if x.student_id == student_id and
-                          any(lesson_id in [ll.id for ll in by_cg_date.get((x.class_group_id, d), [])]
-                              for dlist in (weekday_map.values() if x.track not in tracks_map else tracks_map[x.track].values())
-                              for d in dlist)), None)
-                r_type = r.type if r else CycleRoster.TYPE_NORMAL
-                lp_type = LessonParticipant.TYPE_TRIAL if r_type == CycleRoster.TYPE_TRIAL else LessonParticipant.TYPE_TEMP
-
-                # 幂等创建 participant
-                lp, _ = LessonParticipant.objects.get_or_create(
-                    lesson_id=lesson_id, student_id=student_id,
-                    defaults={'type': lp_type, 'created_by': request.user}
-                )
-                # 记录发布明细
-                CyclePublishItem.objects.create(
-                    cycle=cycle, roster=r, lesson_id=lesson_id, student_id=student_id,
-                    participant=lp, type=r_type, track=(r.track if r else None)
-                )
-                added.append({'lesson_id': lesson_id, 'student_id': student_id})
-
-            # 删除（只删本周期生成的明细）
-            for (lesson_id, student_id) in need_remove:
-                item = existing_items.get((lesson_id, student_id))
-                if item and item.participant_id:
-                    # 仅当 participant 仍存在且没有被其它周期/手工引用（我们只记录一条）
-                    LessonParticipant.objects.filter(id=item.participant_id).delete()
-                if item:
-                    item.delete()
-                removed.append({'lesson_id': lesson_id, 'student_id': student_id})
+            added, removed = apply_publish_changes(
+                cycle, plan, plan['need_add'], plan['need_remove'], request.user
+            )
+            stats = {
+                'add': len(added),
+                'remove': len(removed),
+                'missing_lessons': missing,
+            }
+            CyclePublishLog.objects.create(
+                cycle=cycle, scope=scope, mode=mode, payload=payload,
+                diff_stats=stats, published_by=request.user
+            )
 
+        return ok({'added': added, 'removed': removed, 'missing_lessons': missing}, 'published')
+
+    def _apply_plan_token(self, request, cycle, plan_token):
+        try:
+            token = read_plan_token(plan_token)
+        except signing.BadSignature:
+            return err('invalid or expired plan_token', 400, 400)
+        preview = CyclePublishLog.objects.filter(pk=token.get('log'), cycle=cycle).first()
+        if not preview or 'plan' not in (preview.payload or {}):
+            return err('plan not found for this cycle', 400, 400)
+
+        payload = {k: v for k, v in preview.payload.items() if k != 'plan'}
+        missing = (preview.diff_stats or {}).get('missing_lessons', [])
+        with transaction.atomic():
+            if plan_fingerprint(cycle, preview.scope, payload) != token.get('fp'):
+                return err('roster, lessons or published items changed since the dry run; preview again',
+                           409, 409)
+            plan = load_plan(preview.payload['plan'], cycle)
+            added, removed = apply_publish_changes(
+                cycle, plan, plan['need_add'], plan['need_remove'], request.user
+            )
             stats = {
                 'add': len(added),
                 'remove': len(removed),
                 'missing_lessons': missing,
+                'plan_log_id': preview.id,
             }
             CyclePublishLog.objects.create(
-                cycle=cycle, scope=scope, mode=mode, payload={'map': map_, 'tracks': tracks},
+                cycle=cycle, scope=preview.scope, mode=preview.mode, payload=payload,
                 diff_stats=stats, published_by=request.user
             )
 
         return ok({'added': added, 'removed': removed, 'missing_lessons': missing}, 'published')
 
+
+class CyclePublishJobView(APIView):
+    """GET 后台发布任务进度"""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        if not require_manager(request.user):
+            return err('permission denied', 403, 403)
+        job = CyclePublishJob.objects.filter(pk=pk).first()
+        if not job: return err('job not found', 404, 404)
+        return ok({
+            'id': job.id,
+            'cycle_id': job.cycle_id,
+            'status': job.status,
+            'total': job.total_pairs,
+            'processed': job.processed_pairs,
+            'remaining': max(0, job.total_pairs - job.processed_pairs),
+            'errors': job.errors or [],
+            'attempts': job.attempts,
+            'log_id': job.log_id,
+            'created_at': job.created_at,
+            'started_at': job.started_at,
+            'finished_at': job.finished_at,
+        })
+
+ROSTER_COUNT_CACHE_TIMEOUT = 60 * 10  # 秒；名册/班级写入、学生改名都会换版本号，超时只是回收过期键
+
+
+def _encode_roster_cursor(r) -> str:
+    raw = json.dumps([r.class_group_id, r.student.name, r.id], ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _decode_roster_cursor(token: str):
+    """返回 (class_group_id, student_name, roster_id)；格式不对抛 ValueError"""
+    raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    cg_id, name, rid = json.loads(raw.decode('utf-8'))
+    return int(cg_id), str(name), int(rid)
+
+
 class CycleMasterRosterView(APIView):
     """
     GET /api/schedule/cycle-schedule/cycles/{cycle_id}/roster
     聚合该周期下所有班级名册，支持筛选与分页。
+    - ?page=N：偏移分页（兼容旧前端）
+    - ?cursor=<next>：游标分页，按 (class_group_id, student__name, id) 续读，任意深度耗时一致；首页传空 cursor
+    - count 按 (周期, 筛选条件) 缓存，名册/班级写入或学生改名后版本号变化即失效
     """
     permission_classes = [IsAuthenticated]
 
@@ -361,6 +340,12 @@ class CycleMasterRosterView(APIView):
 
         q = request.query_params
 
+        # ETag：该周期名册版本 + 课表版本（班级/科目名）+ 查询参数
+        versions = get_versions(cycle_roster_scope(cycle_id), TIMETABLE)
+        etag = make_etag('master_roster', cycle_id, versions, sorted(q.lists()))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
         # 基础查询
         qs = (CycleRoster.objects
               .filter(cycle_id=cycle_id)
@@ -372,39 +357,67 @@ class CycleMasterRosterView(APIView):
               ))
 
         # 过滤项
-        if q.get('class_group'):
-            qs = qs.filter(class_group_id=q.get('class_group'))
-        if q.get('subject'):
-            qs = qs.filter(class_group__subject_id=q.get('subject'))
-        if q.get('teacher'):
-            qs = qs.filter(class_group__teacher_main_id=q.get('teacher'))
-        if q.get('course_mode'):
-            qs = qs.filter(class_group__course_mode=q.get('course_mode'))
-        if q.get('grade'):
-            qs = qs.filter(class_group__grade=q.get('grade'))
-        if q.get('track'):
-            qs = qs.filter(track=q.get('track'))
-        if q.get('type'):
-            qs = qs.filter(type=q.get('type'))
-        if q.get('q'):
-            qs = qs.filter(student__name__icontains=q.get('q'))
+        filters = {}
+        for key in ('class_group', 'subject', 'teacher', 'course_mode', 'grade', 'track', 'type', 'q'):
+            if q.get(key):
+                filters[key] = q.get(key)
+        if filters.get('class_group'):
+            qs = qs.filter(class_group_id=filters['class_group'])
+        if filters.get('subject'):
+            qs = qs.filter(class_group__subject_id=filters['subject'])
+        if filters.get('teacher'):
+            qs = qs.filter(class_group__teacher_main_id=filters['teacher'])
+        if filters.get('course_mode'):
+            qs = qs.filter(class_group__course_mode=filters['course_mode'])
+        if filters.get('grade'):
+            qs = qs.filter(class_group__grade=filters['grade'])
+        if filters.get('track'):
+            qs = qs.filter(track=filters['track'])
+        if filters.get('type'):
+            qs = qs.filter(type=filters['type'])
+        if filters.get('q'):
+            qs = qs.filter(student__name__icontains=filters['q'])
+
+        # 总数：按筛选条件缓存（翻页不再重复 count）
+        count_key = 'schedule:roster_count:%s:%s' % (cycle_id, make_etag(versions, sorted(filters.items())).strip('"'))
+        total = cache.get(count_key)
+        if total is None:
+            total = qs.count()
+            cache.set(count_key, total, ROSTER_COUNT_CACHE_TIMEOUT)
 
         # 排序（班级 → 学生名）
         qs = qs.order_by('class_group_id', 'student__name', 'id')
 
         # 分页
-        try:
-            page = max(1, int(q.get('page', 1)))
-        except Exception:
-            page = 1
         try:
             page_size = max(1, min(100, int(q.get('page_size', 20))))
         except Exception:
             page_size = 20
 
-        total = qs.count()
-        start = (page - 1) * page_size
-        rows = qs[start:start + page_size]
+        if 'cursor' in q:
+            page = None
+            if q.get('cursor'):
+                try:
+                    cg_id, name, rid = _decode_roster_cursor(q.get('cursor'))
+                except Exception:
+                    return err('invalid cursor', 400, 400)
+                qs = qs.filter(
+                    Q(class_group_id__gt=cg_id)
+                    | Q(class_group_id=cg_id, student__name__gt=name)
+                    | Q(class_group_id=cg_id, student__name=name, id__gt=rid)
+                )
+            rows = list(qs[:page_size + 1])
+        else:
+            try:
+                page = max(1, int(q.get('page', 1)))
+            except Exception:
+                page = 1
+            start = (page - 1) * page_size
+            rows = list(qs[start:start + page_size + 1])
+
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        next_cursor = _encode_roster_cursor(rows[-1]) if has_more else None
 
         # 组装
         results = []
@@ -434,7 +447,8 @@ class CycleMasterRosterView(APIView):
         # return ok({'count': total, 'page': page, 'page_size': page_size, 'results': ser.data})
 
         # 直接返回
-        return ok({'count': total, 'page': page, 'page_size': page_size, 'results': results})
+        return with_etag(ok({'count': total, 'page': page, 'page_size': page_size,
+                             'next': next_cursor, 'results': results}), etag)
 
 def ok(data=None, message='OK', code=0, http=200):
     return Response({'code': code, 'message': message, 'data': data}, status=http)
@@ -449,6 +463,10 @@ class PreplanSlotListCreateView(APIView):
         """
         GET /api/schedule/cycle-schedule/preplan/slots?cycle=1&weekday=5
         """
+        etag = make_etag('preplan_slots', get_versions(PREPLAN, TIMETABLE), sorted(request.query_params.lists()))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+
         qs = CyclePreplanSlot.objects.all().select_related('class_group','class_group__subject','teacher_override','room_override')
         cycle = request.query_params.get('cycle')
         if cycle: qs = qs.filter(cycle_id=cycle)
@@ -457,7 +475,7 @@ class PreplanSlotListCreateView(APIView):
         cg = request.query_params.get('class_group')
         if cg: qs = qs.filter(class_group_id=cg)
         data = CyclePreplanSlotSerializer(qs.order_by('weekday','start_time','id'), many=True).data
-        return ok(data)
+        return with_etag(ok(data), etag)
 
     @transaction.atomic
     def post(self, request):
@@ -494,4 +512,51 @@ class PreplanSlotDetailView(APIView):
         obj = CyclePreplanSlot.objects.filter(pk=pk).first()
         if not obj: return err('not found', 404, 404)
         obj.delete()
-        return ok({'deleted': 1}, 'deleted')
\ No newline at end of file
+        return ok({'deleted': 1}, 'deleted')
+
+
+class PreplanSolveView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        """
+        POST /api/schedule/cycle-schedule/cycles/{id}/preplan/solve
+        body: {[keep_overrides]=true, [max_backtracks]=2000, [apply]=false}
+        为本周期全部预排槽位自动分配教室/老师；apply=true 时写回 room_override / teacher_override
+        """
+        if not require_manager(request.user):
+            return err('permission denied', 403, 403)
+        cycle = Cycle.objects.filter(pk=pk).first()
+        if not cycle: return err('cycle not found', 404, 404)
+
+        body = request.data or {}
+        try:
+            max_backtracks = max(0, int(body.get('max_backtracks', DEFAULT_MAX_BACKTRACKS)))
+        except (TypeError, ValueError):
+            return err('max_backtracks must be an integer', 400, 400)
+
+        result = solve_cycle(cycle, keep_overrides=bool(body.get('keep_overrides', True)),
+                             max_backtracks=max_backtracks)
+        if body.get('apply'):
+            with transaction.atomic():
+                result['stats']['updated'] = apply_assignment(cycle, result['assignments'])
+            return ok(result, 'applied')
+        return ok(result)
+
+
+class PreplanConflictsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        """
+        GET /api/schedule/cycle-schedule/cycles/{id}/preplan/conflicts
+        本周期全部预排槽位的老师/教室/学生冲突（看板一次拉取即可高亮）
+        """
+        cycle = Cycle.objects.filter(pk=pk).first()
+        if not cycle: return err('cycle not found', 404, 404)
+
+        etag = make_etag('preplan_conflicts', cycle.id,
+                         get_versions(PREPLAN, TIMETABLE, cycle_roster_scope(cycle.id)))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return with_etag(ok(preplan_conflicts(cycle)), etag)
@@ -0,0 +1,20 @@
+# backend/students/management/commands/rebuild_student_search.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from students.search import pinyin_enabled, rebuild_search_index, REBUILD_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "全量重建学生搜索索引（StudentSearchDoc + SQLite FTS5 / PostgreSQL trigram）。批量导入学生、调整文档规则，或补装 pypinyin 后需要拼音搜索时执行。"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH_SIZE, help='每批处理的学生数')
+
+    def handle(self, *args, **options):
+        if not pinyin_enabled():
+            self.stderr.write(self.style.WARNING("未安装 pypinyin：拼音列将为空，姓名只能按汉字搜索（pip install -r requirements.txt）"))
+        t0 = time.perf_counter()
+        n = rebuild_search_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"已重建 {n} 名学生的搜索文档，用时 {time.perf_counter() - t0:.1f}s"))
@@ -0,0 +1,137 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:55
+
+import django.db.models.deletion
+from django.db import migrations, models, OperationalError
+
+FTS_TABLE = 'edu_student_search_fts'
+DOC_TABLE = 'edu_student_search_doc'
+
+SQLITE_FORWARD = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        document, grams, content='{DOC_TABLE}', content_rowid='student_id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER {DOC_TABLE}_ai AFTER INSERT ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, document, grams) VALUES (new.student_id, new.document, new.grams);
+    END""",
+    f"""CREATE TRIGGER {DOC_TABLE}_ad AFTER DELETE ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, document, grams) VALUES ('delete', old.student_id, old.document, old.grams);
+    END""",
+    f"""CREATE TRIGGER {DOC_TABLE}_au AFTER UPDATE ON {DOC_TABLE} BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, document, grams) VALUES ('delete', old.student_id, old.document, old.grams);
+        INSERT INTO {FTS_TABLE}(rowid, document, grams) VALUES (new.student_id, new.document, new.grams);
+    END""",
+]
+SQLITE_BACKWARD = [
+    f'DROP TRIGGER IF EXISTS {DOC_TABLE}_au',
+    f'DROP TRIGGER IF EXISTS {DOC_TABLE}_ad',
+    f'DROP TRIGGER IF EXISTS {DOC_TABLE}_ai',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+POSTGRES_FORWARD = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f'CREATE INDEX IF NOT EXISTS {DOC_TABLE}_document_trgm ON {DOC_TABLE} USING gin (document gin_trgm_ops)',
+]
+POSTGRES_BACKWARD = [
+    f'DROP INDEX IF EXISTS {DOC_TABLE}_document_trgm',
+]
+
+
+def _run(schema_editor, statements):
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def create_search_backend(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            _run(schema_editor, SQLITE_FORWARD)
+        except OperationalError:
+            # SQLite 未编译 FTS5/trigram（< 3.34）：退回 LIKE，搜索服务会自动识别
+            _run(schema_editor, SQLITE_BACKWARD)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_FORWARD)
+
+
+def drop_search_backend(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        _run(schema_editor, SQLITE_BACKWARD)
+    elif vendor == 'postgresql':
+        _run(schema_editor, POSTGRES_BACKWARD)
+
+
+def backfill(apps, schema_editor):
+    """
+    为已有学生生成搜索文档（插入时由触发器同步进 FTS）
+    文档构造按迁移当时的规则冻结在这里，不引用 students.search：之后改规则用 rebuild_student_search 重建
+    """
+    try:
+        from pypinyin import lazy_pinyin, Style
+    except ImportError:
+        lazy_pinyin = None
+
+    Student = apps.get_model('students', 'Student')
+    StudentGuardian = apps.get_model('students', 'StudentGuardian')
+    StudentSearchDoc = apps.get_model('students', 'StudentSearchDoc')
+
+    def short_grams(*texts):
+        grams = set()
+        for text in texts:
+            text = (text or '').lower().replace('|', '')
+            for i in range(len(text)):
+                grams.add(text[i])
+                if i + 1 < len(text):
+                    grams.add(text[i:i + 2])
+        return ' '.join(sorted(g.ljust(3, '|') for g in grams if g.strip()))
+
+    phones = {}
+    for sid, phone in StudentGuardian.objects.values_list('student_id', 'guardian__phone'):
+        if phone:
+            phones.setdefault(sid, set()).add(phone)
+
+    docs = []
+    for stu in Student.objects.select_related('school').only('id', 'name', 'remark', 'school__name').iterator():
+        full = initials = ''
+        if stu.name and lazy_pinyin is not None:
+            full = ''.join(lazy_pinyin(stu.name)).lower()
+            initials = ''.join(lazy_pinyin(stu.name, style=Style.FIRST_LETTER)).lower()
+        school_name = stu.school.name if stu.school_id else ''
+        phone_text = ' '.join(sorted(phones.get(stu.id, ())))
+        parts = [stu.name, full, initials, stu.remark, school_name, phone_text]
+        docs.append(StudentSearchDoc(
+            student_id=stu.id, name=stu.name or '', name_pinyin=full, name_initials=initials,
+            remark=stu.remark or '', school_name=school_name or '', phones=phone_text,
+            document=' '.join(p for p in parts if p).lower(), grams=short_grams(*parts),
+        ))
+    StudentSearchDoc.objects.bulk_create(docs, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('students', '0003_alter_school_id_alter_student_academic_status_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentSearchDoc',
+            fields=[
+                ('student', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_doc', serialize=False, to='students.student')),
+                ('name', models.CharField(blank=True, default='', max_length=50)),
+                ('name_pinyin', models.CharField(blank=True, default='', max_length=200)),
+                ('name_initials', models.CharField(blank=True, default='', max_length=50)),
+                ('remark', models.CharField(blank=True, default='', max_length=500)),
+                ('school_name', models.CharField(blank=True, default='', max_length=100)),
+                ('phones', models.CharField(blank=True, default='', max_length=500)),
+                ('document', models.TextField(blank=True, default='')),
+                ('grams', models.TextField(blank=True, default='')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'edu_student_search_doc',
+            },
+        ),
+        migrations.RunPython(create_search_backend, drop_search_backend),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -169,3 +169,26 @@ class ReferralReward(models.Model):
             return json.loads(self.rule_snapshot) if self.rule_snapshot else None
         except Exception:
             return None
+
+# ================= 搜索索引 =================
+
+class StudentSearchDoc(models.Model):
+    """
+    学生搜索文档（一人一行，由 students.search 维护，勿手工写）
+    - SQLite：迁移里建 FTS5(trigram) 外部内容表 + 触发器，随本表自动同步
+    - PostgreSQL：document 上建 pg_trgm GIN 索引
+    - 其它库：直接在这张窄表上 LIKE（不再联表）
+    """
+    student = models.OneToOneField(Student, on_delete=models.CASCADE, primary_key=True, related_name='search_doc')
+    name = models.CharField(max_length=50, blank=True, default='')
+    name_pinyin = models.CharField(max_length=200, blank=True, default='')   # 全拼；未装 pypinyin 时为空
+    name_initials = models.CharField(max_length=50, blank=True, default='')  # 首字母
+    remark = models.CharField(max_length=500, blank=True, default='')
+    school_name = models.CharField(max_length=100, blank=True, default='')
+    phones = models.CharField(max_length=500, blank=True, default='')         # 监护人手机号，空格分隔
+    document = models.TextField(blank=True, default='')   # 以上字段小写拼接（LIKE / trigram 用）
+    grams = models.TextField(blank=True, default='')      # 以上字段的 1~2 字短词（补足 trigram 对短查询的缺口）
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'edu_student_search_doc'
@@ -0,0 +1,151 @@
+# backend/students/search.py
+"""
+学生搜索服务（StudentSearchView / StudentsSearchView / StudentViewSet.list 共用）
+- 每个学生一行 StudentSearchDoc：姓名、拼音（全拼+首字母）、备注、学校名、监护人手机号
+- SQLite：FTS5 trigram 外部内容表 edu_student_search_fts，由触发器随 StudentSearchDoc 同步
+    · ≥3 字的词走 trigram；1~2 字的词（中文名很常见）走 grams 列里的补位短词
+    · grams 与 document 覆盖同样的字段，长短词命中范围一致
+- PostgreSQL：document 上的 pg_trgm GIN 索引，ILIKE 直接命中
+- 其它库：在窄表 document 上 LIKE
+- 文档由 signals 维护；全量重建：python manage.py rebuild_student_search
+拼音依赖 pypinyin（requirements.txt 已声明，可选）；未安装时拼音列为空，其它字段照常可搜，
+装上后执行一次 rebuild_student_search 补齐已有学生的拼音。
+"""
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:  # 可选依赖
+    lazy_pinyin = None
+
+from .models import Student, StudentGuardian, StudentSearchDoc
+
+FTS_TABLE = 'edu_student_search_fts'
+GRAM_PAD = '|'
+REBUILD_BATCH_SIZE = 1000
+
+_fts_available = None
+
+
+def fts_enabled() -> bool:
+    """当前连接是否有 FTS5 表（SQLite 且迁移时建表成功）；进程内只查一次"""
+    global _fts_available
+    if connection.vendor != 'sqlite':
+        return False
+    if _fts_available is None:
+        with connection.cursor() as cur:
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=%s", [FTS_TABLE])
+            _fts_available = cur.fetchone() is not None
+    return _fts_available
+
+
+# —— 文档构造 ——
+def pinyin_enabled() -> bool:
+    return lazy_pinyin is not None
+
+
+def name_pinyin(name: str):
+    """返回 (全拼, 首字母)；没装 pypinyin 返回空串"""
+    if not name or not pinyin_enabled():
+        return '', ''
+    full = ''.join(lazy_pinyin(name)).lower()
+    initials = ''.join(lazy_pinyin(name, style=Style.FIRST_LETTER)).lower()
+    return full, initials
+
+
+def short_grams(*texts) -> str:
+    """1~2 字的子串，右侧补 GRAM_PAD 到 3 字，使其能被 trigram 精确命中"""
+    grams = set()
+    for text in texts:
+        text = (text or '').lower().replace(GRAM_PAD, '')
+        for i in range(len(text)):
+            grams.add(text[i])
+            if i + 1 < len(text):
+                grams.add(text[i:i + 2])
+    grams.discard(' ')
+    return ' '.join(sorted(g.ljust(3, GRAM_PAD) for g in grams if g.strip()))
+
+
+def _build_doc(student, school_name: str, phones) -> StudentSearchDoc:
+    full, initials = name_pinyin(student.name)
+    phones = ' '.join(sorted(set(p for p in phones if p)))
+    parts = [student.name, full, initials, student.remark, school_name, phones]
+    return StudentSearchDoc(
+        student_id=student.id,
+        name=student.name or '',
+        name_pinyin=full,
+        name_initials=initials,
+        remark=student.remark or '',
+        school_name=school_name or '',
+        phones=phones,
+        document=' '.join(p for p in parts if p).lower(),
+        grams=short_grams(*parts),
+    )
+
+
+def refresh_student_docs(student_ids) -> int:
+    """重建指定学生的搜索文档（3 次查询 + 批量写）；已删除的学生只清文档"""
+    student_ids = list(set(student_ids))
+    if not student_ids:
+        return 0
+    students = list(Student.objects.filter(id__in=student_ids)
+                    .select_related('school').only('id', 'name', 'remark', 'school__name'))
+    phones = defaultdict(list)
+    for sid, phone in (StudentGuardian.objects.filter(student_id__in=student_ids)
+                       .values_list('student_id', 'guardian__phone')):
+        phones[sid].append(phone)
+
+    docs = [_build_doc(s, s.school.name if s.school_id else '', phones.get(s.id, []))
+            for s in students]
+    # 先删后插：FTS 触发器按行同步
+    StudentSearchDoc.objects.filter(student_id__in=student_ids).delete()
+    StudentSearchDoc.objects.bulk_create(docs)
+    return len(docs)
+
+
+def rebuild_search_index(batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    """全量重建（rebuild_student_search 命令使用）"""
+    StudentSearchDoc.objects.all().delete()
+    total = 0
+    last_id = 0
+    while True:
+        ids = list(Student.objects.filter(id__gt=last_id).order_by('id')
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        total += refresh_student_docs(ids)
+        last_id = ids[-1]
+    return total
+
+
+# —— 查询 ——
+def _terms(keyword: str):
+    return [t for t in (keyword or '').lower().replace(GRAM_PAD, ' ').replace('"', ' ').split() if t]
+
+
+def _fts_query(terms) -> str:
+    parts = []
+    for t in terms:
+        if len(t) >= 3:
+            parts.append('"%s"' % t)
+        else:
+            parts.append('grams : "%s"' % t.ljust(3, GRAM_PAD))
+    return ' AND '.join(parts)
+
+
+def search_students(qs, keyword: str):
+    """在给定 Student 查询集上按关键词过滤（多个词之间为“且”）；空关键词原样返回"""
+    terms = _terms(keyword)
+    if not terms:
+        return qs
+    if fts_enabled():
+        return qs.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [_fts_query(terms)]
+        ))
+    docs = StudentSearchDoc.objects.all()
+    for t in terms:
+        docs = docs.filter(document__icontains=t)
+    return qs.filter(id__in=docs.values('student_id'))
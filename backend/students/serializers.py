@@ -1,15 +1,30 @@
 from rest_framework import serializers
 from django.db import transaction
+from django.db.models import Prefetch
 from django.contrib.auth import get_user_model
 
 from .models import (
     Student, Guardian, StudentGuardian, School,
     RELATION_CHOICES, GRADE_CHOICES, VISIT_CHANNEL, ReferralReward
 )
+from .search import refresh_student_docs
 from academics.models import Enrollment
 
 User = get_user_model()
 
+# --- 字典标签（模块级预计算，避免逐行 dict(...)） ---
+GRADE_LABELS = dict(GRADE_CHOICES)
+RELATION_LABELS = dict(RELATION_CHOICES)
+VISIT_CHANNEL_LABELS = dict(VISIT_CHANNEL)
+
+# --- 主联系人预取（列表/搜索共用，结果挂在 student.primary_links） ---
+def primary_links_prefetch():
+    return Prefetch(
+        'guardian_links',
+        queryset=StudentGuardian.objects.filter(is_primary=True).select_related('guardian'),
+        to_attr='primary_links',
+    )
+
 # --- 嵌套监护人输入 ---
 class GuardianInlineIn(serializers.Serializer):
     relation_code = serializers.ChoiceField(choices=[c[0] for c in RELATION_CHOICES])
@@ -37,21 +52,26 @@ class StudentListOut(serializers.ModelSerializer):
         ]
 
     def get_grade_label(self, obj):
-        d = dict(GRADE_CHOICES); return d.get(obj.grade, '')
+        return GRADE_LABELS.get(obj.grade, '')
 
     def get_visit_channel_label(self, obj):
-        from .models import VISIT_CHANNEL
-        return dict(VISIT_CHANNEL).get(obj.visit_channel, '')
+        return VISIT_CHANNEL_LABELS.get(obj.visit_channel, '')
 
     def get_primary_contact(self, obj):
-        link = obj.guardian_links.filter(is_primary=True).select_related('guardian').first()
+        # 列表页走 primary_links_prefetch()；单条（retrieve）未预取时回退查询
+        if hasattr(obj, 'primary_links'):
+            link = obj.primary_links[0] if obj.primary_links else None
+        else:
+            link = obj.guardian_links.filter(is_primary=True).select_related('guardian').first()
         if not link: return None
-        rel_map = dict(RELATION_CHOICES)
-        return {'relation_label': rel_map.get(link.relation_code, ''),
+        return {'relation_label': RELATION_LABELS.get(link.relation_code, ''),
                 'phone': link.guardian.phone}
 
     def get_other_contacts_count(self, obj):
-        cnt = obj.guardian_links.count()
+        # 列表页由 annotate(contacts_count=...) 提供
+        cnt = getattr(obj, 'contacts_count', None)
+        if cnt is None:
+            cnt = obj.guardian_links.count()
         return max(0, cnt - 1)
 
     def get_current_salesperson(self, obj):
@@ -72,7 +92,7 @@ class StudentIn(serializers.Serializer):
 
     def validate(self, attrs):
         # 年级合法
-        if attrs.get('grade_id') not in dict(GRADE_CHOICES):
+        if attrs.get('grade_id') not in GRADE_LABELS:
             raise serializers.ValidationError({'grade_id': '年级不在 K12 范围'})
 
         # 学校存在
@@ -87,7 +107,7 @@ class StudentIn(serializers.Serializer):
         if vc == 'referral':
             if not ref_id:
                 raise serializers.ValidationError({'referral_student_id': '转介绍必须选择推荐学员'})
-            if not Enrollment.is_student_studying(ref_id):  # 只看派生在读
+            if ref_id not in Enrollment.studying_student_ids([ref_id]):  # 只看派生在读
                 raise serializers.ValidationError({'referral_student_id': '仅支持在读学员作为推荐人'})
         elif vc == 'other':
             if not other_text:
@@ -138,6 +158,7 @@ class StudentIn(serializers.Serializer):
                 remark=g.get('remark') or ''
             ))
         StudentGuardian.objects.bulk_create(links)
+        refresh_student_docs([stu.id])  # bulk_create 不触发信号：补上监护人手机号
 
         # 转介绍奖励（pending）
         if stu.visit_channel == 'referral' and stu.referral_student_id:
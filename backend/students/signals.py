@@ -0,0 +1,32 @@
+# backend/students/signals.py
+"""
+搜索文档维护：学生/学校/监护人/监护关系写入后重建相关学生的 StudentSearchDoc
+（学生删除时文档随外键级联删除，FTS 由触发器同步）
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Student, School, Guardian, StudentGuardian
+from .search import refresh_student_docs
+
+
+@receiver(post_save, sender=Student)
+def _student_saved(sender, instance, **kwargs):
+    refresh_student_docs([instance.id])
+
+
+@receiver(post_save, sender=School)
+def _school_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_student_docs(Student.objects.filter(school_id=instance.id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Guardian)
+def _guardian_saved(sender, instance, created, **kwargs):
+    if not created:
+        refresh_student_docs(instance.student_links.values_list('student_id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=StudentGuardian)
+def _link_changed(sender, instance, **kwargs):
+    refresh_student_docs([instance.student_id])
@@ -1,3 +1,118 @@
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from rest_framework.test import APIClient
+
+from . import search
+from .models import School, Student, Guardian, StudentGuardian, StudentSearchDoc
+
+User = get_user_model()
+
+
+class StudentListQueryCountTests(TestCase):
+    """学生列表页的查询数固定，不随 page_size 增长（N+1 回归）"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='admin', role='admin', is_staff=True)
+        sales = User.objects.create(username='sales', role='salesperson', name='班主任')
+        school = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+        for i in range(25):
+            stu = Student.objects.create(
+                name=f'学生{i}', grade=8, school=school, visit_channel='walk_in',
+                current_salesperson=sales,
+            )
+            for j, relation in enumerate(('mother', 'father')):
+                g = Guardian.objects.create(phone=f'138{i:04d}{j:04d}')
+                StudentGuardian.objects.create(student=stu, guardian=g, relation_code=relation, is_primary=(j == 0))
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _list(self, page_size):
+        return self.client.get('/api/students/', {'page_size': page_size})
+
+    def test_list_runs_fixed_number_of_queries(self):
+        # count + 当前页（含学校/班主任 join 与联系人数 annotate）+ 主联系人 prefetch
+        with self.assertNumQueries(3):
+            resp = self._list(5)
+        self.assertEqual(resp.status_code, 200)
+        with self.assertNumQueries(3):
+            resp = self._list(20)
+        self.assertEqual(len(resp.json()['data']['results']), 20)
+
+    def test_list_contact_fields(self):
+        row = self._list(1).json()['data']['results'][0]
+        self.assertEqual(row['primary_contact'], {'relation_label': '母亲', 'phone': '13800240000'})
+        self.assertEqual(row['other_contacts_count'], 1)
+        self.assertEqual(row['grade_label'], '初二')
+        self.assertEqual(row['visit_channel_label'], '直访')
+        self.assertEqual(row['current_salesperson']['name'], '班主任')
+
+
+class StudentSearchTests(TestCase):
+    """长短关键词命中同样的字段（姓名/拼音/备注/学校/监护人手机号）；FTS 与 LIKE 两条路径结果一致"""
+
+    @classmethod
+    def setUpTestData(cls):
+        shiyan = School.objects.create(name='实验中学', pinyin='shiyanzhongxue')
+        other = School.objects.create(name='育才中学', pinyin='yucaizhongxue')
+        cls.zhang = Student.objects.create(name='张伟', grade=8, school=shiyan, remark='想补数学')
+        cls.li = Student.objects.create(name='李娜', grade=8, school=shiyan)
+        cls.wang = Student.objects.create(name='王芳', grade=8, school=other, remark='英语基础弱')
+        g = Guardian.objects.create(phone='13912345678')
+        StudentGuardian.objects.create(student=cls.wang, guardian=g, relation_code='mother', is_primary=True)
+
+    def _ids(self, keyword):
+        return set(search.search_students(Student.objects.all(), keyword).values_list('id', flat=True))
+
+    def _check(self, keyword, expected):
+        for fts in (True, False):
+            with self.subTest(keyword=keyword, fts=fts), mock.patch.object(search, 'fts_enabled', return_value=fts):
+                self.assertEqual(self._ids(keyword), {s.id for s in expected})
+
+    def test_short_name(self):
+        self._check('张', [self.zhang])
+        self._check('李娜', [self.li])
+
+    def test_short_remark(self):
+        self._check('数学', [self.zhang])
+        self._check('英语', [self.wang])
+
+    def test_phone(self):
+        self._check('39', [self.wang])
+        self._check('5678', [self.wang])
+
+    def test_school_short_and_long_agree(self):
+        self._check('实验', [self.zhang, self.li])
+        self._check('实验中学', [self.zhang, self.li])
+
+    def test_terms_are_anded(self):
+        self._check('实验 数学', [self.zhang])
+        self._check('育才 数学', [])
+
+    def test_docs_follow_remark_update(self):
+        self.li.remark = '物理竞赛'
+        self.li.save()
+        self._check('物理', [self.li])
+
+    @skipUnless(search.pinyin_enabled(), 'pypinyin 未安装')
+    def test_pinyin_full_and_initials(self):
+        doc = StudentSearchDoc.objects.get(student=self.zhang)
+        self.assertEqual((doc.name_pinyin, doc.name_initials), ('zhangwei', 'zw'))
+        self._check('zw', [self.zhang])
+        self._check('ZhangWei', [self.zhang])
+        self._check('lina', [self.li])
+        self._check('wf 英语', [self.wang])
 
-# Create your tests here.
+    def test_without_pypinyin_names_still_searchable(self):
+        with mock.patch.object(search, 'lazy_pinyin', None):
+            self.assertFalse(search.pinyin_enabled())
+            search.rebuild_search_index()
+        doc = StudentSearchDoc.objects.get(student=self.zhang)
+        self.assertEqual((doc.name_pinyin, doc.name_initials), ('', ''))
+        self._check('张伟', [self.zhang])
+        self._check('zw', [])
+        self._check('zhangwei', [])
@@ -1,13 +1,16 @@
 from rest_framework import viewsets, permissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from django.db.models import Q
+from django.db.models import Q, Count
 from django.contrib.auth import get_user_model
 
 from .models import (
     Student, School, GRADE_CHOICES, RELATION_CHOICES, VISIT_CHANNEL, ReferralReward
 )
-from .serializers import StudentListOut, StudentIn
+from .serializers import (
+    StudentListOut, StudentIn, primary_links_prefetch, GRADE_LABELS, RELATION_LABELS
+)
+from .search import search_students
 from academics.models import Enrollment
 
 User = get_user_model()
@@ -61,24 +64,24 @@ class StudentsSearchView(APIView):
     permission_classes = [permissions.IsAuthenticated]
     def get(self, request):
         kw = request.query_params.get('keyword', '')
-        qs = Student.objects.all()
-        if kw:
-            qs = qs.filter(Q(name__icontains=kw) | Q(remark__icontains=kw))
-        # 仅保留在读
-        ids = [s.id for s in qs[:200] if Enrollment.is_student_studying(s.id)]
-        qs = Student.objects.filter(id__in=ids).order_by('-id')[:30]
+        qs = search_students(Student.objects.all(), kw)
+        # 仅保留在读：前 200 个候选一次性判定
+        candidates = list(qs.values_list('id', flat=True)[:200])
+        ids = Enrollment.studying_student_ids(candidates)
+        qs = (Student.objects.filter(id__in=ids).order_by('-id')
+              .prefetch_related(primary_links_prefetch())[:30])
         data = []
         for s in qs:
-            link = s.guardian_links.filter(is_primary=True).select_related('guardian').first()
+            link = s.primary_links[0] if s.primary_links else None
             primary = None
             if link:
                 primary = {
-                    'relation_label': dict(RELATION_CHOICES).get(link.relation_code, ''),
+                    'relation_label': RELATION_LABELS.get(link.relation_code, ''),
                     'phone_mask': link.guardian.phone if not link.guardian.phone else (link.guardian.phone[:3] + '****' + link.guardian.phone[-4:])
                 }
             data.append({
                 'id': s.id, 'name': s.name,
-                'grade_label': dict(GRADE_CHOICES).get(s.grade, ''),
+                'grade_label': GRADE_LABELS.get(s.grade, ''),
                 'primary_contact': primary
             })
         return Response({'code': 200, 'data': data})
@@ -103,7 +106,7 @@ class StudentViewSet(viewsets.ModelViewSet):
 
         qs = self.get_queryset()
         if kw:
-            qs = qs.filter(Q(name__icontains=kw) | Q(remark__icontains=kw) | Q(school__name__icontains=kw))
+            qs = search_students(qs, kw)
         if grade_id:
             qs = qs.filter(grade=int(grade_id))
         if salesperson_id:
@@ -118,7 +121,9 @@ class StudentViewSet(viewsets.ModelViewSet):
         start = (page - 1) * page_size
         end = start + page_size
         total = qs.count()
-        ser = StudentListOut(qs[start:end], many=True)
+        rows = (qs.annotate(contacts_count=Count('guardian_links'))
+                .prefetch_related(primary_links_prefetch())[start:end])
+        ser = StudentListOut(rows, many=True)
         return Response({'code': 200, 'data': {'results': ser.data, 'count': total}})
 
     def create(self, request, *args, **kwargs):
@@ -16,3 +16,13 @@ export function getUnitPriceByStudent(studentId, courseMode, qty = 1) {
 export function createPurchase(payload) {
   return api.post('billing/purchases', payload)
 }
+
+/**
+ * 批量报价：一次取回整张价目表
+ * payload: { items: [{ student_id | grade, course_mode, qty }] }
+ *       或 { grid: { student_id | grades, course_modes?, qtys } }
+ * 返回与请求行一一对应：{ unit, unit_price, subtotal, gift_qty, rule_id, gift_rule_id, error }
+ */
+export function quotePrices(payload) {
+  return api.post('billing/price/batch', payload)
+}
@@ -62,3 +62,6 @@ export function getCycleMasterRoster(cycleId, params = {}) {
 
 export const publishCycle = (id, payload) =>
   request.post(`/schedule/cycle-schedule/cycles/${id}/publish`, payload)
+
+export const getPublishJob = (jobId) =>
+  request.get(`/schedule/cycle-schedule/publish-jobs/${jobId}`)
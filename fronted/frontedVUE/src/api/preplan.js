@@ -35,3 +35,11 @@ export const getPreplanSlot = (id) =>
 // 删除（当前不做删除入口，预留）
 export const deletePreplanSlot = (id) =>
   request.delete(API(`/schedule/cycle-schedule/preplan/slots/${id}`))
+
+// 自动分配教室/老师（apply=true 时写回 override）
+export const solvePreplan = (cycleId, data) =>
+  request.post(API(`/schedule/cycle-schedule/cycles/${cycleId}/preplan/solve`), data)
+
+// 整周期冲突报告（老师/教室/学生）
+export const getPreplanConflicts = (cycleId) =>
+  request.get(API(`/schedule/cycle-schedule/cycles/${cycleId}/preplan/conflicts`))
@@ -20,6 +20,7 @@ export const listTeachers  = () => request.get(API('/schedule/teachers'))
 
 // ---- 班级 ----
 export const createClassGroup   = (data) => request.post(API('/schedule/class-groups'), data)
+export const previewClassGroup  = (data) => request.post(API('/schedule/class-groups/preview'), data)
 export const listClassGroups    = (params) => request.get(API('/schedule/class-groups'), { params })
 export const enrollClassGroup   = (id, data) => request.post(API(`/schedule/class-groups/${id}/enroll`), data)
 export const unenrollClassGroup = (id, data) => request.post(API(`/schedule/class-groups/${id}/unenroll`), data)
@@ -35,6 +36,10 @@ export const revokeLeave = (lessonId, data) => request.delete(API(`/schedule/les
 export const getAttendance    = (lessonId) => request.get(API(`/schedule/lessons/${lessonId}/attendance`))
 export const commitAttendance = (lessonId, data) => request.post(API(`/schedule/lessons/${lessonId}/attendance`), data)
 export const revertAttendance = (lessonId) => request.post(API(`/schedule/lessons/${lessonId}/attendance/revert`))
+// 多课次一次提交：{ lessons: [{ lesson_id, all_present?, items? }] }；任一课次不通过则整批不写
+export const commitAttendanceBulk = (data) => request.post(API(`/schedule/lessons/attendance/bulk`), data)
+// 批量撤销消课（admin）：{ lesson_ids } | { class_group_id, date_from?, date_to? } | { date_from, date_to, campus_id? }
+export const revertAttendanceBulk = (data) => request.post(API(`/schedule/lessons/attendance/revert/bulk`), data)
 
 
 // ---- 排课中增删学生 ----